@@ -1,6 +1,13 @@
 #!/usr/bin/python3
 
 import os
+import sys
+import time
+import json
+import hashlib
+import shutil
+import concurrent.futures
+import multiprocessing
 from merge_utils import *
 
 # KIT DESIGN AND DEVELOPER DOCS
@@ -113,14 +120,18 @@ kit_groups = {
 
 kit_order = [ 'prime', 'shared', None, 'current' ]
 
-def getKitPrepSteps(kit_dict):
+def getKitPrepSteps(kit_dict, source=None):
+
+	# source is the gentoo-staging tree (or snapshot) the kit is generated from:
+	if source == None:
+		source = gentoo_staging
 
 	kit_steps = {
 		'core-kit' : { 'pre' : [
 				GenerateRepoMetadata("core-kit", aliases=["gentoo"], priority=1000),
-				SyncDir(gentoo_staging.root, "profiles", exclude=["repo_name"]),
+				SyncDir(source.root, "profiles", exclude=["repo_name"]),
 				SyncDir(funtoo_overlay.root, "profiles", "profiles", exclude=["repo_name", "categories", "updates"]),
-				SyncDir(gentoo_staging.root, "metadata", exclude=["cache","md5-cache","layout.conf"]),
+				SyncDir(source.root, "metadata", exclude=["cache","md5-cache","layout.conf"]),
 				SyncFiles(funtoo_overlay.root, {
 						"COPYRIGHT.txt":"COPYRIGHT.txt",
 						"LICENSE.txt":"LICENSE.txt",
@@ -128,7 +139,7 @@ def getKitPrepSteps(kit_dict):
 				ThirdPartyMirrors(),
 				RunSed(["profiles/base/make.defaults"], ["/^PYTHON_TARGETS=/d", "/^PYTHON_SINGLE_TARGET=/d"]),
 				CopyAndRename("profiles/funtoo/1.0/linux-gnu/arch/x86-64bit/subarch", "profiles/funtoo/1.0/linux-gnu/arch/pure64/subarch", lambda x: os.path.basename(x) + "-pure64"),
-				SyncFiles(gentoo_staging.root, {
+				SyncFiles(source.root, {
 					"profiles/package.mask":"profiles/package.mask/00-gentoo",
 					"profiles/arch/amd64/package.use.mask":"profiles/funtoo/1.0/linux-gnu/arch/x86-64bit/package.use.mask/01-gentoo",
 					"profiles/arch/amd64/use.mask":"profiles/funtoo/1.0/linux-gnu/arch/x86-64bit/use.mask/01-gentoo",
@@ -161,7 +172,7 @@ def getKitPrepSteps(kit_dict):
 			]
 		},
 		'nokit' : { 'pre' : [
-				SyncDir(gentoo_staging.root),
+				SyncDir(source.root),
 				GenerateRepoMetadata("nokit", masters=["core-kit"], priority=-2000),
 			]
 		}
@@ -185,9 +196,149 @@ def getKitPrepSteps(kit_dict):
 
 	return ( out_pre_steps, out_post_steps )
 
-def updateKit(kit_dict, kitted_catpkgs, create=False):
+# INCREMENTAL UPDATES
+
+# With --incremental, a kit that was generated before is not cleaned and re-copied from scratch. Instead, we record the
+# gentoo-staging and kit-fixups SHA1s used for each kit branch, along with a fingerprint of everything else that decides
+# its contents (package-set files, the catpkgs claimed by previously generated kits, and these scripts). If the
+# fingerprint still matches and the kit branch is where we left it, only the catpkgs, eclasses and licenses that git
+# says have changed since then are copied again, and anything that is no longer selected is removed. Untouched files
+# keep their mtimes, so egencache can reuse its cache. nokit is always regenerated in full.
+
+def kitStateFile(kit_dict):
+	return os.path.join(cache_dir, "kits", "%s-%s.json" % ( kit_dict['name'], kit_dict['branch'] ))
+
+def kitFingerprint(kit_dict, kitted_catpkgs):
+	h = hashlib.sha1()
+	h.update(json.dumps([ kit_dict['name'], kit_dict['branch'], kit_dict['src_branch'] ]).encode("utf-8"))
+	pkgdir = funtoo_overlay.root + "/funtoo/scripts"
+	script_dir = os.path.dirname(os.path.realpath(__file__))
+	paths = [
+		pkgdir + "/package-sets/%s-packages" % kit_dict['name'],
+		pkgdir + "/package-sets/%s-skip" % kit_dict['name'],
+		os.path.realpath(__file__),
+		script_dir + "/merge_utils.py"
+	]
+	hashFiles(h, paths)
+	h.update("\n".join(sorted(kitted_catpkgs.keys())).encode("utf-8"))
+	if kit_dict['name'] == 'core-kit':
+		# core-kit's profiles are synced from funtoo-overlay:
+		h.update(str(gitRevParse(funtoo_overlay.root)).encode("utf-8"))
+	return h.hexdigest()
+
+def getKitChanges(kit_dict, kit, fingerprint, src_sha, fixup_sha):
+
+	"""
+	Return a dict with the "catpkgs", "eclasses" and "licenses" that need to be copied again to update kit
+	incrementally, or None if the kit needs to be regenerated from scratch.
+	"""
+
+	try:
+		with open(kitStateFile(kit_dict), "r") as f:
+			state = json.load(f)
+	except (IOError, ValueError):
+		print("No usable state for %s %s; regenerating in full." % ( kit_dict['name'], kit_dict['branch'] ))
+		return None
+	if state["fingerprint"] != fingerprint:
+		print("Package set or previous kits changed for %s %s; regenerating in full." % ( kit_dict['name'], kit_dict['branch'] ))
+		return None
+	dest_paths = gitChangedPaths(kit.root, state["dest_head"])
+	if gitRevParse(kit.root) != state["dest_head"] or dest_paths == None or len(dest_paths):
+		print("Kit %s %s was modified since it was last generated; regenerating in full." % ( kit_dict['name'], kit_dict['branch'] ))
+		return None
+	src_paths = gitChangedPaths(gentoo_staging.root, state["src_sha"], src_sha)
+	fixup_paths = gitChangedPaths(fixup_repo.root, state["fixup_sha"], fixup_sha)
+	if src_paths == None or fixup_paths == None:
+		print("Can't diff against previous SHA1s for %s %s; regenerating in full." % ( kit_dict['name'], kit_dict['branch'] ))
+		return None
+
+	changes = { "catpkgs" : set(), "eclasses" : set(), "licenses" : set() }
+	for path in src_paths:
+		parts = path.split("/")
+		if len(parts) == 2 and parts[0] == "eclass":
+			changes["eclasses"].add(parts[1])
+		elif len(parts) == 2 and parts[0] == "licenses":
+			changes["licenses"].add(parts[1])
+		elif pathToCatPkg(path) != None:
+			changes["catpkgs"].add(pathToCatPkg(path))
+		elif kit_dict['name'] == 'core-kit':
+			# profiles, metadata, etc. are synced into core-kit, and those steps don't remove stale files:
+			print("%s changed in gentoo-staging; regenerating core-kit in full." % path)
+			return None
+	fixup_prefixes = [ "%s/%s/" % ( kit_dict['name'], fixup_dir ) for fixup_dir in [ "global", kit_dict['branch'] ] ]
+	for path in fixup_paths:
+		if path.startswith("eclass/"):
+			changes["eclasses"].add(os.path.basename(path))
+			continue
+		for prefix in fixup_prefixes:
+			if not path.startswith(prefix):
+				continue
+			path = path[len(prefix):]
+			if path.startswith("eclass/"):
+				changes["eclasses"].add(os.path.basename(path))
+			elif pathToCatPkg(path) != None:
+				changes["catpkgs"].add(pathToCatPkg(path))
+	print("Updating %s %s incrementally: %s catpkgs, %s eclasses, %s licenses changed." % ( kit_dict['name'], kit_dict['branch'],
+		len(changes["catpkgs"]), len(changes["eclasses"]), len(changes["licenses"]) ))
+	return changes
+
+def removeStaleFiles(kit, steps):
+	# After an incremental update, remove catpkgs, eclasses and licenses from the kit that none of steps selected:
+	wanted = set()
+	for step in steps:
+		if isinstance(step, InsertEbuilds) or isinstance(step, InsertFilesFromSubdir):
+			wanted.update(step.selected)
+	wanted_dirs = set([ "/".join(path.split("/")[:2]) for path in wanted ])
+	for cat in os.listdir(kit.root):
+		catdir = os.path.join(kit.root, cat)
+		if not ( "-" in cat or cat == "virtual" ) or not os.path.isdir(catdir):
+			continue
+		for pkg in os.listdir(catdir):
+			if cat + "/" + pkg in wanted_dirs or not os.path.isdir(os.path.join(catdir, pkg)):
+				continue
+			print("Removing stale catpkg %s/%s" % ( cat, pkg ))
+			shutil.rmtree(os.path.join(catdir, pkg))
+		if len(os.listdir(catdir)) == 0:
+			os.rmdir(catdir)
+	for subdir in [ "eclass", "licenses" ]:
+		if not os.path.isdir(os.path.join(kit.root, subdir)):
+			continue
+		for fn in os.listdir(os.path.join(kit.root, subdir)):
+			if subdir + "/" + fn not in wanted:
+				print("Removing stale %s/%s" % ( subdir, fn ))
+				os.unlink(os.path.join(kit.root, subdir, fn))
+
+def saveKitState(kit_dict, kit, fingerprint, src_sha, fixup_sha):
+	state = {
+		"fingerprint" : fingerprint,
+		"src_sha" : src_sha,
+		"fixup_sha" : fixup_sha,
+		"dest_head" : gitRevParse(kit.root)
+	}
+	fn = kitStateFile(kit_dict)
+	if not os.path.exists(os.path.dirname(fn)):
+		os.makedirs(os.path.dirname(fn))
+	with open(fn + ".tmp", "w") as f:
+		json.dump(state, f)
+	os.replace(fn + ".tmp", fn)
+
+def kitTree(kit_dict):
+	return GitTree(kit_dict['name'], kit_dict['branch'], "repos@git.funtoo.org:kits/%s.git" % kit_dict['name'], root="/var/git/dest-trees/%s" % kit_dict['name'], pull=True, step_cache=True)
+
+def updateKit(kit_dict, kitted_catpkgs, create=False, incremental=False):
+
+	# Returns the catpkgs that ended up in the kit (None for nokit), after adding them to kitted_catpkgs. The kit is
+	# generated from a snapshot of gentoo-staging at src_branch, so kits using different SHA1s can run at the same time:
+
+	with tracer.span("%s:%s" % ( kit_dict['name'], kit_dict['branch'] ), "kit", src_branch=kit_dict['src_branch'], incremental=incremental):
+		source = gentoo_staging.snapshot(kit_dict['src_branch'])
+		try:
+			return updateKitFrom(source, kit_dict, kitted_catpkgs, create=create, incremental=incremental)
+		finally:
+			source.release()
+
+def updateKitFrom(source, kit_dict, kitted_catpkgs, create=False, incremental=False):
 
-	gentoo_staging.run([GitCheckout(kit_dict['src_branch'])])
 	# TODO : create branch if it doesn't yet exist in the kit.
 
 	if create and not os.path.exists('/var/git/dest-trees/%s' % kit_dict['name']):
@@ -196,15 +347,24 @@ def updateKit(kit_dict, kitted_catpkgs, create=False):
 			if kit_dict['branch'] != 'master':
 				# create branch
 				os.system('cd /var/git/dest-trees/%s' % kit_dict['name'] + ' ;git checkout -b %s' % kit_dict['branch'])
-	kit_dict['kit'] = kit = GitTree(kit_dict['name'], kit_dict['branch'], "repos@git.funtoo.org:kits/%s.git" % kit_dict['name'], root="/var/git/dest-trees/%s" % kit_dict['name'], pull=True)
+	kit_dict['kit'] = kit = kitTree(kit_dict)
+
+	kit.run([GitCheckout(kit_dict['branch'])])
+	src_sha = source.head()
+	fixup_sha = gitRevParse(fixup_repo.root)
+	fingerprint = kitFingerprint(kit_dict, kitted_catpkgs)
+	changes = None
+	if incremental and kit_dict['name'] != 'nokit':
+		changes = getKitChanges(kit_dict, kit, fingerprint, src_sha, fixup_sha)
 	
 	# Phase 1: prep the kit
 	pre_steps = [
-		GitCheckout(kit_dict['branch']),
-		CleanTree()
+		GitCheckout(kit_dict['branch'])
 	]
+	if changes == None:
+		pre_steps += [ CleanTree() ]
 	
-	prep_steps = getKitPrepSteps(kit_dict)
+	prep_steps = getKitPrepSteps(kit_dict, source)
 	pre_steps += prep_steps[0]
 	post_steps = prep_steps[1]
 
@@ -213,12 +373,12 @@ def updateKit(kit_dict, kitted_catpkgs, create=False):
 		# perform these steps only, then return from this function. nokit has a special set of steps
 		pre_steps += [
 			RemoveFiles(list(kitted_catpkgs.keys())),
-			CreateCategories(gentoo_staging),
+			CreateCategories(source),
 			GenUseLocalDesc(),
 			GenCache( cache_dir="/var/cache/edb/%s-%s" % ( kit_dict['name'], kit_dict['branch'] ) )
 		]
 		kit.run(pre_steps)
-		return
+		return None
 	# SPECIAL NOKIT STEPS END
 	kit.run(pre_steps)
 
@@ -226,7 +386,7 @@ def updateKit(kit_dict, kitted_catpkgs, create=False):
 
 	# Here we generate our main set of ebuild copy steps, based on the contents of the package-set file for the kit:
 
-	steps = generateShardSteps(kit_dict['name'], gentoo_staging, kit, pkgdir=funtoo_overlay.root+"/funtoo/scripts", branch=kit_dict['branch'], catpkg_dict=kitted_catpkgs)
+	steps = generateShardSteps(kit_dict['name'], source, kit, pkgdir=funtoo_overlay.root+"/funtoo/scripts", branch=kit_dict['branch'], catpkg_dict=kitted_catpkgs, restrict=changes)
 	kit.run(steps)
 
 	# Phase 3: copy eclasses, licenses, and ebuild/eclass fixups from the kit-fixups repository. 
@@ -234,9 +394,15 @@ def updateKit(kit_dict, kitted_catpkgs, create=False):
 	# First, we will auto-detect the eclasses and licenses used by the ebuilds we copied over, and ensure these are copied over
 	# to the kit. We will use the gentoo-staging SHA1 as a source for these:
 
+	# When updating incrementally, only the catpkgs, eclasses and licenses in changes are copied again by these steps
+	# (along with anything that doesn't exist in the kit yet):
+
+	restrict_catpkgs = changes["catpkgs"] if changes != None else None
+	restrict_eclasses = changes["eclasses"] if changes != None else None
+
 	steps += [
-		InsertLicenses(gentoo_staging, select=list(getAllLicenses(ebuild_repo=kit, super_repo=gentoo_staging))),
-		InsertEclasses(gentoo_staging, select=list(getAllEclasses(ebuild_repo=kit, super_repo=gentoo_staging))),
+		InsertLicenses(source, select=list(getAllLicenses(ebuild_repo=kit, super_repo=source)), restrict=changes["licenses"] if changes != None else None),
+		InsertEclasses(source, select=list(getAllEclasses(ebuild_repo=kit, super_repo=source)), restrict=restrict_eclasses),
 	]
 
 	# Next, we are going to process the kit-fixups repository and look for ebuilds and eclasses to replace. Eclasses can be
@@ -252,56 +418,270 @@ def updateKit(kit_dict, kitted_catpkgs, create=False):
 	# kit-fixups/<kit>/<branch>/cat/pkg <----- install cat/pkg into a particular branch of a kit
 
 	if os.path.exists(fixup_repo.root + "/eclass"):
-		steps += [ InsertEclasses(fixup_repo, select="all", skip=None) ]
+		steps += [ InsertEclasses(fixup_repo, select="all", skip=None, restrict=restrict_eclasses) ]
 	for fixup_dir in [ "global", kit_dict["branch"] ]:
 		fixup_path = kit_dict['name'] + "/" + fixup_dir
 		if os.path.exists(fixup_repo.root + "/" + fixup_path):
 			if os.path.exists(fixup_repo.root + "/" + fixup_path + "/eclass"):
 				steps += [
-					InsertFilesFromSubdir(fixup_repo,fixup_path+"/eclass", ".eclass", select="all", skip=None)
+					InsertFilesFromSubdir(fixup_repo,fixup_path+"/eclass", ".eclass", select="all", skip=None, restrict=restrict_eclasses)
 				]
 			steps += [
 				# add a new parameter called 'prefix'
-				InsertEbuilds(fixup_repo, ebuildloc=fixup_path, select="all", skip=None, replace=True )
+				InsertEbuilds(fixup_repo, ebuildloc=fixup_path, select="all", skip=None, replace=True, restrict=restrict_catpkgs )
 			]
 
 	# All fix-up steps have been generated. Now let's run them:
 
 	kit.run(steps)
 
+	if changes != None:
+		removeStaleFiles(kit, steps)
+
 	# Phase 4: finalize and commit
 	# TODO: create and dynamic-alize cache_dir below.
 	post_steps += [
-		CreateCategories(gentoo_staging),
+		CreateCategories(source),
 		Minify(),
 		GenUseLocalDesc(),
 		GenCache( cache_dir="/var/cache/edb/%s-%s" % ( kit_dict['name'], kit_dict['branch'] ) )
 	]
 	kit.run(post_steps)
 
-	kitted_catpkgs.update(kit.getAllCatPkgs())
+	kit_catpkgs = kit.getAllCatPkgs()
+	kitted_catpkgs.update(kit_catpkgs)
 	kit.gitCommit(message="updates",branch=kit_dict['branch'],push=False)
+	saveKitState(kit_dict, kit, fingerprint, src_sha, fixup_sha)
+	return set(kit_catpkgs.keys())
 
-if __name__ == "__main__":
+# PARALLEL GENERATION
 
-	funtoo_overlay = GitTree("funtoo-overlay", "master", "repos@git.funtoo.org:funtoo-overlay.git", pull=True)
-	gentoo_staging = GitTree("gentoo-staging", "master", "repos@git.funtoo.org:ports/gentoo-staging.git", pull=True)
-	fixup_repo = GitTree("kit-fixups", "master", "repos@git.funtoo.org:kits/kit-fixups.git", pull=True)
+# Each kit only needs to know which catpkgs were claimed by the kits before it, and that can be worked out up front from
+# the package sets (see generateAuditSet) and the kit-fixups repository, without generating anything. planKits() does
+# this for a list of kit groups, in kit_order precedence, and runKits() then generates the kits of the plan in worker
+# processes.
 
+def getFixupCatPkgs(kit_dict):
+	# catpkgs that kit-fixups inserts into the kit (regardless of what earlier kits claimed):
+	catpkgs = set()
+	for fixup_dir in [ "global", kit_dict["branch"] ]:
+		fixup_root = fixup_repo.root + "/" + kit_dict['name'] + "/" + fixup_dir
+		if not os.path.isdir(fixup_root):
+			continue
+		for cat in os.listdir(fixup_root):
+			if not ( "-" in cat or cat == "virtual" ) or not os.path.isdir(os.path.join(fixup_root, cat)):
+				continue
+			for pkg in os.listdir(os.path.join(fixup_root, cat)):
+				if os.path.isdir(os.path.join(fixup_root, cat, pkg)):
+					catpkgs.add(cat + "/" + pkg)
+	return catpkgs
+
+def planKits(groups, src_sha=None, pattern_hits=None, dry_run=False):
+
+	"""
+	Resolve the kits in groups (a list of kit group names, where None starts over with no kitted catpkgs, like
+	kit_order) into a list of (kit_dict, kitted_catpkgs, catpkgs, segment) tuples. kitted_catpkgs holds the catpkgs
+	claimed by the kits before this one, which is what updateKit() needs, catpkgs is the set of catpkgs this kit will
+	get, and segment numbers the runs of kits between None entries -- kits only claim catpkgs from later kits of
+	their own segment.
+
+	If src_sha is specified, it is used instead of each kit's src_branch. If pattern_hits is a dict, it is filled with
+	the package-set line hit counts of each kit (see generateAuditSet), keyed by (kit name, branch). With dry_run=True,
+	gentoo-staging is read as a TreeRevision rather than from snapshots, so nothing is checked out or indexed.
+	"""
+
+	plan = []
 	kitted_catpkgs = {}
-
-	#for kit_group in kit_order: 
-	# for testing, we're using this:
-	for kit_group in [ "prime" ]:
+	segment = 0
+	for kit_group in groups:
 		if kit_group == None:
 			kitted_catpkgs = {}
+			segment += 1
+			continue
+		for kit_dict in kit_groups[kit_group]:
+			rev = src_sha if src_sha else kit_dict['src_branch']
+			source = gentoo_staging.revision(rev) if dry_run else gentoo_staging.snapshot(rev)
+			if kit_dict['name'] == 'nokit':
+				# nokit gets everything that's left over, and doesn't claim anything:
+				catpkgs = set(source.getAllCatPkgs().keys()) - set(kitted_catpkgs.keys())
+				source.release()
+				plan.append((kit_dict, dict(kitted_catpkgs), catpkgs, segment))
+				continue
+			hits = {}
+			catpkgs = generateAuditSet(kit_dict['name'], source, pkgdir=funtoo_overlay.root+"/funtoo/scripts", branch=kit_dict['branch'], catpkg_dict=dict(kitted_catpkgs), pattern_hits=hits)
+			source.release()
+			if pattern_hits != None:
+				pattern_hits[(kit_dict['name'], kit_dict['branch'])] = hits
+			catpkgs |= getFixupCatPkgs(kit_dict)
+			plan.append((kit_dict, dict(kitted_catpkgs), catpkgs, segment))
+			for catpkg in catpkgs:
+				kitted_catpkgs[catpkg] = kit_dict['name']
+	return plan
+
+def reportPlan(groups, src_sha=None):
+
+	# Print which kit each catpkg lands in, what falls through to nokit, and package-set lines that match nothing, without
+	# generating anything. Each run of groups between None entries is planned and reported separately.
+
+	start = time.time()
+	segments = [ [] ]
+	for kit_group in groups:
+		if kit_group == None:
+			segments.append([])
 		else:
-			for kit_dict in kit_groups[kit_group]:
-				print("Regenerating kit ",kit_dict)
-				updateKit(kit_dict, kitted_catpkgs, create=True)
+			segments[-1].append(kit_group)
+	for segment in segments:
+		if not segment:
+			continue
+		pattern_hits = {}
+		plan = planKits(segment, src_sha=src_sha, pattern_hits=pattern_hits, dry_run=True)
+		print()
+		print("# Kit plan for group(s): %s" % ", ".join(segment))
+		print()
+		owners = {}
+		claimed = set()
+		for kit_dict, kitted_catpkgs, catpkgs, _seg in plan:
+			print("# %s %s (gentoo-staging %s): %s catpkgs" % ( kit_dict['name'], kit_dict['branch'], src_sha if src_sha else kit_dict['src_branch'], len(catpkgs) ))
+			for catpkg in catpkgs:
+				if catpkg not in owners:
+					owners[catpkg] = []
+				owners[catpkg].append("%s:%s" % ( kit_dict['name'], kit_dict['branch'] ))
+			if kit_dict['name'] != 'nokit':
+				claimed |= catpkgs
+		if 'nokit' not in [ item[0]['name'] for item in plan ]:
+			# no nokit in these groups -- show what would fall through to it (from the last kit's source):
+			source = gentoo_staging.revision(src_sha if src_sha else plan[-1][0]['src_branch'])
+			for catpkg in set(source.getAllCatPkgs().keys()) - claimed:
+				owners[catpkg] = [ "(nokit)" ]
+		print()
+		for catpkg in sorted(owners.keys()):
+			print("%s %s" % ( catpkg, " ".join(owners[catpkg]) ))
+		print()
+		print("# Package-set lines matching nothing:")
+		for kit_dict, kitted_catpkgs, catpkgs, _seg in plan:
+			hits = pattern_hits.get((kit_dict['name'], kit_dict['branch']), {})
+			for pattern in sorted(hits.keys()):
+				if hits[pattern] == 0:
+					print("%s:%s %s" % ( kit_dict['name'], kit_dict['branch'], pattern ))
+	print()
+	print("# Planned in %.1f seconds." % ( time.time() - start ))
+
+def kittedBefore(plan, results, pos):
+	# the catpkgs claimed by the kits before plan[pos] in its segment: what each of those kits actually got if it has
+	# been generated (results maps plan positions to the catpkgs updateKit() returned), and what the plan says otherwise.
+	kitted = {}
+	for i in range(pos):
+		kit_dict, kitted_catpkgs, catpkgs, segment = plan[i]
+		if segment != plan[pos][3] or kit_dict['name'] == 'nokit':
+			continue
+		for catpkg in results[i] if i in results else catpkgs:
+			kitted[catpkg] = kit_dict['name']
+	return kitted
+
+def runKitJob(args):
+	kit_dict, kitted_catpkgs, incremental = args
+	# each worker logs to a merge log of its own:
+	reopenCaches(log_path="%s.%s-%s" % ( merge_log_path, kit_dict['name'], kit_dict['branch'] ))
+	try:
+		return updateKit(kit_dict, kitted_catpkgs, create=True, incremental=incremental)
+	finally:
+		# worker processes don't run atexit handlers -- hand our spans to the parent now:
+		tracer.flush()
+
+def runKits(plan, jobs=1, incremental=False):
+
+	# Generate the kits of plan, using up to jobs worker processes. Kits running in parallel take the catpkgs claimed
+	# by the kits before them from the plan (or from the actual results, for kits that are already done). Afterwards,
+	# any kit whose predecessors turned out differently from what it was generated with is generated again, in plan
+	# order, so the result is always what a serial run would have produced.
+
+	results = {}
+	ran_with = {}
+
+	def generate(pos):
+		kit_dict = plan[pos][0]
+		kitted_catpkgs = kittedBefore(plan, results, pos)
+		print("Regenerating kit ",kit_dict)
+		ran_with[pos] = set(kitted_catpkgs)
+		results[pos] = updateKit(kit_dict, kitted_catpkgs, create=True, incremental=incremental)
+
+	if jobs > 1:
+		# Each kit reads from its own gentoo-staging snapshot, but the branches of a kit share the kit's tree, so they
+		# can't be generated at the same time:
+		batches = []
+		for pos in range(len(plan)):
+			for batch in batches:
+				if plan[pos][0]['name'] not in [ plan[b][0]['name'] for b in batch ]:
+					batch.append(pos)
+					break
+			else:
+				batches.append([ pos ])
+
+		with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork")) as executor:
+			for batch in batches:
+				futures = []
+				for pos in batch:
+					kitted_catpkgs = kittedBefore(plan, results, pos)
+					ran_with[pos] = set(kitted_catpkgs)
+					print("Regenerating kit ",plan[pos][0])
+					futures.append(executor.submit(runKitJob, (plan[pos][0], kitted_catpkgs, incremental)))
+				for pos, future in zip(batch, futures):
+					results[pos] = future.result()
+					# the kit's GitTree was created in the worker:
+					plan[pos][0]['kit'] = kitTree(plan[pos][0])
+
+	for pos in range(len(plan)):
+		kit_dict, kitted_catpkgs, catpkgs, segment = plan[pos]
+		if pos not in results:
+			generate(pos)
+		elif ran_with[pos] != set(kittedBefore(plan, results, pos)):
+			print("Kits before %s %s didn't get the catpkgs the plan said they would; generating it again." % ( kit_dict['name'], kit_dict['branch'] ))
+			generate(pos)
+		if results[pos] != None and results[pos] != catpkgs:
+			print("Warning: %s %s has %s catpkgs not in the plan, and is missing %s planned catpkgs." % ( kit_dict['name'], kit_dict['branch'],
+				len(results[pos] - catpkgs), len(catpkgs - results[pos]) ))
+
+if __name__ == "__main__":
+
+	# a dry run (--plan) works from what the source trees have locally, so it doesn't pull them:
+	plan_only = "--plan" in sys.argv[1:]
+	funtoo_overlay = GitTree("funtoo-overlay", "master", "repos@git.funtoo.org:funtoo-overlay.git", pull=True, defer=plan_only)
+	gentoo_staging = GitTree("gentoo-staging", "master", "repos@git.funtoo.org:ports/gentoo-staging.git", pull=True, defer=plan_only)
+	fixup_repo = GitTree("kit-fixups", "master", "repos@git.funtoo.org:kits/kit-fixups.git", pull=True, defer=plan_only)
+	if plan_only:
+		# ...unless they haven't been cloned yet:
+		initializeTrees([ tree for tree in [ funtoo_overlay, gentoo_staging, fixup_repo ] if not os.path.exists(tree.root) ])
+
+	incremental = "--incremental" in sys.argv[1:]
+
+	# --jobs N sets how many kits are generated at the same time:
+	jobs = 1
+	for pos, arg in enumerate(sys.argv[1:]):
+		if arg == "--jobs" and pos + 2 < len(sys.argv):
+			jobs = int(sys.argv[pos + 2])
+		elif arg.startswith("--jobs="):
+			jobs = int(arg[7:])
+
+	if plan_only:
+		# dry run: --plan [SHA1] reports the kit plan (optionally against a specific gentoo-staging SHA1) and exits:
+		pos = sys.argv.index("--plan")
+		src_sha = None
+		if pos + 1 < len(sys.argv) and not sys.argv[pos + 1].startswith("--"):
+			src_sha = sys.argv[pos + 1]
+		reportPlan(kit_order, src_sha=src_sha)
+		sys.exit(0)
+
+	#plan = planKits(kit_order)
+	# for testing, we're using this:
+	plan = planKits([ "prime" ])
+	runKits(plan, jobs=jobs, incremental=incremental)
 
 	print("Checking out prime versions of kits.")
 	for kit_dict in kit_groups['prime']:
 		kit_dict['kit'].run([GitCheckout(branch=kit_dict['branch'])])
 
+	# drop gentoo-staging snapshots and cached step outputs that are no longer needed:
+	worktree_pool.prune(gentoo_staging)
+	StepCache().prune()
+
 # vim: ts=4 sw=4 noet tw=140
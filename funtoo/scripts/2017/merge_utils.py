@@ -8,6 +8,20 @@ import subprocess
 import sys
 import datetime
 import re
+import sqlite3
+import json
+import hashlib
+import stat
+import errno
+import concurrent.futures
+import multiprocessing
+import fcntl
+import time
+import threading
+import atexit
+import contextlib
+import collections
+import types
 from lxml import etree
 import portage
 from portage.dbapi.porttree import portdbapi
@@ -18,7 +32,143 @@ from portage.exception import PortageKeyError
 
 debug = False
 
-mergeLog = open("/var/tmp/merge.log","w")
+# persistent caches (metadata indexes, etc.) are stored here:
+cache_dir = "/var/cache/merge-utils"
+
+# read-only snapshots of source trees (see WorktreePool) are checked out here:
+worktree_dir = "/var/git/worktrees"
+
+# source-only GitTrees are cloned here:
+source_tree_dir = "/var/git/source-trees"
+
+# number of threads used by initializeTrees() to fetch source trees, and the time limit for each fetch, in seconds:
+fetch_workers = 8
+fetch_timeout = 600
+
+# number of threads used to copy catpkgs into destination trees:
+copy_workers = os.cpu_count() or 4
+
+# number of processes used to parse metadata.xml files:
+metadata_workers = os.cpu_count() or 4
+
+# catpkgs inserted by InsertEbuilds are logged to this file. It is opened (and truncated) on first use, not on import,
+# and is line-buffered so that nothing is left in the buffer for forked children to write out a second time:
+merge_log_path = "/var/tmp/merge.log"
+mergeLog = None
+
+def logMerge(line):
+	global mergeLog
+	if mergeLog == None:
+		mergeLog = open(merge_log_path, "w", buffering=1)
+	mergeLog.write(line + "\n")
+
+class Tracer(object):
+
+	"""
+	Tracer records nested spans -- steps, kits, subprocesses, portage queries -- and writes them out at exit as a
+	Chrome trace-event file, which can be loaded into chrome://tracing or Perfetto. Each span carries its wall time,
+	the CPU time used by this process and by finished child processes while it was open, and the number of
+	subprocesses its thread started. Tracing is off unless MERGE_TRACE names the trace file, or setTraceFile() is
+	called. Forked children write their spans to <trace file>.<pid> when flush() is called, and the parent merges
+	these files into the trace.
+	"""
+
+	def __init__(self):
+		self.path = None
+		self.events = []
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.child = False
+		os.register_at_fork(after_in_child=self.forked)
+
+	def enable(self, path):
+		if self.path == None:
+			atexit.register(self.write)
+		self.path = os.path.abspath(path)
+
+	def forked(self):
+		# the parent's spans are the parent's to write:
+		self.events = []
+		self.lock = threading.Lock()
+		self.child = True
+
+	def countSubprocess(self):
+		self.local.subprocesses = getattr(self.local, "subprocesses", 0) + 1
+
+	@contextlib.contextmanager
+	def span(self, name, cat, **args):
+		if self.path == None:
+			yield
+			return
+		start = time.time()
+		cpu = time.process_time()
+		times = os.times()
+		subprocesses = getattr(self.local, "subprocesses", 0)
+		try:
+			yield
+		finally:
+			end = time.time()
+			end_times = os.times()
+			args["cpu_ms"] = round((time.process_time() - cpu) * 1000, 3)
+			args["children_cpu_ms"] = round((end_times.children_user + end_times.children_system - times.children_user - times.children_system) * 1000, 3)
+			args["subprocesses"] = getattr(self.local, "subprocesses", 0) - subprocesses
+			event = { "name" : name, "cat" : cat, "ph" : "X", "ts" : int(start * 1000000), "dur" : int((end - start) * 1000000),
+				"pid" : os.getpid(), "tid" : threading.get_native_id(), "args" : args }
+			with self.lock:
+				self.events.append(event)
+
+	def flush(self):
+		# in a forked child, write out the spans recorded so far for the parent to pick up.
+		if self.path == None or not self.child:
+			return
+		fn = "%s.%s" % ( self.path, os.getpid() )
+		with self.lock:
+			with open(fn + ".tmp", "w") as f:
+				json.dump(self.events, f)
+			os.replace(fn + ".tmp", fn)
+
+	def write(self):
+		if self.path == None:
+			return
+		if self.child:
+			self.flush()
+			return
+		events = list(self.events)
+		for fn in glob.glob(glob.escape(self.path) + ".*"):
+			if not fn[len(self.path) + 1:].isdigit():
+				continue
+			try:
+				with open(fn, "r") as f:
+					events += json.load(f)
+			except (IOError, ValueError):
+				pass
+			os.unlink(fn)
+		events.sort(key=lambda e: e["ts"])
+		events.insert(0, { "name" : "process_name", "ph" : "M", "pid" : os.getpid(), "args" : { "name" : os.path.basename(sys.argv[0]) } })
+		with open(self.path, "w") as f:
+			json.dump({ "traceEvents" : events, "displayTimeUnit" : "ms" }, f)
+		print("Wrote trace to %s" % self.path)
+
+tracer = Tracer()
+
+def setTraceFile(path):
+	# record a trace of this run to path (see Tracer).
+	tracer.enable(path)
+
+if os.environ.get("MERGE_TRACE"):
+	setTraceFile(os.environ["MERGE_TRACE"])
+
+@contextlib.contextmanager
+def traceSubprocess(cmd):
+	# span for a subprocess; cmd is a command line string or argument list.
+	tracer.countSubprocess()
+	if tracer.path == None:
+		yield
+		return
+	if not isinstance(cmd, str):
+		cmd = " ".join(cmd)
+	with tracer.span(cmd if len(cmd) <= 80 else cmd[:77] + "...", "subprocess", cmd=cmd):
+		yield
 
 def get_pkglist(fname):
 	if fname[0] == "/":
@@ -59,78 +209,468 @@ def filterInCategory(pkgset, fil):
 			nomatch.add(pkg)
 	return match, nomatch
 
-def getDependencies(cur_overlay, catpkgs, levels=0, cur_level=0):
-	cur_tree = cur_overlay.root
+def gitRevParse(root, rev="HEAD"):
+	# return the full SHA1 of the commit that rev resolves to in the git repo at root, or None if it can't be resolved.
+	if not os.path.exists(os.path.join(root, ".git")):
+		return None
+	with traceSubprocess("git rev-parse " + rev):
+		out = subprocess.run(["git", "rev-parse", "--verify", "-q", rev + "^{commit}"], cwd=root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+	if out.returncode != 0:
+		return None
+	return out.stdout.decode().strip()
+
+def gitChangedPaths(root, old, new=None):
+
+	"""
+	Return a set of paths (relative to root) that differ between commit old and commit new. If new is None,
+	old is compared against the working tree, including untracked files. None is returned if git can't tell
+	us (for example, because old no longer exists in the repository.)
+	"""
+
+	cmd = ["git", "diff", "--name-only", "--no-renames", old]
+	if new is not None:
+		cmd.append(new)
+	with traceSubprocess(cmd):
+		out = subprocess.run(cmd, cwd=root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+	if out.returncode != 0:
+		return None
+	paths = set(out.stdout.decode().splitlines())
+	if new is None:
+		with traceSubprocess("git ls-files --others"):
+			out = subprocess.run(["git", "ls-files", "--others", "--exclude-standard"], cwd=root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+		if out.returncode != 0:
+			return None
+		paths.update(out.stdout.decode().splitlines())
+	return paths
+
+def gitIsClean(root):
+	# return True if the working tree at root matches its HEAD commit, with no untracked files. Both checks stop at the
+	# first difference, rather than listing everything that changed like gitChangedPaths does.
+	with traceSubprocess("git diff-index --quiet HEAD"):
+		out = subprocess.run(["git", "diff-index", "--quiet", "HEAD", "--"], cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	if out.returncode != 0:
+		return False
+	# --directory lists an untracked directory as one entry instead of walking it:
+	with traceSubprocess("git ls-files --others --directory"):
+		out = subprocess.run(["git", "ls-files", "--others", "--exclude-standard", "--directory", "--no-empty-directory"], cwd=root,
+			stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+	return out.returncode == 0 and out.stdout == b""
+
+def gitIsCheckedOut(root, rev):
+	# return True if rev is what the working tree at root has checked out -- for a local branch, HEAD must be on it.
+	head = gitRevParse(root)
+	if head == None or head != gitRevParse(root, rev):
+		return False
+	with traceSubprocess("git show-ref " + rev):
+		is_branch = subprocess.run(["git", "show-ref", "--verify", "-q", "refs/heads/" + rev], cwd=root).returncode == 0
+	if is_branch:
+		with traceSubprocess("git symbolic-ref HEAD"):
+			out = subprocess.run(["git", "symbolic-ref", "-q", "--short", "HEAD"], cwd=root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+		return out.stdout.decode().strip() == rev
+	return True
+
+def gitOutput(root, args, input=None, env=None):
+	# run a git plumbing command in root, feeding it input (a str), and return its output. Exits on failure.
+	with traceSubprocess(["git"] + args):
+		out = subprocess.run(["git"] + args, cwd=root, input=input.encode("utf-8", "surrogateescape") if input != None else None,
+			env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	if out.returncode != 0:
+		print("Error executing %r in %s" % (["git"] + args, root))
+		print("stderr: %s" % out.stderr.decode())
+		sys.exit(1)
+	return out.stdout.decode("utf-8", "surrogateescape")
+
+def gitTreeBlobs(root, sha, paths):
+	# return {path: (mode, blob SHA1)} for the files under paths in commit sha of the git repo at root.
+	blobs = {}
+	paths = sorted(paths)
+	for pos in range(0, len(paths), 1000):
+		for line in gitOutput(root, ["ls-tree", "-r", "-z", "--full-tree", sha, "--"] + paths[pos:pos+1000]).split("\0"):
+			if not line:
+				continue
+			info, path = line.split("\t", 1)
+			mode, objtype, blob = info.split()
+			if objtype == "blob":
+				blobs[path] = (mode, blob)
+	return blobs
+
+def hashFiles(h, paths):
+	# feed the names and contents of paths (files, or directories of files) to hashlib object h. Missing files count too.
+	for path in paths:
+		if os.path.isdir(path):
+			files = [ os.path.join(path, fn) for fn in sorted(os.listdir(path)) ]
+		else:
+			files = [ path ]
+		for fn in files:
+			h.update(fn.encode("utf-8") + b"\0")
+			if os.path.exists(fn):
+				with open(fn, "rb") as f:
+					h.update(f.read())
+
+def runFingerprint(trees, paths):
+
+	"""
+	Return a fingerprint of everything a run depends on: the HEAD SHA1 of each tree, the contents of paths (see
+	hashFiles()) and merge_utils.py itself. None is returned if a tree has uncommitted changes, as its SHA1 doesn't
+	describe its contents then.
+	"""
+
+	h = hashlib.sha1()
+	for tree in trees:
+		sha = gitRevParse(tree.root)
+		if sha == None or gitChangedPaths(tree.root, sha) != set():
+			return None
+		h.update(("%s %s\n" % ( tree.name, sha )).encode("utf-8"))
+	hashFiles(h, list(paths) + [ os.path.realpath(__file__) ])
+	return h.hexdigest()
+
+def fingerprintFile(name):
+	return os.path.join(cache_dir, "fingerprints", name)
+
+def checkFingerprint(name, fingerprint):
+	# return True if fingerprint matches the one saved by the last successful run called name.
+	if fingerprint == None:
+		return False
 	try:
-		with open(os.path.join(cur_tree, 'profiles/repo_name')) as f:
-			cur_name = f.readline().strip()
-	except FileNotFoundError:
-			cur_name = cur_overlay.name
-	env = os.environ.copy()
-	env['PORTAGE_REPOSITORIES'] = '''
+		with open(fingerprintFile(name), "r") as f:
+			return f.read().strip() == fingerprint
+	except IOError:
+		return False
+
+def saveFingerprint(name, fingerprint):
+	if fingerprint == None:
+		return
+	fn = fingerprintFile(name)
+	os.makedirs(os.path.dirname(fn), exist_ok=True)
+	with open(fn + ".tmp", "w") as f:
+		f.write(fingerprint + "\n")
+	os.replace(fn + ".tmp", fn)
+
+def exitIfUnchanged(name, trees, paths):
+	# exit with code 2 -- "no new updates" to merge-funtoo.sh -- if runFingerprint(trees, paths) matches the one saved
+	# by the last successful run called name.
+	if checkFingerprint(name, runFingerprint(trees, paths)):
+		print("No changes since the last run of %s, exiting." % name)
+		sys.exit(2)
+
+def pathToCatPkg(path):
+	# map a path inside a portage tree to the catpkg it belongs to, or None if it isn't part of a catpkg.
+	parts = path.split("/")
+	if len(parts) == 4 and parts[0] == "metadata" and parts[1] == "md5-cache":
+		cps = catpkgsplit(parts[2] + "/" + parts[3])
+		if cps:
+			return cps[0] + "/" + cps[1]
+		return None
+	if len(parts) < 3:
+		return None
+	# All categories have a "-" in them, except for "virtual":
+	if "-" in parts[0] or parts[0] == "virtual":
+		return parts[0] + "/" + parts[1]
+	return None
+
+def repositoriesConfig(ebuild_repo, super_repo=None):
+	# generate a PORTAGE_REPOSITORIES setting for ebuild_repo, optionally using super_repo as its master for eclasses.
+	eb_name = ebuild_repo.reponame if getattr(ebuild_repo, "reponame", None) else repoName(ebuild_repo)
+	if super_repo:
+		return '''
 [DEFAULT]
-main-repo = %s 
+main-repo = gentoo
 
-[%s]
+[gentoo]
 location = %s
-''' % (cur_name, cur_name, cur_tree)
-	p = portage.portdbapi(mysettings=portage.config(env=env,config_profile_path=''))
-	p.frozen = False
-	mypkgs = set()
-	for catpkg in list(catpkgs):
-		for pkg in p.cp_list(catpkg):
-			if pkg == '':
-				print("No match for %s" % catpkg)
-				continue
-			try:
-				aux = p.aux_get(pkg, ["DEPEND", "RDEPEND"])
-			except PortageKeyError:
-				print("Portage key error for %s" % repr(pkg))
-				return mypkgs
-			for dep in flatten(use_reduce(aux[0]+" "+aux[1], matchall=True)):
-				if len(dep) and dep[0] == "!":
-					continue
-				try:
-					mypkg = dep_getkey(dep)
-				except portage.exception.InvalidAtom:
-					continue
-				if mypkg not in mypkgs:
-					mypkgs.add(mypkg)
-				if levels != cur_level:
-					mypkgs = mypkgs.union(getDependencies(cur_overlay, mypkg, levels=levels, cur_level=cur_level+1))
-	return mypkgs
 
-def getPackagesInCatWithEclass(cur_overlay, cat, eclass):
-	cur_tree = cur_overlay.root
-	try:
-		with open(os.path.join(cur_tree, 'profiles/repo_name')) as f:
-			cur_name = f.readline().strip()
-	except FileNotFoundError:
-			cur_name = cur_overlay.name
-	env = os.environ.copy()
-	env['PORTAGE_REPOSITORIES'] = '''
+[%s]
+location = %s
+eclass-overrides = gentoo 
+aliases = -gentoo
+masters = gentoo 
+	''' % ( super_repo.root, eb_name, ebuild_repo.root)
+	else:
+		return '''
 [DEFAULT]
 main-repo = %s
 
 [%s]
 location = %s
-''' % (cur_name, cur_name, cur_tree)
-	p = portage.portdbapi(mysettings=portage.config(env=env, config_profile_path=''))
-	p.frozen = False
+	''' % ( eb_name, eb_name, ebuild_repo.root )
+
+class PortdbPool(object):
+
+	"""
+	PortdbPool hands out shared portdbapi instances, so that we don't parse profiles and build a new
+	portage.config for every query. Instances are keyed by the repository roots, masters and eclass-overrides
+	of the configuration, and are rebuilt when the HEAD of any of the trees involved moves (eclass caches and
+	friends would otherwise be stale.)
+	"""
+
+	def __init__(self):
+		self.pool = {}
+
+	def get(self, ebuild_repo, super_repo=None):
+		if super_repo:
+			key = ((super_repo.root, ebuild_repo.root), ("gentoo",), ("gentoo",))
+		else:
+			key = ((ebuild_repo.root,), (), ())
+		heads = tuple(gitRevParse(root) for root in key[0])
+		if key in self.pool and self.pool[key][0] == heads:
+			return self.pool[key][1]
+		env = os.environ.copy()
+		env['PORTAGE_REPOSITORIES'] = repositoriesConfig(ebuild_repo, super_repo)
+		p = portdbapi(mysettings=portage.config(env=env,config_profile_path=''))
+		p.frozen = False
+		self.pool[key] = (heads, p)
+		return p
+
+portdb_pool = PortdbPool()
+
+def getPortdb(ebuild_repo, super_repo=None):
+	return portdb_pool.get(ebuild_repo, super_repo)
+
+metadata_keys = [ "DEPEND", "RDEPEND", "INHERITED", "LICENSE", "KEYWORDS", "EAPI" ]
+
+class MetadataIndex(object):
+
+	"""
+	MetadataIndex is a persistent (SQLite) index of the metadata of every ebuild in ebuild_repo, so that
+	dependency, eclass and license queries don't need to call aux_get for every cpv in the tree on every run.
+
+	The index records the SHA1 of the ebuild_repo commit (and of the super_repo commit, which provides the
+	eclasses) that it was generated from. When sync() is called, git is asked which paths changed since the
+	recorded commits, and only the affected catpkgs (and the catpkgs inheriting a modified eclass) are
+	re-read from portage. Uncommitted changes in the working tree are picked up as well, and re-checked on
+	the next sync, so the index can be used on destination trees that are in the middle of being assembled.
+	"""
+
+	version = "1"
+
+	def __init__(self, ebuild_repo, super_repo=None):
+		self.ebuild_repo = ebuild_repo
+		self.super_repo = super_repo
+		# snapshots (see TreeSnapshot) get an index of their own, named "<tree>@<sha1>":
+		name = getattr(ebuild_repo, "index_name", ebuild_repo.name)
+		if super_repo:
+			name += "+" + getattr(super_repo, "index_name", super_repo.name)
+		self.path = os.path.join(cache_dir, "metadata", name.replace("/", "_") + ".db")
+		if not os.path.exists(os.path.dirname(self.path)):
+			os.makedirs(os.path.dirname(self.path))
+		if "@" in name and not os.path.exists(self.path):
+			self.seed(name.split("@")[0])
+		self.db = sqlite3.connect(self.path, timeout=300)
+		self.db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+		self.db.execute("CREATE TABLE IF NOT EXISTS metadata (cpv TEXT PRIMARY KEY, cp TEXT, cat TEXT, %s)" % ", ".join("%s TEXT" % k for k in metadata_keys))
+		self.db.execute("CREATE INDEX IF NOT EXISTS metadata_cp ON metadata (cp)")
+		self.db.execute("CREATE INDEX IF NOT EXISTS metadata_cat ON metadata (cat)")
+		self.db.commit()
+		self.sha = None
+
+	def seed(self, prefix):
+		# start a new snapshot index off the most recently updated index of the same tree, so sync() only has to
+		# catch up with the differences between the two commits:
+		prefix = prefix.replace("/", "_")
+		candidates = []
+		for fn in glob.glob(os.path.join(cache_dir, "metadata", glob.escape(prefix) + "*.db")):
+			rest = os.path.basename(fn)[len(prefix):-3]
+			if rest == "" or ( rest.startswith("@") and "+" not in rest ):
+				candidates.append(fn)
+		if not candidates:
+			return
+		src = sqlite3.connect(max(candidates, key=os.path.getmtime), timeout=300)
+		dst = sqlite3.connect(self.path + ".tmp")
+		src.backup(dst)
+		src.close()
+		dst.close()
+		os.rename(self.path + ".tmp", self.path)
+
+	def getState(self):
+		return dict(self.db.execute("SELECT key, value FROM state"))
+
+	def updateCatPkgs(self, cps):
+		# re-read metadata from portage for all cpvs in the catpkgs specified:
+		with tracer.span("aux_get", "portage", repo=self.ebuild_repo.name, catpkgs=len(cps)):
+			self.auxGetCatPkgs(cps)
+
+	def auxGetCatPkgs(self, cps):
+		root = self.ebuild_repo.root
+		p = getPortdb(self.ebuild_repo, self.super_repo)
+		for cp in cps:
+			self.db.execute("DELETE FROM metadata WHERE cp = ?", (cp,))
+			for cpv in p.cp_list(cp, mytree=root):
+				try:
+					aux = p.aux_get(cpv, metadata_keys, mytree=root)
+				except PortageKeyError:
+					print("Portage key error for %s" % repr(cpv))
+					continue
+				self.db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, %s)" % ", ".join("?" * len(metadata_keys)), [cpv, cp, cp.split("/")[0]] + list(aux))
+
+	def sync(self):
+		if getattr(self.ebuild_repo, "frozen", False):
+			# use the index as it is (see TreeRevision):
+			self.sha = self.getState().get("sha") or None
+			return
+		root = self.ebuild_repo.root
+		state = self.getState()
+		sha = gitRevParse(root)
+		eclass_sha = gitRevParse(self.super_repo.root) if self.super_repo else None
+		dirty = set()
+		if sha != None:
+			dirty_paths = gitChangedPaths(root, sha)
+			if dirty_paths == None:
+				sha = None
+			else:
+				dirty = set(filter(None, map(pathToCatPkg, dirty_paths)))
+		# memoized results derived from the index are only valid for a clean tree at a known commit:
+		self.sha = sha if not dirty else None
+		cps = None
+		if sha != None and state.get("version") == self.version and state.get("sha"):
+			# find out what changed since the last sync:
+			paths = gitChangedPaths(root, state["sha"])
+			if state["eclass_sha"] == (eclass_sha or ""):
+				eclass_paths = set()
+			elif state["eclass_sha"] and eclass_sha:
+				eclass_paths = gitChangedPaths(self.super_repo.root, state["eclass_sha"], eclass_sha)
+			else:
+				eclass_paths = None
+			if paths != None and eclass_paths != None:
+				pending = set(json.loads(state["pending"]))
+				if state["sha"] == sha and not paths and not eclass_paths and not pending:
+					# index is current
+					return
+				cps = set(filter(None, map(pathToCatPkg, paths))) | pending
+				eclasses = set(p[7:-7] for p in paths | eclass_paths if p.startswith("eclass/") and p.endswith(".eclass"))
+				if eclasses:
+					for cp, inherited in self.db.execute("SELECT cp, INHERITED FROM metadata").fetchall():
+						if eclasses & set(inherited.split()):
+							cps.add(cp)
+		if cps == None:
+			print("Generating metadata index for %s..." % root)
+			self.db.execute("DELETE FROM metadata")
+			self.updateCatPkgs(getPortdb(self.ebuild_repo, self.super_repo).cp_all(trees=[root]))
+		else:
+			print("Updating metadata index for %s (%s catpkgs)..." % (root, len(cps)))
+			self.updateCatPkgs(sorted(cps))
+		# an empty sha (not a git tree) will force a full update next time:
+		new_state = {
+			"version" : self.version,
+			"sha" : sha or "",
+			"eclass_sha" : eclass_sha or "",
+			"pending" : json.dumps(sorted(dirty))
+		}
+		self.db.execute("DELETE FROM state")
+		self.db.executemany("INSERT INTO state VALUES (?, ?)", new_state.items())
+		self.db.commit()
+
+	def query(self, keys, cps=None, cat=None):
+		# return a list of (cp, cpv, key1, key2, ...) tuples for the specified catpkgs, category, or entire tree.
+		sql = "SELECT cp, cpv, %s FROM metadata" % ", ".join(keys)
+		if cps != None:
+			out = []
+			for cp in cps:
+				out += self.db.execute(sql + " WHERE cp = ? ORDER BY cpv", (cp,)).fetchall()
+			return out
+		elif cat != None:
+			return self.db.execute(sql + " WHERE cat = ? ORDER BY cpv", (cat,)).fetchall()
+		else:
+			return self.db.execute(sql + " ORDER BY cpv").fetchall()
+
+metadata_indexes = {}
+
+def getMetadataIndex(ebuild_repo, super_repo=None):
+	# return a MetadataIndex for ebuild_repo (with eclasses from super_repo), brought up-to-date with the tree.
+	key = (ebuild_repo.root, getattr(ebuild_repo, "index_name", None), super_repo.root if super_repo else None)
+	if key not in metadata_indexes:
+		metadata_indexes[key] = MetadataIndex(ebuild_repo, super_repo)
+	with tracer.span("MetadataIndex.sync", "portage", repo=ebuild_repo.name):
+		metadata_indexes[key].sync()
+	return metadata_indexes[key]
+
+class DependencyGraph(object):
+
+	"""
+	DependencyGraph computes dependency closures (used by @depsincat@) over a catpkg -> dependency catpkgs
+	adjacency map that is derived from the DEPEND and RDEPEND of all ebuilds of a catpkg in the metadata
+	index. Adjacency entries are generated on demand and shared by all queries, and the closure of each root
+	catpkg is memoized per tree SHA1, so multiple @depsincat@ lines for the same root cost one traversal.
+	"""
+
+	def __init__(self, tree):
+		self.tree = tree
+		self.sha = None
+		self.adjacency = {}
+		self.closures = {}
+
+	def sync(self):
+		self.index = getMetadataIndex(self.tree)
+		if self.sha == None or self.sha != self.index.sha:
+			# tree changed (or has uncommitted changes) -- cached data is no longer valid:
+			self.adjacency = {}
+			self.closures = {}
+		self.sha = self.index.sha
+
+	def deps(self, catpkg):
+		if catpkg not in self.adjacency:
+			mypkgs = set()
+			for cp, cpv, depend, rdepend in self.index.query(["DEPEND", "RDEPEND"], cps=[catpkg]):
+				for dep in flatten(use_reduce(depend+" "+rdepend, matchall=True)):
+					if len(dep) and dep[0] == "!":
+						continue
+					try:
+						mypkgs.add(dep_getkey(dep))
+					except portage.exception.InvalidAtom:
+						continue
+			self.adjacency[catpkg] = frozenset(mypkgs)
+		return self.adjacency[catpkg]
+
+	def closure(self, catpkg, levels=0):
+
+		"""
+		Return the set of catpkgs that catpkg depends on. levels specifies how many additional levels of
+		dependencies to follow beyond the direct dependencies (0 = direct dependencies only, None = follow
+		until the full closure has been found.) Each catpkg is expanded at most once, so dependency cycles
+		terminate the traversal rather than looping.
+		"""
+
+		key = (catpkg, levels)
+		if key in self.closures:
+			return self.closures[key]
+		found = set()
+		visited = set([catpkg])
+		frontier = [catpkg]
+		level = 0
+		while frontier:
+			next_frontier = []
+			for cp in frontier:
+				for dep in self.deps(cp):
+					found.add(dep)
+					if dep not in visited:
+						visited.add(dep)
+						next_frontier.append(dep)
+			if levels != None and level >= levels:
+				break
+			level += 1
+			frontier = next_frontier
+		self.closures[key] = frozenset(found)
+		return self.closures[key]
+
+dependency_graphs = {}
+
+def getDependencies(cur_overlay, catpkgs, levels=0):
+	key = (cur_overlay.root, getattr(cur_overlay, "index_name", None))
+	if key not in dependency_graphs:
+		dependency_graphs[key] = DependencyGraph(cur_overlay)
+	graph = dependency_graphs[key]
+	with tracer.span("getDependencies", "portage", repo=cur_overlay.name, catpkgs=len(catpkgs)):
+		graph.sync()
+		mypkgs = set()
+		for catpkg in catpkgs:
+			mypkgs |= graph.closure(catpkg, levels=levels)
+	return mypkgs
+
+def getPackagesInCatWithEclass(cur_overlay, cat, eclass):
+	index = getMetadataIndex(cur_overlay)
 	mypkgs = set()
-	for catpkg in p.cp_all(categories=[cat]):
-		for pkg in p.cp_list(catpkg):
-			if pkg == '':
-				print("No match for %s" % catpkg)
-				continue
-			try:
-				aux = p.aux_get(pkg, ["INHERITED"])
-			except PortageKeyError:
-				print("Portage key error for %s" % repr(pkg))
-				continue
-			if eclass in aux[0].split():
-				if eclass not in mypkgs:
-					mypkgs.add(catpkg)
+	for catpkg, pkg, inherited in index.query(["INHERITED"], cat=cat):
+		if eclass in inherited.split():
+			mypkgs.add(catpkg)
 	return mypkgs
 
 def repoName(cur_overlay):
@@ -150,117 +690,82 @@ def getAllLicenses(ebuild_repo, super_repo=None):
 
 
 def getAllMeta(metadata, ebuild_repo, super_repo=None):
-	print("EBUILD REPO", ebuild_repo.root, "SUPER_REPO", super_repo.root)
-	metadict = { "LICENSE" : 0, "INHERITED" : 1 }
-	metapos = metadict[metadata]
-
-	# ebuild_repo is where we get the set of all packages for our loop:
-	eb_name = ebuild_repo.reponame if ebuild_repo.reponame else repoName(ebuild_repo)
-	env = os.environ.copy()
-	# super_repo contains all ebuilds in ebuild_repo AND eclasses
-	if super_repo:
-		super_name = super_repo.reponame if super_repo.reponame else repoName(super_repo)
-		env['PORTAGE_REPOSITORIES'] = '''
-[DEFAULT]
-main-repo = gentoo
-
-[gentoo]
-location = %s
-
-[%s]
-location = %s
-eclass-overrides = gentoo 
-aliases = -gentoo
-masters = gentoo 
-	''' % ( super_repo.root, eb_name, ebuild_repo.root)
-	else:
-		env['PORTAGE_REPOSITORIES'] = '''
-[DEFAULT]
-main-repo = %s
-
-[%s]
-location = %s
-	''' % ( eb_name, eb_name, eb_name, ebuild_repo.root )
-	print(env['PORTAGE_REPOSITORIES'])
-	p = portdbapi(mysettings=portage.config(env=env,config_profile_path=''))
-	p.frozen = False
-	myeclasses = set()
-	for cp in p.cp_all(trees=[ebuild_repo.root]):
-		for cpv in p.cp_list(cp, mytree=ebuild_repo.root):
-			try:
-				aux = p.aux_get(cpv, ["LICENSE","INHERITED"], mytree=ebuild_repo.root)
-			except PortageKeyError:
-				print("Portage key error for %s" % repr(cpv))
-				raise
+	print("EBUILD REPO", ebuild_repo.root, "SUPER_REPO", super_repo.root if super_repo else None)
+	with tracer.span("getAllMeta " + metadata, "portage", repo=ebuild_repo.name):
+		index = getMetadataIndex(ebuild_repo, super_repo)
+		myeclasses = set()
+		for cp, cpv, value in index.query([metadata]):
 			if metadata == "INHERITED":
-				for eclass in aux[metapos].split():
-					key = eclass + ".eclass"
-					if key not in myeclasses:
-						myeclasses.add(key)
+				for eclass in value.split():
+					myeclasses.add(eclass + ".eclass")
 			elif metadata == "LICENSE":
-				for lic in aux[metapos].split():
-					if lic not in myeclasses:
-						myeclasses.add(lic)
+				for lic in value.split():
+					myeclasses.add(lic)
 	return myeclasses
 
-def generateAuditSet(name, from_tree, pkgdir=None, branch="master", catpkg_dict=None):
+def generateAuditSet(name, from_tree, pkgdir=None, branch="master", catpkg_dict=None, pattern_hits=None):
 
 	# This function is similar to generateShardSteps, but it doesn't actually generate steps. Instead
 	# it runs through the same package list, and generates a set of catpkgs (ignoring eclass commands)
 	# that would be copied. Then we can compare against the catpkgs that actually exist in a repository
-	# and see if any are missing. 
+	# and see if any are missing. from_tree is used as currently checked out. If pattern_hits is a dict,
+	# it is filled with the number of catpkgs in from_tree matched by each package-set line (whether or
+	# not they were already claimed or skipped.)
 
 	all_pats = []
 	pkgf = "package-sets/%s-packages" % name
+	pkgf_skip = "package-sets/%s-skip" % name
 	if pkgdir != None:
 		pkgf = pkgdir + "/" + pkgf
+		pkgf_skip = pkgdir + "/" + pkgf_skip
+	skip = []
+	if os.path.exists(pkgf_skip):
+		skip = get_pkglist(pkgf_skip)
 	for pattern in get_pkglist(pkgf):
 		if pattern.startswith("@regex@:"):
-			all_pats.append(re.compile(pattern[8:]))
+			all_pats.append((pattern, re.compile(pattern[8:])))
 		elif pattern.startswith("@depsincat@:"):
 			patsplit = pattern.split(":")
 			catpkg = patsplit[1]
 			dep_pkglist = getDependencies(from_tree, [ catpkg ] )
 			if len(patsplit) == 3:
 				dep_pkglist, dep_pkglist_nomatch = filterInCategory(dep_pkglist, patsplit[2])
-			all_pats += list(dep_pkglist)
+			all_pats += [ (pattern, pat) for pat in dep_pkglist ]
 		elif pattern.startswith("@cat_has_eclass@:"):
 			patsplit = pattern.split(":")
 			cat, eclass = patsplit[1:]
 			cat_pkglist = getPackagesInCatWithEclass(from_tree, cat, eclass )
-			all_pats += list(cat_pkglist)
+			all_pats += [ (pattern, pat) for pat in cat_pkglist ]
 		elif pattern == "@all_eclasses@":
-			pass
+			continue
 		elif pattern.startswith("@eclass@:"):
-			pass
+			continue
 		else:
-			all_pats.append(pattern)
+			all_pats.append((pattern, pattern))
+		if pattern_hits != None:
+			pattern_hits[pattern] = 0
+	all_catpkgs = getCatPkgs(from_tree.root, listing=getattr(from_tree, "listing", None))
+	matcher = PackageMatcher([ pat for pattern, pat in all_pats ])
+	skip_matcher = PackageMatcher(skip)
 	catpkgs = set()
-	all_catpkgs = from_tree.getAllCatPkgs()
-	all_catpkgs_set = set(all_catpkgs)
-	prev_catpkgs = set(catpkg_dict.keys())
-	for pat in all_pats:
-		if isinstance(pat, regextype):
-			for cp in all_catpkgs:
-				m = pat.match(cp)
-				if m and cp not in prev_catpkgs:
-					catpkgs.add(cp)
-		elif pat.endswith("/*"):
-			ps = pat.split("/")
-			cat = ps[0]
-			for cp in all_catpkgs:
-				cps = cp.split("/")
-				if len(cps) and cps[0] == cat and cp not in prev_catpkgs:
-					catpkgs.add(cp)
-		else:
-			if pat in all_catpkgs_set and pat not in prev_catpkgs:
-				catpkgs.add(pat)
+	for cp in all_catpkgs:
+		# skip the same catpkgs InsertEbuilds would:
+		if matcher.match(cp) and cp not in catpkg_dict and not skip_matcher.match(cp):
+			catpkgs.add(cp)
+	if pattern_hits != None:
+		hits = matcher.hits(all_catpkgs)
+		for pattern, pat in all_pats:
+			pattern_hits[pattern] += hits.get(pat, 0)
 	for cp in list(catpkgs):
 		catpkg_dict[cp] = name
 	return catpkgs
 
-def generateShardSteps(name, from_tree, to_tree, pkgdir=None, branch="master", catpkg_dict=None):
+def generateShardSteps(name, from_tree, to_tree, pkgdir=None, branch="master", catpkg_dict=None, restrict=None):
+	# restrict, if specified, is a dict with "catpkgs" and "eclasses" sets that is used to limit the generated steps to
+	# updating those catpkgs and eclasses (see InsertEbuilds and InsertFilesFromSubdir.)
 	steps = []
+	restrict_catpkgs = restrict["catpkgs"] if restrict != None else None
+	restrict_eclasses = restrict["eclasses"] if restrict != None else None
 	if branch:
 		steps += [ GitCheckout(branch) ]
 	pkglist = []
@@ -274,7 +779,8 @@ def generateShardSteps(name, from_tree, to_tree, pkgdir=None, branch="master", c
 		skip = get_pkglist(pkgf_skip)
 	for pattern in get_pkglist(pkgf):
 		if pattern.startswith("@regex@:"):
-			steps += [ InsertEbuilds(from_tree, select=re.compile(pattern[8:]), skip=skip, replace=True, catpkg_dict=catpkg_dict) ]
+			# regexes go into the same select list, and are matched by InsertEbuilds' PackageMatcher:
+			pkglist.append(re.compile(pattern[8:]))
 		elif pattern.startswith("@depsincat@:"):
 			patsplit = pattern.split(":")
 			catpkg = patsplit[1]
@@ -291,15 +797,110 @@ def generateShardSteps(name, from_tree, to_tree, pkgdir=None, branch="master", c
 			# copy over all eclasses used by all ebuilds
 			# get all eclasses used in ebuilds in to_tree, and copy them from from_tree to to_tree
 			a = getAllEclasses(ebuild_repo=to_tree, super_repo=from_tree)
-			steps += [ InsertEclasses(from_tree, select=list(a)) ]
+			steps += [ InsertEclasses(from_tree, select=list(a), restrict=restrict_eclasses) ]
 		elif pattern.startswith("@eclass@:"):
-			steps += [ InsertEclasses(from_tree, select=re.compile(pattern[9:])) ]
+			steps += [ InsertEclasses(from_tree, select=re.compile(pattern[9:]), restrict=restrict_eclasses) ]
 		else:
 			pkglist.append(pattern)
 	if pkglist:
-		steps += [ InsertEbuilds(from_tree, select=pkglist, skip=skip, replace=True, catpkg_dict=catpkg_dict) ]
+		steps += [ InsertEbuilds(from_tree, select=pkglist, skip=skip, replace=True, catpkg_dict=catpkg_dict, restrict=restrict_catpkgs) ]
 	return steps
 
+class KeywordProvider(object):
+
+	"""
+	KeywordProvider extracts the KEYWORDS of ebuilds for the comparison scripts. It uses the metadata/md5-cache
+	entry for the ebuild if there is one that is current, then tries to parse a single static KEYWORDS= assignment
+	out of the ebuild itself, and only as a last resort sources the ebuild in bash using keywords.sh.
+
+	The static parser only handles ebuilds where KEYWORDS is mentioned exactly once, in an unindented assignment
+	that is not inside an if or case block. Anything else -- conditional assignments like
+	"[[ ${PV} == *9999 ]] || KEYWORDS=...", appends, references to ${KEYWORDS} -- goes to bash.
+	"""
+
+	keywords_re = re.compile(r'^(?:export[ \t]+)?KEYWORDS=', re.M)
+	keywords_token_re = re.compile(r'\bKEYWORDS\b')
+	block_open_re = re.compile(r'(?:^|[;&|{(])[ \t]*(?:if|case)\b', re.M)
+	block_close_re = re.compile(r'(?:^|[;&|])[ \t]*(?:fi|esac)\b', re.M)
+
+	def __init__(self, keywords_sh=None):
+		if keywords_sh == None:
+			keywords_sh = os.path.join(os.path.dirname(os.path.abspath(__file__)), "keywords.sh")
+		self.keywords_sh = keywords_sh
+		self.stats = { "md5-cache" : 0, "static" : 0, "bash" : 0 }
+
+	def fromCache(self, portdir, ebuild):
+		cat, pkg, fn = ebuild.split("/")
+		try:
+			with open(os.path.join(portdir, "metadata/md5-cache", cat, fn[:-7]), "r") as f:
+				cache = dict(line.rstrip("\n").split("=", 1) for line in f if "=" in line)
+			with open(os.path.join(portdir, ebuild), "rb") as f:
+				ebuild_md5 = hashlib.md5(f.read()).hexdigest()
+		except (IOError, ValueError):
+			return None
+		if cache.get("_md5_") != ebuild_md5:
+			# stale cache entry
+			return None
+		return set(cache.get("KEYWORDS", "").split())
+
+	def fromEbuild(self, portdir, ebuild):
+		try:
+			with open(os.path.join(portdir, ebuild), "r") as f:
+				data = f.read()
+		except (IOError, UnicodeDecodeError):
+			return None
+		tokens = len(self.keywords_token_re.findall(data))
+		if tokens == 0:
+			# KEYWORDS not mentioned in the ebuild -- keywords.sh would give us nothing, too.
+			return set()
+		matches = list(self.keywords_re.finditer(data))
+		if tokens > 1 or len(matches) != 1:
+			# conditional, incremental or indirect assignments need bash.
+			return None
+		before = data[:matches[0].start()]
+		if len(self.block_open_re.findall(before)) != len(self.block_close_re.findall(before)):
+			# assigned inside an if or case block:
+			return None
+		rest = data[matches[0].end():]
+		if rest[:1] in [ '"', "'" ]:
+			end = rest.find(rest[0], 1)
+			if end == -1:
+				return None
+			value = rest[1:end]
+			trailing = rest[end+1:].split("\n", 1)[0]
+		else:
+			line = rest.split("\n", 1)[0]
+			value = re.split(r'[ \t;]', line, 1)[0]
+			trailing = line[len(value):]
+		if "$" in value or "`" in value or "\\" in value:
+			return None
+		if trailing.strip() not in [ "", ";" ] and not trailing.strip().startswith("#"):
+			return None
+		return set(value.split())
+
+	def fromBash(self, portdir, ebuild):
+		cmd = self.keywords_sh + " %s %s" % ( portdir, ebuild )
+		with traceSubprocess(cmd):
+			return subprocess.getstatusoutput(cmd)
+
+	def getKeywords(self, portdir, ebuild):
+
+		"""
+		Return the KEYWORDS of ebuild (specified as "cat/pkg/pkg-ver.ebuild", relative to portdir) as a
+		(0, set of keywords) tuple. If keywords.sh had to be used and failed, its (status, output) is returned.
+		"""
+
+		for method, func in [ ("md5-cache", self.fromCache), ("static", self.fromEbuild) ]:
+			keywords = func(portdir, ebuild)
+			if keywords != None:
+				self.stats[method] += 1
+				return (0, keywords)
+		self.stats["bash"] += 1
+		a = self.fromBash(portdir, ebuild)
+		if a[0] == 0:
+			return (0, set(a[1].split()))
+		return a
+
 def qa_build(host,build,arch_desc,subarch,head,target):
 	success = False
 	print("Performing remote QA build on %s for %s %s %s %s (%s)" % (host, build, arch_desc, subarch, head, target))
@@ -339,7 +940,8 @@ def runShell(string,abortOnFail=True):
 		print(string)
 	else:
 		print("running: %r" % string)
-		out = subprocess.getstatusoutput(string)
+		with traceSubprocess(string):
+			out = subprocess.getstatusoutput(string)
 		if out[0] != 0:
 			print("Error executing %r" % string)
 			print()
@@ -351,7 +953,7 @@ def runShell(string,abortOnFail=True):
 				return False
 	return True
 
-def run_command(args, *, abort_on_failure=True, **kwargs):
+def run_command(args, *, abort_on_failure=True, timeout=None, **kwargs):
 	if debug:
 		print(args)
 	else:
@@ -359,10 +961,17 @@ def run_command(args, *, abort_on_failure=True, **kwargs):
 		stdout = kwargs.pop("stdout", subprocess.PIPE)
 		stderr = kwargs.pop("stderr", subprocess.PIPE)
 		try:
-			with subprocess.Popen(args, stdout=stdout, stderr=stderr, **kwargs) as process:
-				status = process.wait()
-				stdout_content = process.stdout.read().decode()
-				stderr_content = process.stderr.read().decode()
+			with traceSubprocess(args), subprocess.Popen(args, stdout=stdout, stderr=stderr, **kwargs) as process:
+				try:
+					stdout_content, stderr_content = process.communicate(timeout=timeout)
+					status = process.returncode
+				except subprocess.TimeoutExpired:
+					process.kill()
+					stdout_content, stderr_content = process.communicate()
+					status = -1
+					stderr_content = ("timed out after %s seconds\n" % timeout).encode() + (stderr_content or b"")
+				stdout_content = stdout_content.decode() if stdout_content != None else ""
+				stderr_content = stderr_content.decode() if stderr_content != None else ""
 		except OSError as e:
 			status = -1
 			stdout_content = ""
@@ -378,8 +987,450 @@ def run_command(args, *, abort_on_failure=True, **kwargs):
 				return False
 	return True
 
+def copyFileData(infd, outfd, size):
+	# copy size bytes between file descriptors in-kernel where possible (copy_file_range, then sendfile):
+	offset = 0
+	if hasattr(os, "copy_file_range"):
+		try:
+			while offset < size:
+				count = os.copy_file_range(infd, outfd, size - offset)
+				if count == 0:
+					break
+				offset += count
+			return
+		except OSError as e:
+			if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+				raise
+	try:
+		while offset < size:
+			count = os.sendfile(outfd, infd, offset, size - offset)
+			if count == 0:
+				break
+			offset += count
+		return
+	except OSError as e:
+		if e.errno not in (errno.ENOSYS, errno.EINVAL):
+			raise
+	os.lseek(infd, offset, os.SEEK_SET)
+	while True:
+		buf = os.read(infd, 1024 * 1024)
+		if not buf:
+			break
+		os.write(outfd, buf)
+
+def copyStat(src, dst, st):
+	# preserve ownership, mode and timestamps of src, like "cp -a":
+	if os.geteuid() == 0:
+		os.lchown(dst, st.st_uid, st.st_gid)
+	if not stat.S_ISLNK(st.st_mode):
+		os.chmod(dst, stat.S_IMODE(st.st_mode))
+	os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+# ioctl used to create a copy-on-write clone of a file on btrfs/xfs:
+FICLONE = 0x40049409
+
+link_modes = [ None, "hardlink", "reflink" ]
+
+def copyFile(src, dst, st=None, link_mode=None):
+
+	"""
+	Copy a single file or symlink from src to dst, replacing dst if it exists. With a link_mode of "hardlink",
+	regular files are hard-linked to the source file rather than copied, and with "reflink", a copy-on-write
+	clone is created. Both fall back to a regular copy if the filesystem can't do it.
+	"""
+
+	if st == None:
+		st = os.lstat(src)
+	if os.path.lexists(dst):
+		os.unlink(dst)
+	if stat.S_ISLNK(st.st_mode):
+		os.symlink(os.readlink(src), dst)
+	else:
+		if link_mode == "hardlink":
+			try:
+				os.link(src, dst)
+				return
+			except OSError as e:
+				if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+					raise
+		with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+			cloned = False
+			if link_mode == "reflink":
+				try:
+					fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+					cloned = True
+				except OSError as e:
+					if e.errno not in (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY):
+						raise
+			if not cloned:
+				copyFileData(fsrc.fileno(), fdst.fileno(), st.st_size)
+	copyStat(src, dst, st)
+
+def copyTree(src, dst, link_mode=None):
+
+	"""
+	Copy the directory src to dst, like "cp -a src dst" would if dst does not exist. If dst already exists,
+	the contents of src are merged on top of it, replacing files that exist in both. See copyFile() for
+	link_mode.
+	"""
+
+	if not os.path.isdir(dst):
+		os.makedirs(dst)
+	for entry in os.scandir(src):
+		st = entry.stat(follow_symlinks=False)
+		if stat.S_ISDIR(st.st_mode):
+			copyTree(entry.path, os.path.join(dst, entry.name), link_mode)
+		else:
+			copyFile(entry.path, os.path.join(dst, entry.name), st, link_mode)
+	copyStat(src, dst, os.stat(src))
+
+def breakLink(path, keep=True):
+
+	"""
+	If path is a hard link shared with another tree (see GitTree's link_mode), replace it with a private file so
+	it can be modified without changing the source tree. If keep is False, the caller is about to overwrite the
+	file, so the link is simply removed.
+	"""
+
+	try:
+		st = os.lstat(path)
+	except FileNotFoundError:
+		return
+	if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+		if keep:
+			tmp = path + ".merge-tmp"
+			copyFile(path, tmp, st)
+			os.rename(tmp, path)
+		else:
+			os.unlink(path)
+
+def openForWrite(path, mode="w"):
+	# open a file in a destination tree for writing, making sure we don't write through to a hard-linked source file.
+	breakLink(path, keep="w" not in mode)
+	return open(path, mode)
+
+def runParallel(func, jobs, workers=None):
+	# run func on each job using a thread pool, returning the results in the order of jobs.
+	if workers == None:
+		workers = copy_workers
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		return list(executor.map(func, jobs))
+
+# Manifest entry types, in the order they are written out. Other types are written after these, sorted by type.
+manifest_types = [ "AUX", "DIST", "EBUILD", "MISC" ]
+
+class ManifestEntry(object):
+
+	"A single entry (line) of a Manifest file, such as 'DIST foo-1.0.tar.gz 1234 SHA256 ...'."
+
+	__slots__ = [ "type", "name", "line" ]
+
+	def __init__(self, line):
+		if not line.endswith("\n"):
+			line += "\n"
+		self.line = line
+		parts = line.split(None, 2)
+		self.type = parts[0]
+		self.name = parts[1] if len(parts) > 1 else ""
+
+	def key(self):
+		return (self.type, self.name)
+
+	def sortKey(self):
+		if self.type in manifest_types:
+			return (manifest_types.index(self.type), "", self.name)
+		return (len(manifest_types), self.type, self.name)
+
+class ManifestMergeStats(object):
+
+	"Counts of what happened while merging Manifests: entries added, and conflicting or identical entries replaced."
+
+	__slots__ = [ "manifests", "added", "conflicts", "identical" ]
+
+	def __init__(self):
+		self.manifests = 0
+		self.added = 0
+		self.conflicts = 0
+		self.identical = 0
+
+	def add(self, other):
+		for attr in self.__slots__:
+			setattr(self, attr, getattr(self, attr) + getattr(other, attr))
+
+	def __str__(self):
+		return "merged %s Manifests: %s entries added, %s conflicting entries replaced by source, %s identical" % (self.manifests, self.added, self.conflicts, self.identical)
+
+def iterManifest(path):
+	# stream ManifestEntry objects from the Manifest file at path. A missing Manifest has no entries.
+	try:
+		with open(path, "r") as f:
+			for line in f:
+				if line.strip():
+					yield ManifestEntry(line)
+	except FileNotFoundError:
+		return
+
+def readManifest(path):
+	# return a dict of (type, name) -> ManifestEntry for the Manifest file at path.
+	entries = {}
+	for entry in iterManifest(path):
+		entries[entry.key()] = entry
+	return entries
+
+def mergeManifest(entries, path, stats=None):
+	# merge the entries of the Manifest at path on top of the entries dict. Entries from path win.
+	if stats == None:
+		stats = ManifestMergeStats()
+	stats.manifests += 1
+	for entry in iterManifest(path):
+		key = entry.key()
+		if key not in entries:
+			stats.added += 1
+		elif entries[key].line == entry.line:
+			stats.identical += 1
+		else:
+			stats.conflicts += 1
+		entries[key] = entry
+	return stats
+
+def writeManifest(path, entries):
+	with openForWrite(path, "w") as f:
+		for entry in sorted(entries.values(), key=ManifestEntry.sortKey):
+			f.write(entry.line)
+
+def hashPaths(h, root, paths):
+	# feed the type, mode and contents of paths (relative to root, walking into directories) to hashlib object h.
+	for path in paths:
+		full = os.path.join(root, path)
+		try:
+			st = os.lstat(full)
+		except FileNotFoundError:
+			h.update(("missing %s\0" % path).encode("utf-8", "surrogateescape"))
+			continue
+		if stat.S_ISDIR(st.st_mode):
+			h.update(("dir %s\0" % path).encode("utf-8", "surrogateescape"))
+			hashPaths(h, root, [ os.path.join(path, name) for name in sorted(os.listdir(full)) ])
+		elif stat.S_ISLNK(st.st_mode):
+			h.update(("link %s %s\0" % ( path, os.readlink(full) )).encode("utf-8", "surrogateescape"))
+		else:
+			h.update(("file %s %o\0" % ( path, stat.S_IMODE(st.st_mode) )).encode("utf-8", "surrogateescape"))
+			with open(full, "rb") as f:
+				h.update(f.read())
+
+class StepCache(object):
+
+	"""
+	StepCache remembers what the last successful run of each cacheable MergeStep (see MergeStep.cacheKey()) wrote to
+	a tree. When the step comes up again with the same key -- same parameters, same inputs -- its recorded output is
+	written back instead of running it. File contents are stored by SHA1 under <path>/objects, and there is one
+	record per step and tree under <path>/steps. GitTrees use a StepCache if created with step_cache=True.
+	"""
+
+	def __init__(self, path=None):
+		self.path = path if path != None else os.path.join(cache_dir, "steps")
+
+	def lock(self):
+		os.makedirs(self.path, exist_ok=True)
+		f = open(os.path.join(self.path, "lock"), "w")
+		fcntl.flock(f, fcntl.LOCK_EX)
+		return f
+
+	def slotFile(self, tree, step):
+		# branches of a tree get their own records, so they don't push each other out:
+		return os.path.join(self.path, "steps", tree.name, getattr(tree, "branch", None) or "", step.cacheSlot())
+
+	def objectFile(self, sha):
+		return os.path.join(self.path, "objects", sha[:2], sha[2:])
+
+	def lookup(self, tree, step, key):
+		# return the outputs recorded for step in tree under key, or None.
+		try:
+			with open(self.slotFile(tree, step), "r") as f:
+				record = json.load(f)
+		except (IOError, ValueError):
+			return None
+		if record.get("key") != key:
+			return None
+		for entry in record["outputs"].values():
+			if entry != None and entry[0] == "f" and not os.path.exists(self.objectFile(entry[2])):
+				return None
+		return record["outputs"]
+
+	def record(self, tree, step, key):
+		outputs = {}
+		with self.lock():
+			for path in step.cacheOutputs(tree):
+				self.store(tree.root, path, outputs)
+			fn = self.slotFile(tree, step)
+			os.makedirs(os.path.dirname(fn), exist_ok=True)
+			with open(fn + ".tmp", "w") as f:
+				json.dump({ "key" : key, "step" : step.__class__.__name__, "outputs" : outputs }, f)
+			os.replace(fn + ".tmp", fn)
+
+	def store(self, root, path, outputs):
+		full = os.path.join(root, path)
+		try:
+			st = os.lstat(full)
+		except FileNotFoundError:
+			outputs[path] = None
+			return
+		if stat.S_ISDIR(st.st_mode):
+			outputs[path] = [ "d", stat.S_IMODE(st.st_mode), None ]
+			for name in sorted(os.listdir(full)):
+				self.store(root, os.path.join(path, name), outputs)
+		elif stat.S_ISLNK(st.st_mode):
+			outputs[path] = [ "l", 0, os.readlink(full) ]
+		else:
+			with open(full, "rb") as f:
+				data = f.read()
+			sha = hashlib.sha1(data).hexdigest()
+			obj = self.objectFile(sha)
+			if not os.path.exists(obj):
+				os.makedirs(os.path.dirname(obj), exist_ok=True)
+				with open(obj + ".tmp", "wb") as f:
+					f.write(data)
+				os.replace(obj + ".tmp", obj)
+			outputs[path] = [ "f", stat.S_IMODE(st.st_mode), sha ]
+
+	def replay(self, tree, outputs):
+		# write recorded outputs back to tree. Files that already have the right contents are left alone. Returns False,
+		# without changing anything, if something other than a directory is in the way of the directory of an output
+		# (what the step does about that is up to the step, so it has to run.)
+		for path in outputs.keys():
+			parent = os.path.dirname(path)
+			while parent != "" and parent not in outputs:
+				full = os.path.join(tree.root, parent)
+				if os.path.lexists(full) and ( os.path.islink(full) or not os.path.isdir(full) ):
+					return False
+				parent = os.path.dirname(parent)
+		for path in sorted(outputs.keys()):
+			entry = outputs[path]
+			full = os.path.join(tree.root, path)
+			if entry == None:
+				if os.path.isdir(full) and not os.path.islink(full):
+					shutil.rmtree(full)
+				elif os.path.lexists(full):
+					os.unlink(full)
+				continue
+			kind, mode, value = entry
+			if kind == "d":
+				if os.path.lexists(full) and not os.path.isdir(full):
+					os.unlink(full)
+				os.makedirs(full, exist_ok=True)
+				continue
+			os.makedirs(os.path.dirname(full), exist_ok=True)
+			if os.path.isdir(full) and not os.path.islink(full):
+				shutil.rmtree(full)
+			if kind == "l":
+				if os.path.islink(full) and os.readlink(full) == value:
+					continue
+				if os.path.lexists(full):
+					os.unlink(full)
+				os.symlink(value, full)
+				continue
+			if os.path.isfile(full) and not os.path.islink(full):
+				st = os.lstat(full)
+				with open(full, "rb") as f:
+					if hashlib.sha1(f.read()).hexdigest() == value:
+						if stat.S_IMODE(st.st_mode) != mode:
+							os.chmod(full, mode)
+						continue
+			# write a new file and rename it into place, so we never write through a hard link:
+			shutil.copyfile(self.objectFile(value), full + ".merge-tmp")
+			os.chmod(full + ".merge-tmp", mode)
+			os.replace(full + ".merge-tmp", full)
+		return True
+
+	def prune(self):
+		# remove stored file contents that no step record refers to any more. This walks the whole cache, so scripts
+		# call it once, when they are done.
+		with self.lock():
+			used = set()
+			for dirpath, dirnames, filenames in os.walk(os.path.join(self.path, "steps")):
+				for fn in filenames:
+					try:
+						with open(os.path.join(dirpath, fn), "r") as f:
+							record = json.load(f)
+					except (IOError, ValueError):
+						continue
+					for entry in record.get("outputs", {}).values():
+						if entry != None and entry[0] == "f":
+							used.add(entry[2])
+			for dirpath, dirnames, filenames in os.walk(os.path.join(self.path, "objects")):
+				for fn in filenames:
+					if os.path.basename(dirpath) + fn not in used:
+						os.unlink(os.path.join(dirpath, fn))
+
+def callableKey(fun):
+	# return a SHA1 identifying what plain function fun does -- its code, the names it uses, its defaults and the values
+	# it closes over -- or None if it can't be identified that way.
+	def describe(value):
+		if isinstance(value, types.CodeType):
+			return [ "code", value.co_code.hex(), [ describe(c) for c in value.co_consts ], list(value.co_names) ]
+		elif isinstance(value, (tuple, list, frozenset)):
+			items = [ describe(v) for v in value ]
+			if None in items:
+				return None
+			return [ type(value).__name__, sorted(items, key=repr) if isinstance(value, frozenset) else items ]
+		elif value is None or isinstance(value, (str, bytes, int, float, bool)):
+			return repr(value)
+		return None
+	if not isinstance(fun, types.FunctionType):
+		return None
+	parts = [ describe(fun.__code__), describe(fun.__defaults__ or ()) ]
+	for cell in fun.__closure__ or ():
+		try:
+			parts.append(describe(cell.cell_contents))
+		except ValueError:
+			# empty cell
+			return None
+	if None in parts or fun.__kwdefaults__:
+		return None
+	return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()
+
 class MergeStep(object):
-	pass
+
+	"""
+	Base class of the steps run by GitTree.run(). A step whose result depends only on its parameters and on files it
+	can name up front can be cached by a StepCache: cacheParams() returns its parameters (None, the default, means
+	it can't be cached), cacheInputs() the files it reads and cacheOutputs() the files it writes. cacheParams() must
+	not depend on the tree -- anything read from the tree belongs in cacheInputs(). Cacheable steps must not have
+	side effects other than the files they write.
+	"""
+
+	def cacheParams(self):
+		# return a JSON-serializable description of the step's parameters, or None if the step can't be cached.
+		return None
+
+	def cacheInputs(self, tree):
+		# return a list of (root, paths) tuples naming the files (or directories) the step reads.
+		return []
+
+	def cacheOutputs(self, tree):
+		# return the paths, relative to tree.root, that the step writes.
+		return []
+
+	def cacheSlot(self):
+		# identifies the step among the steps run on a tree; the StepCache keeps one record per slot.
+		return hashlib.sha1(json.dumps([ self.__class__.__name__, self.cacheParams() ], sort_keys=True).encode("utf-8")).hexdigest()
+
+	def cacheKey(self, tree):
+		# return a key identifying this run of the step (its parameters and inputs), or None if it can't be cached.
+		params = self.cacheParams()
+		if params == None:
+			return None
+		h = hashlib.sha1()
+		h.update(json.dumps([ self.__class__.__name__, params ], sort_keys=True).encode("utf-8"))
+		# roots are left out, so that the key doesn't change with where the tree (or a snapshot) is checked out:
+		for pos, ( root, paths ) in enumerate(self.cacheInputs(tree)):
+			h.update(("input %s\0" % pos).encode("utf-8"))
+			hashPaths(h, root, paths)
+		# what is in the way of the outputs can matter too (cp into an existing directory, for instance):
+		for path in self.cacheOutputs(tree):
+			full = os.path.join(tree.root, path)
+			if os.path.isdir(full):
+				h.update(("dir %s\0" % path).encode("utf-8", "surrogateescape"))
+		return h.hexdigest()
 
 class AutoGlobMask(MergeStep):
 
@@ -404,19 +1455,36 @@ class AutoGlobMask(MergeStep):
 		self.catpkg = catpkg
 		self.maskdest = maskdest
 
+	def cacheParams(self):
+		return [ self.catpkg, self.glob, self.maskdest ]
+
+	def cacheInputs(self, tree):
+		return [ ( tree.root, [ self.catpkg ] ) ]
+
+	def cacheOutputs(self, tree):
+		return [ os.path.join("profiles/package.mask", self.maskdest) ]
+
 	def run(self,tree):
 		if not os.path.exists(tree.root + "/profiles/package.mask"):
 			os.makedirs(tree.root + "/profiles/package.mask")
-		f = open(os.path.join(tree.root,"profiles/package.mask", self.maskdest), "w")
-		os.chdir(os.path.join(tree.root,self.catpkg))
+		f = openForWrite(os.path.join(tree.root,"profiles/package.mask", self.maskdest), "w")
 		cat = self.catpkg.split("/")[0]
-		for item in glob.glob(self.glob+".ebuild"):
-			f.write("=%s/%s\n" % (cat,item[:-7]))
+		for item in glob.glob(os.path.join(tree.root,self.catpkg,self.glob+".ebuild")):
+			f.write("=%s/%s\n" % (cat,os.path.basename(item)[:-7]))
 		f.close()
 
 class ThirdPartyMirrors(MergeStep):
 	"Add funtoo's distfiles mirror, and add funtoo's mirrors as gentoo back-ups."
 
+	def cacheParams(self):
+		return []
+
+	def cacheInputs(self, tree):
+		return [ ( tree.root, [ "profiles/thirdpartymirrors" ] ) ]
+
+	def cacheOutputs(self, tree):
+		return [ "profiles/thirdpartymirrors" ]
+
 	def run(self,tree):
 		orig = "%s/profiles/thirdpartymirrors" % tree.root
 		new = "%s/profiles/thirdpartymirrors.new" % tree.root
@@ -463,11 +1531,17 @@ class GenerateRepoMetadata(MergeStep):
 		self.masters = masters
 		self.priority = priority
 
+	def cacheParams(self):
+		return [ self.name, self.masters, self.aliases, self.priority ]
+
+	def cacheOutputs(self, tree):
+		return [ "metadata/layout.conf", "profiles/repo_name" ]
+
 	def run(self,tree):
 		meta_path = os.path.join(tree.root, "metadata")
 		if not os.path.exists(meta_path):
 			os.makedirs(meta_path)
-		a = open(meta_path + '/layout.conf','w')
+		a = openForWrite(meta_path + '/layout.conf','w')
 		out = '''repo-name = %s
 thin-manifests = true
 sign-manifests = false
@@ -483,7 +1557,7 @@ cache-formats = md5-dict
 		rn_path = os.path.join(tree.root, "profiles")
 		if not os.path.exists(rn_path):
 			os.makedirs(rn_path)
-		a = open(rn_path + '/repo_name', 'w')
+		a = openForWrite(rn_path + '/repo_name', 'w')
 		a.write(self.name + "\n")
 		a.close() 
 
@@ -519,6 +1593,9 @@ class SyncDir(MergeStep):
 		if not os.path.exists(dest):
 			os.makedirs(dest)
 		cmd = "rsync -a --exclude CVS --exclude .svn --filter=\"hide /.git\" --filter=\"protect /.git\" "
+		if getattr(tree, "link_mode", None) == "hardlink":
+			# hard-link unmodified files to the source rather than copying them:
+			cmd += "--link-dest=%s " % os.path.abspath(src)
 		for e in self.exclude:
 			cmd += "--exclude %s " % e
 		if self.delete:
@@ -533,6 +1610,21 @@ class CopyAndRename(MergeStep):
 		#renaming function ... accepts source file path, and returns destination filename
 		self.ren_fun = ren_fun
 
+	def cacheParams(self):
+		fun_key = callableKey(self.ren_fun)
+		if fun_key == None:
+			return None
+		return [ self.src, self.dest, fun_key ]
+
+	def cacheInputs(self, tree):
+		return [ ( tree.root, [ self.src ] ) ]
+
+	def cacheOutputs(self, tree):
+		srcpath = os.path.join(tree.root, self.src)
+		if not os.path.isdir(srcpath):
+			return []
+		return [ os.path.join(self.dest, self.ren_fun(f)) for f in sorted(os.listdir(srcpath)) ]
+
 	def run(self, tree):
 		srcpath = os.path.join(tree.root,self.src)
 		for f in os.listdir(srcpath):
@@ -547,6 +1639,15 @@ class SyncFiles(MergeStep):
 		if not isinstance(files, dict):
 			raise TypeError("'files' argument should be a dict of source:destination items")
 
+	def cacheParams(self):
+		return sorted(self.files.items(), key=lambda x: x[0])
+
+	def cacheInputs(self, tree):
+		return [ ( self.srcroot, sorted(self.files.keys()) ) ]
+
+	def cacheOutputs(self, tree):
+		return [ dest if dest is not None else src for src, dest in sorted(self.files.items(), key=lambda x: x[0]) ]
+
 	def run(self, tree):
 		for src, dest in self.files.items():
 			if dest is not None:
@@ -583,7 +1684,7 @@ class MergeUpdates(MergeStep):
 				src_file.close()
 				dest_file.close()
 				dest_lines.extend(src_lines)
-				dest_file = open(dest, "w")
+				dest_file = openForWrite(dest, "w")
 				dest_file.writelines(dest_lines)
 				dest_file.close()
 			else:
@@ -612,6 +1713,159 @@ class SyncFromTree(SyncDir):
 		SyncDir.run(self,desttree)
 		desttree.logTree(self.srctree)
 
+class PackageXMLRecorder(object):
+
+	"""
+	PackageXMLRecorder records the repository that each catpkg in a destination tree was copied from, along
+	with the USE flags described in its metadata.xml, and writes this out as our packages.xml file. Pass it to
+	GitTree as xml_out and InsertEbuilds will record every catpkg it copies.
+
+	The output is byte-for-byte what the merge scripts have always produced for the same sequence of copies:
+	every copied catpkg gets a <category> element of its own, in the order the catpkgs were copied, and a catpkg
+	copied more than once is listed once per copy. To keep it that way there is no catpkg index, no sorting and
+	no bounded memory: records is an unbounded list of plain tuples in copy order, held until write(). What it
+	saves over the old code is the two XPath searches of the whole document for every copied catpkg.
+	"""
+
+	def __init__(self):
+		self.records = []
+
+	def record(self, cat, pkg, repository, use_flags=None):
+		# use_flags is a list of (flag, description) tuples, or None if there is no usable metadata.xml.
+		self.records.append((cat, pkg, repository, use_flags))
+
+	def categoryElement(self, cat, pkg, repository, use_flags):
+		catxml = etree.Element("category", name=cat)
+		pkgxml = etree.SubElement(catxml, "package", name=pkg, repository=repository)
+		if use_flags != None:
+			pkgxml.attrib["use"] = ""
+			usexml = etree.SubElement(pkgxml, "use")
+			for name, desc in use_flags:
+				flag = etree.SubElement(usexml, "flag")
+				flag.attrib["name"] = name
+				flag.text = desc
+		return catxml
+
+	def write(self, fn):
+		with open(fn, "wb") as a:
+			if not self.records:
+				a.write(b"<?xml version='1.0' encoding='UTF-8'?>\n<packages/>\n")
+				return
+			with etree.xmlfile(a, encoding="UTF-8") as xf:
+				xf.write_declaration()
+				with xf.element("packages"):
+					for record in self.records:
+						catxml = self.categoryElement(*record)
+						etree.indent(catxml, level=1)
+						xf.write("\n  ")
+						xf.write(catxml)
+					xf.write("\n")
+			a.write(b"\n")
+
+def parseUseFlags(data):
+	# parse the contents of a metadata.xml file, returning a list of (flag, description) tuples, or None if it can't be parsed.
+	try:
+		metatree = etree.fromstring(data)
+	except (etree.XMLSyntaxError, UnicodeDecodeError, ValueError):
+		return None
+	use_flags = []
+	for el in metatree.iterfind('.//flag'):
+		name = el.get("name")
+		if name != None:
+			use_flags.append((name, etree.tostring(el, method="text", encoding="unicode").strip()))
+	return use_flags
+
+class UseFlagCache(object):
+
+	"""
+	UseFlagCache is a persistent cache of parsed metadata.xml USE flag descriptions, keyed by the SHA1 of the
+	file's contents. Most metadata.xml files don't change from one merge to the next, so most lookups are hits.
+	"""
+
+	def __init__(self, path=None):
+		if path == None:
+			path = os.path.join(cache_dir, "use-flags.db")
+		if not os.path.exists(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		self.db = sqlite3.connect(path, timeout=300)
+		self.db.execute("CREATE TABLE IF NOT EXISTS use_flags (hash TEXT PRIMARY KEY, flags TEXT)")
+		self.db.commit()
+
+	def get(self, digest):
+		# returns a (found, use_flags) tuple:
+		row = self.db.execute("SELECT flags FROM use_flags WHERE hash = ?", (digest,)).fetchone()
+		if row == None:
+			return False, None
+		flags = json.loads(row[0])
+		return True, [ tuple(f) for f in flags ] if flags != None else None
+
+	def put(self, items):
+		self.db.executemany("INSERT OR REPLACE INTO use_flags VALUES (?, ?)", [ (digest, json.dumps(flags)) for digest, flags in items ])
+		self.db.commit()
+
+use_flag_cache = None
+
+def getUseFlags(paths, workers=None):
+
+	"""
+	Return a dict mapping each metadata.xml path in paths to its list of (flag, description) tuples, or to None
+	if the file does not exist or can't be parsed. Results are looked up in the UseFlagCache by content hash,
+	and files that aren't cached yet are parsed in a process pool.
+	"""
+
+	global use_flag_cache
+	if use_flag_cache == None:
+		use_flag_cache = UseFlagCache()
+	if workers == None:
+		workers = metadata_workers
+	out = {}
+	misses = {}
+	for path in paths:
+		try:
+			with open(path, "rb") as f:
+				data = f.read()
+		except IOError:
+			out[path] = None
+			continue
+		digest = hashlib.sha1(data).hexdigest()
+		found, use_flags = use_flag_cache.get(digest)
+		if found:
+			out[path] = use_flags
+		elif digest in misses:
+			misses[digest][1].append(path)
+		else:
+			misses[digest] = (data, [path])
+	if not misses:
+		return out
+	digests = list(misses.keys())
+	datas = [ misses[digest][0] for digest in digests ]
+	if workers > 1 and len(datas) > 50:
+		# fork, so that workers don't re-import this module:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+			results = list(executor.map(parseUseFlags, datas, chunksize=64))
+	else:
+		results = list(map(parseUseFlags, datas))
+	for digest, use_flags in zip(digests, results):
+		for path in misses[digest][1]:
+			out[path] = use_flags
+	use_flag_cache.put(zip(digests, results))
+	return out
+
+def reopenCaches(log_path=None):
+	# SQLite connections, portdbapi instances and open files can't be shared across fork(). Forked children should call
+	# this before doing any work, so they open their own. If log_path is specified, the child logs inserted catpkgs
+	# there instead of to the merge log it inherited:
+	global use_flag_cache, mergeLog
+	metadata_indexes.clear()
+	dependency_graphs.clear()
+	portdb_pool.pool.clear()
+	tree_listings.clear()
+	use_flag_cache = None
+	if log_path != None:
+		if mergeLog != None:
+			mergeLog.close()
+		mergeLog = open(log_path, "w", buffering=1)
+
 class Tree(object):
 	def __init__(self,name,root):
 		self.name = name
@@ -619,11 +1873,299 @@ class Tree(object):
 	def head(self):
 		return "None"
 
+def initializeTrees(trees, workers=None, timeout=None):
+
+	"""
+	Sync GitTrees created with defer=True, using a thread pool so that fetches from different remotes overlap.
+	workers defaults to fetch_workers and timeout (per network operation, in seconds) to fetch_timeout. When this
+	returns, every tree is checked out and its changes attribute is set.
+	"""
+
+	if workers == None:
+		workers = fetch_workers
+	if timeout == None:
+		timeout = fetch_timeout
+	trees = [ tree for tree in trees if not getattr(tree, "synced", True) ]
+	if len(trees) == 0:
+		return
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+		futures = [ executor.submit(tree.sync, timeout) for tree in trees ]
+		for future in futures:
+			future.result()
+
+class TreeSnapshot(Tree):
+
+	"""
+	A read-only checkout of a single commit of a GitTree, handed out by WorktreePool. It can be used as a source tree
+	anywhere a GitTree can, but it never moves to a different commit. Call release() when done with it.
+	"""
+
+	def __init__(self, tree, sha, root, pool):
+		Tree.__init__(self, tree.name, root)
+		self.tree = tree
+		self.sha = sha
+		self.pool = pool
+		self.reponame = getattr(tree, "reponame", None)
+		self.index_name = "%s@%s" % ( tree.name, sha )
+		self.merged = []
+		self.writeTree = False
+		self.xml_out = None
+
+	def head(self):
+		return self.sha
+
+	def gitCheckout(self, branch=None):
+		# snapshots are pinned to their commit.
+		pass
+
+	def getAllCatPkgs(self):
+		catpkgs = {}
+		for catpkg in getCatPkgs(self.root, listing=getTreeListing(self.root, self.sha)):
+			catpkgs[catpkg] = self.name
+		return catpkgs
+
+	def release(self):
+		self.pool.release(self)
+
+class TreeRevision(Tree):
+
+	"""
+	A single commit of a GitTree, read straight from git without checking anything out: its files are listed by a
+	TreeListing of the commit, and metadata queries are answered by the metadata index the tree already has, as it is
+	(the index isn't synced, so it may lag behind the commit.) Good enough for planning; use a TreeSnapshot for
+	anything that needs the files themselves.
+	"""
+
+	def __init__(self, tree, sha):
+		Tree.__init__(self, tree.name, tree.root)
+		self.tree = tree
+		self.sha = sha
+		self.reponame = getattr(tree, "reponame", None)
+		self.listing = getTreeListing(tree.root, sha)
+		self.frozen = True
+		# the index of a snapshot of this very commit is the best match, if we have one:
+		self.index_name = "%s@%s" % ( tree.name, sha )
+		if not os.path.exists(os.path.join(cache_dir, "metadata", self.index_name.replace("/", "_") + ".db")):
+			self.index_name = tree.name
+
+	def head(self):
+		return self.sha
+
+	def getAllCatPkgs(self):
+		catpkgs = {}
+		for catpkg in getCatPkgs(self.root, listing=self.listing):
+			catpkgs[catpkg] = self.name
+		return catpkgs
+
+	def release(self):
+		pass
+
+class WorktreePool(object):
+
+	"""
+	WorktreePool hands out TreeSnapshots of commits of GitTrees, backed by "git worktree" checkouts at
+	<worktree_dir>/<tree name>/<sha1>. A worktree is created the first time its commit is asked for and is then
+	reused by anyone asking for the same commit, in this or a later run, so different commits of one repository can be
+	read at the same time while its main working tree is updated. Worktrees are created under a lock file, so processes
+	can share the pool. Each process holding a snapshot also holds a shared lock on <worktree_dir>/<tree name>.refs/<sha1>
+	(forked children inherit it), and prune() only removes worktrees whose lock it can take exclusively, beyond the
+	most recently used ones.
+	"""
+
+	def __init__(self):
+		# path -> [ reference count, open reference lock file ]:
+		self.refs = {}
+		# worktrees this process has verified to be clean checkouts of their commit:
+		self.checked = set()
+
+	def lock(self, tree):
+		if not os.path.exists(os.path.join(worktree_dir, tree.name)):
+			os.makedirs(os.path.join(worktree_dir, tree.name))
+		f = open(os.path.join(worktree_dir, tree.name + ".lock"), "w")
+		fcntl.flock(f, fcntl.LOCK_EX)
+		return f
+
+	def acquire(self, tree, rev):
+		with self.lock(tree):
+			sha = gitRevParse(tree.root, rev)
+			if sha == None and re.match("^[0-9a-f]{40}$", rev) and hasattr(tree, "fetchCommit") and tree.fetchCommit(rev):
+				# a pinned commit we didn't have yet:
+				sha = gitRevParse(tree.root, rev)
+			if sha == None:
+				print("Error: can't resolve %s in %s." % ( rev, tree.root ))
+				sys.exit(1)
+			path = os.path.join(worktree_dir, tree.name, sha)
+			if path in self.checked and os.path.isdir(path):
+				# already verified in this run -- just mark it as recently used, for prune():
+				os.utime(path)
+			elif gitRevParse(path) != sha or gitChangedPaths(path, sha) != set():
+				# missing, or not what it should be -- (re)create it:
+				if os.path.lexists(path):
+					shutil.rmtree(path)
+				run_command(["git", "worktree", "prune"], cwd=tree.root)
+				run_command(["git", "worktree", "add", "--detach", path, sha], cwd=tree.root)
+			else:
+				os.utime(path)
+			self.checked.add(path)
+			if path not in self.refs:
+				os.makedirs(os.path.join(worktree_dir, tree.name + ".refs"), exist_ok=True)
+				f = open(os.path.join(worktree_dir, tree.name + ".refs", sha), "w")
+				fcntl.flock(f, fcntl.LOCK_SH)
+				self.refs[path] = [ 0, f ]
+			self.refs[path][0] += 1
+		return TreeSnapshot(tree, sha, path, self)
+
+	def release(self, snapshot):
+		if snapshot.root not in self.refs:
+			return
+		self.refs[snapshot.root][0] -= 1
+		if self.refs[snapshot.root][0] == 0:
+			self.refs.pop(snapshot.root)[1].close()
+
+	def prune(self, tree, keep=2):
+		# remove worktrees of tree that aren't referenced, except for the keep most recently used ones:
+		base = os.path.join(worktree_dir, tree.name)
+		if not os.path.isdir(base):
+			return
+		with self.lock(tree):
+			os.makedirs(os.path.join(worktree_dir, tree.name + ".refs"), exist_ok=True)
+			paths = sorted([ os.path.join(base, sha) for sha in os.listdir(base) ], key=os.path.getmtime, reverse=True)
+			for path in paths[keep:]:
+				if path in self.refs:
+					continue
+				ref_path = os.path.join(worktree_dir, tree.name + ".refs", os.path.basename(path))
+				with open(ref_path, "w") as f:
+					try:
+						fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+					except BlockingIOError:
+						# another process is using it:
+						continue
+					print("Removing worktree %s" % path)
+					shutil.rmtree(path)
+					os.unlink(ref_path)
+				self.checked.discard(path)
+				# the snapshot's metadata indexes go too:
+				for fn in glob.glob(os.path.join(cache_dir, "metadata", "*%s@%s*.db" % ( glob.escape(tree.name), os.path.basename(path) ))):
+					os.unlink(fn)
+			run_command(["git", "worktree", "prune"], cwd=tree.root)
+
+worktree_pool = WorktreePool()
+
+class TreeListing(object):
+
+	"""
+	TreeListing answers listdir/isdir/exists questions about a tree, using paths relative to its root. If sha is
+	specified, the whole listing is read from "git ls-tree -r" of that commit in one go. Otherwise, directories are
+	scanned with os.scandir() as they are first asked about, and remembered from then on.
+	"""
+
+	def __init__(self, root, sha=None):
+		self.root = root
+		self.sha = sha
+		self.children = {}
+		if sha != None:
+			with traceSubprocess("git ls-tree -r " + sha):
+				out = subprocess.run(["git", "ls-tree", "-r", "-z", "--name-only", sha], cwd=root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+			if out.returncode != 0:
+				# fall back to scanning:
+				self.sha = None
+				return
+			self.children[""] = {}
+			for path in out.stdout.decode("utf-8", "surrogateescape").split("\0"):
+				if not path:
+					continue
+				parent = ""
+				parts = path.split("/")
+				for pos, name in enumerate(parts):
+					entries = self.children[parent]
+					is_dir = pos < len(parts) - 1
+					path = parent + "/" + name if parent else name
+					if is_dir and not entries.get(name):
+						entries[name] = True
+						self.children[path] = {}
+					elif not is_dir:
+						entries[name] = False
+					parent = path
+
+	def entries(self, path=""):
+		# return a dict mapping the names in directory path to True (directory) or False (anything else).
+		if path in self.children:
+			return self.children[path]
+		entries = {}
+		if self.sha == None:
+			try:
+				for entry in os.scandir(os.path.join(self.root, path)):
+					entries[entry.name] = entry.is_dir()
+			except (FileNotFoundError, NotADirectoryError):
+				pass
+			self.children[path] = entries
+		return entries
+
+	def listdir(self, path=""):
+		return sorted(self.entries(path).keys())
+
+	def isdir(self, path):
+		if path == "":
+			return True
+		parent, name = os.path.split(path)
+		return self.entries(parent).get(name, False)
+
+	def exists(self, path):
+		parent, name = os.path.split(path)
+		return name in self.entries(parent)
+
+	def read(self, path):
+		# return the contents of file path, as text.
+		if self.sha == None:
+			with open(os.path.join(self.root, path), "r") as f:
+				return f.read()
+		with traceSubprocess("git cat-file blob " + self.sha + ":" + path):
+			out = subprocess.run(["git", "cat-file", "blob", self.sha + ":" + path], cwd=self.root, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+		if out.returncode != 0:
+			raise FileNotFoundError(path)
+		return out.stdout.decode("utf-8")
+
+# listings of whole trees are big, so only the most recently used ones are kept:
+tree_listings = collections.OrderedDict()
+tree_listings_max = 4
+
+def getTreeListing(root, sha=None):
+	# return a TreeListing for root, or for commit sha of it. Clean git trees are listed from git and cached by SHA1;
+	# anything else is scanned. Trees that are being written to, like the destination of a step, should just use
+	# TreeListing(root), as they are rarely clean.
+	if sha == None:
+		sha = gitRevParse(root)
+		if sha == None or not gitIsClean(root):
+			return TreeListing(root)
+	key = (root, sha)
+	if key in tree_listings:
+		tree_listings.move_to_end(key)
+	else:
+		tree_listings[key] = TreeListing(root, sha)
+		while len(tree_listings) > tree_listings_max:
+			tree_listings.popitem(last=False)
+	return tree_listings[key]
+
+def getCatPkgs(root, listing=None):
+	# return a list of the catpkgs in the tree at root, for the categories listed in its profiles/categories.
+	if listing == None:
+		listing = getTreeListing(root)
+	cats = listing.read("profiles/categories").split()
+	catpkgs = []
+	for cat in cats:
+		if not listing.isdir(cat):
+			continue
+		for pkg in listing.listdir(cat):
+			if not listing.isdir(cat + "/" + pkg):
+				continue
+			catpkgs.append(cat + "/" + pkg)
+	return catpkgs
+
 class GitTree(Tree):
 
 	"A Tree (git) that we can use as a source for work jobs, and/or a target for running jobs."
 
-	def __init__(self,name, branch="master",url=None,commit=None,pull=False,root=None,xml_out=None,initialize=False,reponame=None):
+	def __init__(self,name, branch="master",url=None,commit=None,pull=False,root=None,xml_out=None,initialize=False,reponame=None,link_mode=None,defer=False,depth=None,clone_filter=None,step_cache=False):
 		self.name = name
 		self.root = root
 		self.branch = branch
@@ -635,31 +2177,30 @@ class GitTree(Tree):
 		self.push = False
 		self.changes = True
 		self.reponame = reponame
+		# with step_cache=True, cacheable steps are replayed from a StepCache when their inputs haven't changed:
+		self.step_cache = StepCache() if step_cache else None
+		# catpkgs copied verbatim from a clean git tree since the last commit (see recordVerbatim()):
+		self.verbatim = {}
+		# link_mode (None, "hardlink" or "reflink") controls how files are inserted into this tree by copy steps:
+		if link_mode not in link_modes:
+			print("Error: invalid link_mode %r for GitTree %s." % (link_mode, name))
+			sys.exit(1)
+		self.link_mode = link_mode
 		# if we don't specify root destination tree, assume we are source only:
 		if self.root == None:
 			self.writeTree = False
 			if self.url == None:
 				print("Error: please specify root or url for GitTree.")
 				sys.exit(1)
-			base = "/var/git/source-trees"
-			self.root = "%s/%s" % ( base, self.name )
-			if os.path.exists(self.root):
-				self.head_old = self.head()
-				runShell("(cd %s; git fetch origin)" % self.root, abortOnFail=False)
-				runShell("(cd %s; git checkout %s)" % ( self.root, self.branch ))
-				if pull:
-					runShell("(cd %s; git pull -f origin %s)" % ( self.root, self.branch ), abortOnFail=False)
-				self.head_new = self.head()
-				self.changes = self.head_old != self.head_new
-			else:
-				if not os.path.exists(base):
-					os.makedirs(base)
-				if url:
-					runShell("(cd %s; git clone %s %s)" % ( base, self.url, self.name ))
-					runShell("(cd %s; git checkout %s)" % ( self.root, self.branch ))
-				else:
-					print("Error: tree %s does not exist, but no clone URL specified. Exiting." % self.root)
-					sys.exit(1)
+			self.root = "%s/%s" % ( source_tree_dir, self.name )
+			self.pull = pull
+			# depth makes a shallow clone, and clone_filter (such as "blob:none") a partial one:
+			self.depth = depth
+			self.clone_filter = clone_filter
+			self.synced = False
+			# with defer=True, the fetch is left to initializeTrees(), which syncs many trees at once:
+			if not defer:
+				self.sync()
 		else:
 			self.writeTree = True
 			if not os.path.isdir("%s/.git" % self.root):
@@ -681,53 +2222,255 @@ class GitTree(Tree):
 							sys.exit(1)
 			else:
 				self.push = True
+			if self.commit:
+				runShell("(cd %s; git checkout %s)" % ( self.root, self.commit ))
+
+	def sync(self, timeout=None):
+		# clone or update this source tree from its url and check out its branch (and commit, if specified.) timeout
+		# limits each network operation, in seconds.
+		pinned = self.pinned()
+		depth = [ "--depth", str(self.depth) ] if self.depth else []
+		if os.path.exists(self.root):
+			self.head_old = self.head()
+			if pinned != None:
+				# nothing to pull -- and if we already have the commit, no need to go to the network at all:
+				self.fetchCommit(pinned, timeout)
+			else:
+				run_command(["git", "fetch"] + depth + ["origin"], cwd=self.root, timeout=timeout, abort_on_failure=False)
+				runShell("(cd %s; git checkout %s)" % ( self.root, self.branch ))
+				if self.pull:
+					run_command(["git", "pull", "-f"] + depth + ["origin", self.branch], cwd=self.root, timeout=timeout, abort_on_failure=False)
+		else:
+			os.makedirs(source_tree_dir, exist_ok=True)
+			args = ["git", "clone"] + depth
+			if self.clone_filter:
+				args.append("--filter=" + self.clone_filter)
+			if pinned != None:
+				args.append("--no-checkout")
+			run_command(args + [self.url, self.name], cwd=source_tree_dir, timeout=timeout)
+			if pinned != None:
+				self.fetchCommit(pinned, timeout)
+			else:
+				runShell("(cd %s; git checkout %s)" % ( self.root, self.branch ))
 		# branch is updated -- now switch to specific commit if one was specified:
-		if self.commit:
+		if pinned != None:
+			if not gitIsCheckedOut(self.root, pinned):
+				runShell("(cd %s; git checkout %s)" % ( self.root, pinned ))
+		elif self.commit:
 			runShell("(cd %s; git checkout %s)" % ( self.root, self.commit ))
+		if hasattr(self, "head_old"):
+			self.head_new = self.head()
+			self.changes = self.head_old != self.head_new
+		self.synced = True
+
+	def pinned(self):
+		# return the SHA1 this tree is pinned to (as its commit, or by using a SHA1 as its branch), or None.
+		for rev in [ self.commit, self.branch ]:
+			if rev and re.match("^[0-9a-f]{40}$", rev):
+				return rev
+		return None
+
+	def hasCommit(self, sha):
+		with traceSubprocess("git cat-file -e " + sha):
+			return subprocess.run(["git", "cat-file", "-e", sha + "^{commit}"], cwd=self.root, stderr=subprocess.DEVNULL).returncode == 0
+
+	def fetchCommit(self, sha, timeout=None):
+		# make sure commit sha is available locally, fetching just that commit from origin if needed. If the remote won't
+		# serve a single commit, fall back to fetching full history. Returns True if the commit is available.
+		if self.hasCommit(sha):
+			return True
+		depth = [ "--depth", str(self.depth) ] if getattr(self, "depth", None) else []
+		if not run_command(["git", "fetch"] + depth + ["origin", sha], cwd=self.root, timeout=timeout, abort_on_failure=False):
+			unshallow = [ "--unshallow" ] if os.path.exists(os.path.join(self.root, ".git", "shallow")) else []
+			run_command(["git", "fetch"] + unshallow + ["origin"], cwd=self.root, timeout=timeout, abort_on_failure=False)
+		return self.hasCommit(sha)
 
 	def getAllCatPkgs(self):
 		self.gitCheckout()
-		with open(self.root + "/profiles/categories","r") as a:
-			cats = a.read().split()
 		catpkgs = {} 
-		for cat in cats:
-			if not os.path.exists(self.root + "/" + cat):
-				continue
-			pkgs = os.listdir(self.root + "/" + cat)
-			for pkg in pkgs:
-				if not os.path.isdir(self.root + "/" + cat + "/" + pkg):
-					continue
-				catpkgs[cat + "/" + pkg] = self.name
+		for catpkg in getCatPkgs(self.root):
+			catpkgs[catpkg] = self.name
 		return catpkgs
 
 	def gitCheckout(self,branch="master"):
+		if gitIsCheckedOut(self.root, self.branch):
+			return
 		runShell("(cd %s; git checkout %s)" % ( self.root, self.branch ))
 
-	def gitCommit(self,message="",upstream="origin",branch=None,push=True):
-		if branch == None:
-			branch = self.branch
-		runShell("( cd %s; git add . )" % self.root )
-		cmd = "( cd %s; [ -n \"$(git status --porcelain)\" ] && git commit -a -F - << EOF || exit 0\n" % self.root
+	def snapshot(self, rev=None):
+		# return a read-only TreeSnapshot of rev (by default, whatever is checked out now). Release it when done.
+		return worktree_pool.acquire(self, rev if rev else "HEAD")
+
+	def revision(self, rev=None):
+		# return a TreeRevision of rev, which (unlike snapshot()) doesn't check anything out.
+		rev = rev if rev else "HEAD"
+		sha = gitRevParse(self.root, rev)
+		if sha == None and re.match("^[0-9a-f]{40}$", rev) and self.fetchCommit(rev):
+			sha = gitRevParse(self.root, rev)
+		if sha == None:
+			print("Error: can't resolve %s in %s." % ( rev, self.root ))
+			sys.exit(1)
+		return TreeRevision(self, sha)
+
+	def commitMessage(self, message=""):
+		msg = ""
 		if message != "":
-			cmd += "%s\n\n" % message
+			msg += "%s\n\n" % message
 		names = []
 		if len(self.merged):
-			cmd += "merged: \n\n"
+			msg += "merged: \n\n"
 			for name, sha1 in self.merged:
 				if name in names:
 					# don't print dups
 					continue
 				names.append(name)
 				if sha1 != None:
-					cmd += "  %s: %s\n" % ( name, sha1 )
-		cmd += "EOF\n"
-		cmd += ")\n"
-		print("running: %s" % cmd)
-		# we use os.system because this multi-line command breaks runShell() - really, breaks commands.getstatusoutput().
-		retval = os.system(cmd)
-		if retval != 0:
-			print("Commit failed.")
-			sys.exit(1)
+					msg += "  %s: %s\n" % ( name, sha1 )
+		return msg
+
+	def recordVerbatim(self, catpkg, src_root, src_sha, src_path):
+		# record that catpkg was just copied unmodified from src_path in commit src_sha of the clean git tree at src_root.
+		self.verbatim[catpkg] = (src_root, src_sha, src_path)
+
+	def blobSignatureFile(self):
+		return os.path.join(self.root, ".git", "merge-utils-blobs.json")
+
+	def knownBlobs(self, alternates):
+
+		"""
+		Return {path: (mode, blob SHA1, signature)} for the files in the tree whose blob is known without reading them:
+		files copied verbatim from a git tree (see recordVerbatim()) whose size, type and mtime still match the source
+		file, and files committed this way before whose lstat signature (including ctime and inode) hasn't changed since.
+		The object directories of the source repos the blobs come from are appended to the list alternates.
+		"""
+
+		known = {}
+		def signature(st):
+			return [ st.st_mode, st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino ]
+		try:
+			with open(self.blobSignatureFile(), "r") as f:
+				saved = json.load(f)
+		except (IOError, ValueError):
+			saved = {}
+		for path, (mode, blob, sig) in saved.items():
+			try:
+				st = os.lstat(os.path.join(self.root, path))
+			except OSError:
+				continue
+			if signature(st) == sig:
+				known[path] = (mode, blob, sig)
+		sources = {}
+		for catpkg, (src_root, src_sha, src_path) in self.verbatim.items():
+			sources.setdefault((src_root, src_sha), []).append((catpkg, src_path))
+		for (src_root, src_sha), catpkgs in sources.items():
+			if gitRevParse(src_root) != src_sha or gitChangedPaths(src_root, src_sha) != set():
+				# the source tree has moved on, so its files no longer tell us anything about its blobs:
+				continue
+			objects = os.path.realpath(os.path.join(src_root, gitOutput(src_root, ["rev-parse", "--git-common-dir"]).strip(), "objects"))
+			if objects not in alternates:
+				alternates.append(objects)
+			blobs = gitTreeBlobs(src_root, src_sha, [ src_path for catpkg, src_path in catpkgs ])
+			prefixes = dict((src_path + "/", catpkg) for catpkg, src_path in catpkgs)
+			for src_file, (mode, blob) in blobs.items():
+				src_dir = src_file
+				while "/" in src_dir and src_dir + "/" not in prefixes:
+					src_dir = src_dir.rsplit("/", 1)[0]
+				if src_dir + "/" not in prefixes:
+					continue
+				path = prefixes[src_dir + "/"] + src_file[len(src_dir):]
+				try:
+					st = os.lstat(os.path.join(self.root, path))
+					src_st = os.lstat(os.path.join(src_root, src_file))
+				except OSError:
+					continue
+				if (st.st_mode, st.st_size, st.st_mtime_ns) == (src_st.st_mode, src_st.st_size, src_st.st_mtime_ns):
+					known[path] = (mode, blob, signature(st))
+		return known
+
+	def copyObjects(self, commit, parent, alternates):
+		# copy the objects of commit that this repo only has in the object directories in alternates, so that it doesn't
+		# depend on the source repos once we're done:
+		env = dict(os.environ, GIT_ALTERNATE_OBJECT_DIRECTORIES=":".join(alternates))
+		args = ["rev-list", "--objects", commit]
+		if parent != None:
+			args += ["--not", parent]
+		shas = [ line.split()[0] for line in gitOutput(self.root, args, env=env).splitlines() ]
+		out = gitOutput(self.root, ["cat-file", "--batch-check"], input="".join(sha + "\n" for sha in shas))
+		missing = [ line.split()[0] for line in out.splitlines() if line.endswith(" missing") ]
+		if len(missing):
+			gitOutput(self.root, ["pack-objects", "-q", os.path.join(self.root, ".git", "objects", "pack", "pack")], env=env,
+				input="".join(sha + "\n" for sha in missing))
+
+	def gitCommitTree(self, message=""):
+
+		"""
+		Commit the tree using git plumbing. The index is built in a temporary index file: files with known blobs (see
+		knownBlobs()) are added by SHA1 without being read, the rest are picked up by "git add -A" as usual. Then the
+		tree is written and committed, and the temporary index replaces the real one. Returns False if nothing changed.
+		The source repos of the known blobs are only used as alternates while this runs; whatever the new commit needs
+		from them is copied in before HEAD is updated.
+		"""
+
+		git_dir = os.path.join(self.root, ".git")
+		index = os.path.join(git_dir, "index.merge-utils")
+		if os.path.exists(os.path.join(git_dir, "index")):
+			shutil.copyfile(os.path.join(git_dir, "index"), index)
+		elif os.path.exists(index):
+			os.unlink(index)
+		env = dict(os.environ, GIT_INDEX_FILE=index)
+		alternates = []
+		known = self.knownBlobs(alternates)
+		if len(alternates):
+			env["GIT_ALTERNATE_OBJECT_DIRECTORIES"] = ":".join(alternates)
+		paths = sorted(known.keys())
+		if len(paths):
+			gitOutput(self.root, ["update-index", "--add", "--index-info"], env=env,
+				input="".join("%s %s\t%s\n" % ( known[path][0], known[path][1], path ) for path in paths))
+			# keep "git add" from hashing these files again:
+			gitOutput(self.root, ["update-index", "--assume-unchanged", "-z", "--stdin"], env=env, input="\0".join(paths) + "\0")
+		gitOutput(self.root, ["add", "-A", "."], env=env)
+		if len(paths):
+			gitOutput(self.root, ["update-index", "--no-assume-unchanged", "-z", "--stdin"], env=env, input="\0".join(paths) + "\0")
+		tree = gitOutput(self.root, ["write-tree"], env=env).strip()
+		parent = gitRevParse(self.root)
+		changed = parent == None or tree != gitOutput(self.root, ["rev-parse", parent + "^{tree}"]).strip()
+		if changed:
+			args = ["commit-tree", tree]
+			if parent != None:
+				args += ["-p", parent]
+			commit = gitOutput(self.root, args, input=self.commitMessage(message), env=env).strip()
+			if len(alternates):
+				self.copyObjects(commit, parent, alternates)
+			update = ["update-ref", "-m", "commit: merge-utils", "HEAD", commit]
+			if parent != None:
+				update.append(parent)
+			gitOutput(self.root, update)
+			print("Committed %s (%s files added by SHA1)" % ( commit, len(paths) ))
+		os.replace(index, os.path.join(git_dir, "index"))
+		with open(self.blobSignatureFile() + ".tmp", "w") as f:
+			json.dump(known, f)
+		os.replace(self.blobSignatureFile() + ".tmp", self.blobSignatureFile())
+		self.verbatim = {}
+		return changed
+
+	def gitCommit(self,message="",upstream="origin",branch=None,push=True):
+		if branch == None:
+			branch = self.branch
+		if len(self.verbatim) or os.path.exists(self.blobSignatureFile()):
+			self.gitCommitTree(message)
+		else:
+			runShell("( cd %s; git add . )" % self.root )
+			cmd = "( cd %s; [ -n \"$(git status --porcelain)\" ] && git commit -a -F - << EOF || exit 0\n" % self.root
+			cmd += self.commitMessage(message)
+			cmd += "EOF\n"
+			cmd += ")\n"
+			print("running: %s" % cmd)
+			# we use os.system because this multi-line command breaks runShell() - really, breaks commands.getstatusoutput().
+			with traceSubprocess("git commit"):
+				retval = os.system(cmd)
+			if retval != 0:
+				print("Commit failed.")
+				sys.exit(1)
 		if branch != False and push == True:
 			runShell("(cd %s; git push %s %s)" % ( self.root, upstream, branch ))
 		else:	 
@@ -738,8 +2481,17 @@ class GitTree(Tree):
 		print("Starting run")
 		for step in steps:
 			if step != None:
-				print("Running step", step.__class__.__name__)
-				step.run(self)
+				with tracer.span(step.__class__.__name__, "step", tree=self.name):
+					key = step.cacheKey(self) if self.step_cache != None else None
+					if key != None:
+						outputs = self.step_cache.lookup(self, step, key)
+						if outputs != None and self.step_cache.replay(self, outputs):
+							print("Replayed step", step.__class__.__name__)
+							continue
+					print("Running step", step.__class__.__name__)
+					step.run(self)
+					if key != None:
+						self.step_cache.record(self, step, key)
 
 	def head(self):
 		if self.commit:
@@ -800,14 +2552,113 @@ class CvsTree(Tree):
 
 regextype = type(re.compile('hello, world'))
 
+class PackageMatcher(object):
+
+	"""
+	PackageMatcher compiles a select/skip specification once, so that matching a name (usually a catpkg) against it
+	doesn't involve scanning lists. A specification can be:
+
+	True or "all": matches everything.
+	a list (or set/tuple) of names and "cat/*" wildcards, optionally mixed with compiled regexes: exact names go in a
+		set, wildcard categories in another set, and all regexes are combined into a single alternation (unless
+		they use backreferences, named groups or differing flags, in which case they are tried one by one.)
+	a compiled regex: matches what the regex matches (using match(), so anchored at the start.)
+
+	Anything else (such as None) matches nothing, unless default is True.
+	"""
+
+	def __init__(self, spec, default=False):
+		self.all = False
+		self.exact = set()
+		self.cats = set()
+		self.regexes = []
+		self.regex = None
+		if spec is True or spec == "all":
+			self.all = True
+		elif isinstance(spec, (list, tuple, set, frozenset)):
+			for item in spec:
+				if isinstance(item, regextype):
+					self.regexes.append(item)
+				elif item.endswith("/*"):
+					self.cats.add(item[:-2])
+				else:
+					self.exact.add(item)
+		elif isinstance(spec, regextype):
+			self.regexes.append(spec)
+		else:
+			self.all = default
+		if len(self.regexes) == 1:
+			self.regex = self.regexes[0]
+		elif len(self.regexes) > 1:
+			self.regex = self.combine(self.regexes)
+
+	@staticmethod
+	def combine(regexes):
+		# return a single regex matching what any of regexes match, or None if they can't be combined safely:
+		flags = set(r.flags for r in regexes)
+		if len(flags) != 1:
+			return None
+		for r in regexes:
+			if r.groupindex or re.search(r'\\[1-9]|\(\?P=', r.pattern):
+				return None
+		try:
+			return re.compile("|".join("(?:%s)" % r.pattern for r in regexes), flags.pop())
+		except re.error:
+			return None
+
+	def match(self, name):
+		if self.all or name in self.exact:
+			return True
+		if self.cats and name.split("/", 1)[0] in self.cats:
+			return True
+		if self.regex != None:
+			return self.regex.match(name) != None
+		for r in self.regexes:
+			if r.match(name):
+				return True
+		return False
+
+	def hits(self, names):
+
+		"""
+		Return a dict mapping each name, "cat/*" wildcard and regex of the specification to the number of names
+		it matches.
+		"""
+
+		names = list(names)
+		out = {}
+		for name in self.exact:
+			out[name] = 0
+		for cat in self.cats:
+			out[cat + "/*"] = 0
+		for name in names:
+			if name in self.exact:
+				out[name] += 1
+			cat = name.split("/", 1)[0]
+			if cat in self.cats:
+				out[cat + "/*"] += 1
+		for r in self.regexes:
+			out[r] = len([ name for name in names if r.match(name) ])
+		return out
+
 class InsertFilesFromSubdir(MergeStep):
 
-	def __init__(self,srctree,subdir,suffixfilter=None,select="all",skip=None):
+	"""
+	Copy files from subdir of srctree to the same subdir of the destination tree. If restrict is specified, selected
+	files that are not in restrict are only copied if they don't exist in the destination yet. After run(), selected
+	contains the paths (relative to the tree root) of all selected files, whether copied or not.
+	"""
+
+	def __init__(self,srctree,subdir,suffixfilter=None,select="all",skip=None,restrict=None):
 		self.subdir = subdir
 		self.suffixfilter = suffixfilter
 		self.select = select
 		self.srctree = srctree
 		self.skip = skip 
+		self.restrict = restrict
+		self.selected = set()
+		self.select_matcher = PackageMatcher(select, default=True)
+		self.skip_matcher = PackageMatcher(skip)
 
 	def run(self,desttree):
 		desttree.logTree(self.srctree)
@@ -822,29 +2673,25 @@ class InsertFilesFromSubdir(MergeStep):
 		for e in os.listdir(src):
 			if self.suffixfilter and not e.endswith(self.suffixfilter):
 				continue
-			if isinstance(self.select, list):
-				if e not in self.select:
-					continue
-			elif isinstance(self.select, regextype):
-				if not self.select.match(e):
-					continue
-			if isinstance(self.skip, list):
-				if e in self.skip:
-					continue
-			elif isinstance(self.skip, regextype):
-				if self.skip.match(e):
-					continue
-			runShell("cp -a %s/%s %s" % ( src, e, dst))
+			if not self.select_matcher.match(e) or self.skip_matcher.match(e):
+				continue
+			self.selected.add(os.path.join(self.subdir, e))
+			if self.restrict != None and e not in self.restrict and os.path.lexists(os.path.join(dst, e)):
+				continue
+			if os.path.isdir(os.path.join(src, e)) and not os.path.islink(os.path.join(src, e)):
+				copyTree(os.path.join(src, e), os.path.join(dst, e), getattr(desttree, "link_mode", None))
+			else:
+				copyFile(os.path.join(src, e), os.path.join(dst, e), link_mode=getattr(desttree, "link_mode", None))
 
 class InsertEclasses(InsertFilesFromSubdir):
 
-	def __init__(self,srctree,select="all",skip=None):
-		InsertFilesFromSubdir.__init__(self,srctree,"eclass",".eclass",select=select,skip=skip)
+	def __init__(self,srctree,select="all",skip=None,restrict=None):
+		InsertFilesFromSubdir.__init__(self,srctree,"eclass",".eclass",select=select,skip=skip,restrict=restrict)
 
 class InsertLicenses(InsertFilesFromSubdir):
 
-	def __init__(self,srctree,select="all",skip=None):
-		InsertFilesFromSubdir.__init__(self,srctree,"licenses",select=select,skip=skip)
+	def __init__(self,srctree,select="all",skip=None,restrict=None):
+		InsertFilesFromSubdir.__init__(self,srctree,"licenses",select=select,skip=skip,restrict=restrict)
 
 class CreateCategories(MergeStep):
 
@@ -853,20 +2700,22 @@ class CreateCategories(MergeStep):
 
 	def run(self,desttree):
 		catset = set()
+		listing = TreeListing(desttree.root)
 		with open(self.srctree.root + "/profiles/categories", "r") as f:
 			cats = f.read().split()
 			for cat in cats:
-				if os.path.isdir(desttree.root + "/" + cat):
+				if listing.isdir(cat):
 					catset.add(cat)
 			if not os.path.exists(desttree.root + "/profiles"):
 				os.makedirs(desttree.root + "/profiles")
-			with open(desttree.root + "/profiles/categories", "w") as g:
+			with openForWrite(desttree.root + "/profiles/categories", "w") as g:
 				for cat in sorted(list(catset)):
 					g.write(cat+"\n")
 
 class ZapMatchingEbuilds(MergeStep):
 	def __init__(self,srctree,select="all",branch=None):
 		self.select = select
+		self.select_matcher = PackageMatcher(select, default=True)
 		self.srctree = srctree
 		if branch != None:
 			# Allow dynamic switching to different branches/commits to grab things we want:
@@ -883,15 +2732,18 @@ class ZapMatchingEbuilds(MergeStep):
 
 		# Our main loop:
 		print( "# Zapping builds from %s" % desttree.root )
-		for cat in os.listdir(desttree.root):
+		src_listing = getTreeListing(self.srctree.root, getattr(self.srctree, "sha", None))
+		dest_listing = TreeListing(desttree.root)
+		for cat in dest_listing.listdir():
 			if cat not in dest_cat_set:
 				continue
-			src_catdir = os.path.join(self.srctree.root,cat)
-			if not os.path.isdir(src_catdir):
+			if not src_listing.isdir(cat):
 				continue
-			for src_pkg in os.listdir(src_catdir):
+			for src_pkg in src_listing.listdir(cat):
+				if not self.select_matcher.match(cat + "/" + src_pkg):
+					continue
 				dest_pkgdir = os.path.join(desttree.root,cat,src_pkg)
-				if not os.path.exists(dest_pkgdir):
+				if not dest_listing.exists(cat + "/" + src_pkg):
 					# don't need to zap as it doesn't exist
 					continue
 				runShell("rm -rf %s" % dest_pkgdir)
@@ -931,15 +2783,29 @@ class InsertEbuilds(MergeStep):
 	categories: Categories to process. 
 		categories to process for inserting ebuilds. Defaults to all categories in tree, using
 		profiles/categories and all dirs with "-" in them and "virtuals" as sources.
-	
+
+	workers: Number of threads used to copy catpkgs. Defaults to copy_workers.
+
+	restrict: Catpkgs to update. Default = None.
+		If set to a collection of catpkgs, selected catpkgs that are not in it are only copied if
+		they don't exist in the destination tree yet. This is used for incremental updates, where
+		restrict holds the catpkgs that changed since the destination tree was last generated.
+		After run(), the selected attribute contains all selected catpkgs, whether copied or not.
 	
 	"""
-	def __init__(self,srctree,select="all",skip=None,replace=False,merge=None,categories=None,ebuildloc=None,branch=None,catpkg_dict=None):
+	def __init__(self,srctree,select="all",skip=None,replace=False,merge=None,categories=None,ebuildloc=None,branch=None,catpkg_dict=None,workers=None,restrict=None):
+		self.workers = workers
+		self.restrict = restrict
+		self.selected = set()
 		self.select = select
 		self.skip = skip
 		self.srctree = srctree
 		self.replace = replace
 		self.merge = merge
+		self.select_matcher = PackageMatcher(select, default=True)
+		self.skip_matcher = PackageMatcher(skip)
+		self.replace_matcher = PackageMatcher(replace)
+		self.merge_matcher = PackageMatcher(merge)
 		self.categories = categories
 		self.catpkg_dict = catpkg_dict
 		if self.catpkg_dict == None:
@@ -953,16 +2819,19 @@ class InsertEbuilds(MergeStep):
 
 	def __repr__(self):
 		if self.select:
-			return "<InsertEbuilds: %s>" % " ".join(self.select) if type(self.select) == list else ""
+			return "<InsertEbuilds: %s>" % " ".join(x.pattern if isinstance(x, regextype) else x for x in self.select) if type(self.select) == list else ""
 		else:
 			return "<InsertEbuilds>"
 
 	def run(self,desttree):
 		if self.ebuildloc:
 			srctree_root = self.srctree.root + "/" + self.ebuildloc
+			prefix = self.ebuildloc.strip("/") + "/"
 		else:
 			srctree_root = self.srctree.root
+			prefix = ""
 		desttree.logTree(self.srctree)
+		listing = getTreeListing(self.srctree.root, getattr(self.srctree, "sha", None))
 		# Figure out what categories to process:
 		src_cat_path = os.path.join(srctree_root, "profiles/categories")
 		dest_cat_path = os.path.join(desttree.root, "profiles/categories")
@@ -976,10 +2845,10 @@ class InsertEbuilds(MergeStep):
 				with open(src_cat_path, "r") as f:
 					src_cat_set.update(f.read().splitlines())
 			# auto-detect additional categories:
-			cats = os.listdir(srctree_root)
+			cats = listing.listdir(prefix.rstrip("/"))
 			for cat in cats:
 				# All categories have a "-" in them and are directories:
-				if os.path.isdir(os.path.join(srctree_root,cat)):
+				if listing.isdir(prefix + cat):
 					if "-" in cat or cat == "virtual":
 						src_cat_set.add(cat)
 		if os.path.exists(dest_cat_path):
@@ -988,132 +2857,105 @@ class InsertEbuilds(MergeStep):
 		else:
 			dest_cat_set = set()
 
-		# Our main loop:
+		# Our main loop -- figure out what needs to be copied:
 		print( "# Merging in ebuilds from %s" % srctree_root )
+		jobs = []
 		for cat in src_cat_set:
 			catdir = os.path.join(srctree_root, cat)
-			if not os.path.isdir(catdir):
+			if not listing.isdir(prefix + cat):
 				# not a valid category in source overlay, so skip it
 				continue
 			#runShell("install -d %s" % catdir)
-			catall = "%s/*" % cat
-			for pkg in os.listdir(catdir):
+			for pkg in listing.listdir(prefix + cat):
 				catpkg = "%s/%s" % (cat,pkg)
 				pkgdir = os.path.join(catdir, pkg)
 				if catpkg in self.catpkg_dict:
 					#already copied
 					continue
-				if not os.path.isdir(pkgdir):
+				if not listing.isdir(prefix + catpkg):
 					# not a valid package dir in source overlay, so skip it
 					continue
-				if isinstance(self.select, list):
-					if (catall not in self.select) and (catpkg not in self.select):
-						# we have a list of pkgs to merge, and this isn't on the list, so skip:
-						continue
-				elif isinstance(self.select, regextype):
-					if not self.select.match(catpkg):
-						# no regex match:
-						continue
-				if isinstance(self.skip, list):
-					if ((catpkg in self.skip) or (catall in self.skip)):
-						# we have a list of pkgs to skip, and this catpkg is on the list, so skip:
-						continue
-				elif isinstance(self.skip, regextype):
-					if self.select.match(catpkg):
-						# regex skip match, continue
-						continue
+				if not self.select_matcher.match(catpkg):
+					# not selected, so skip:
+					continue
+				if self.skip_matcher.match(catpkg):
+					# we have been told to skip this catpkg:
+					continue
 				dest_cat_set.add(cat)
+				self.selected.add(catpkg)
 				tcatdir = os.path.join(desttree.root,cat)
 				tpkgdir = os.path.join(tcatdir,pkg)
-				copied = False
-				if self.replace == True or (isinstance(self.replace, list) and ((catpkg in self.replace) or (catall in self.replace))):
-					if not os.path.exists(tcatdir):
-						os.makedirs(tcatdir)
-					if self.merge is True or (isinstance(self.merge, list) and ((catpkg in self.merge) or (catall in self.merge)) and os.path.isdir(tpkgdir)):
+				if self.restrict != None and catpkg not in self.restrict and os.path.exists(tpkgdir):
+					# unchanged since the destination was last generated:
+					continue
+				if self.replace_matcher.match(catpkg):
+					if self.merge is True or (self.merge_matcher.match(catpkg) and os.path.isdir(tpkgdir)):
 						# We are being told to merge, and the destination catpkg dir exists... so merging is required! :)
-						# Manifests must be processed and combined:
-						try:
-							pkgdir_manifest_file = open("%s/Manifest" % pkgdir)
-							pkgdir_manifest = pkgdir_manifest_file.readlines()
-							pkgdir_manifest_file.close()
-						except IOError:
-							pkgdir_manifest = []
-						try:
-							tpkgdir_manifest_file = open("%s/Manifest" % tpkgdir)
-							tpkgdir_manifest = tpkgdir_manifest_file.readlines()
-							tpkgdir_manifest_file.close()
-						except IOError:
-							tpkgdir_manifest = []
-						entries = {
-							"AUX": {},
-							"DIST": {},
-							"EBUILD": {},
-							"MISC": {}
-						}
-						for line in tpkgdir_manifest + pkgdir_manifest:
-							if line.startswith(("AUX ", "DIST ", "EBUILD ", "MISC ")):
-								entry_type = line.split(" ")[0]
-								if entry_type in (("AUX", "DIST", "EBUILD", "MISC")):
-									entries[entry_type][line.split(" ")[1]] = line
-						runShell("cp -a %s %s" % (pkgdir, os.path.dirname(tpkgdir)))
-						merged_manifest_file = open("%s/Manifest" % tpkgdir, "w")
-						for entry_type in ("AUX", "DIST", "EBUILD", "MISC"):
-							for key in sorted(entries[entry_type]):
-								merged_manifest_file.write(entries[entry_type][key])
-						merged_manifest_file.close()
+						action = "merge"
 					else:
-						runShell("rm -rf %s; cp -a %s %s" % (tpkgdir, pkgdir, tpkgdir ))
-					copied = True
+						action = "replace"
+				elif os.path.exists(tpkgdir):
+					print("# skipping %s/%s" % (cat, pkg))
+					continue
+				else:
+					action = "copy"
+				if not os.path.exists(tcatdir):
+					os.makedirs(tcatdir)
+				jobs.append((cat, pkg, pkgdir, tpkgdir, action, getattr(desttree, "link_mode", None)))
+
+		# Copy everything over using our thread pool:
+		try:
+			results = runParallel(self.insertPackage, jobs, self.workers)
+		except OSError as e:
+			print("Error inserting ebuilds from %s: %s" % (srctree_root, e))
+			sys.exit(1)
+		merge_stats = ManifestMergeStats()
+		for stats in results:
+			if stats != None:
+				merge_stats.add(stats)
+		if merge_stats.manifests:
+			print("# %s" % merge_stats)
+
+		for cat, pkg, pkgdir, tpkgdir, action, link_mode in jobs:
+			# log each copied catpkg:
+			cpv = "/".join(tpkgdir.split("/")[-2:])
+			logMerge(cpv)
+			if hasattr(desttree, "recordVerbatim"):
+				# let the commit pick up blobs straight from the source repo where it can:
+				if action != "merge" and listing.sha != None:
+					desttree.recordVerbatim(cat + "/" + pkg, self.srctree.root, listing.sha, prefix + cat + "/" + pkg)
 				else:
-					if not os.path.exists(tpkgdir):
-						copied = True
-					if not os.path.exists(tcatdir):
-						os.makedirs(tcatdir)
-					runShell("[ ! -e %s ] && cp -a %s %s || echo \"# skipping %s/%s\"" % (tpkgdir, pkgdir, tpkgdir, cat, pkg ))
-				if copied:
-					# log XML here.
-					cpv = "/".join(tpkgdir.split("/")[-2:])
-					mergeLog.write("%s\n" % cpv)
-				# Record source tree of each copied catpkg to XML for later importing...
-					if desttree.xml_out != None:
-						catxml = desttree.xml_out.find("packages/category[@name='%s']" % cat)
-						if catxml == None:
-							catxml = etree.Element("category", name=cat)
-							desttree.xml_out.append(catxml)
-						pkgxml = desttree.xml_out.find("packages/category[@name='%s']/package/[@name='%s']" % ( cat ,pkg ))
-						#remove existing
-						if pkgxml != None:
-							pkgxml.getparent().remove(pkgxml)
-						pkgxml = etree.Element("package", name=pkg, repository=self.srctree.name)
-						doMeta = True
-						try:
-							tpkgmeta = open("%s/metadata.xml" % tpkgdir, 'rb')
-							try:
-								metatree=etree.parse(tpkgmeta)
-							except UnicodeDecodeError:
-								doMeta = false
-							tpkgmeta.close()
-							if doMeta:
-								use_vars = []
-								usexml = etree.Element("use")
-								for el in metatree.iterfind('.//flag'):
-									name = el.get("name")
-									if name != None:
-										flag = etree.Element("flag")
-										flag.attrib["name"] = name
-										flag.text = etree.tostring(el, method="text").strip()
-										usexml.append(flag)
-								pkgxml.attrib["use"] = ",".join(use_vars)
-								pkgxml.append(usexml)
-						except IOError:
-							pass
-						catxml.append(pkgxml)
+					desttree.verbatim.pop(cat + "/" + pkg, None)
+
+		# Record source tree of each copied catpkg to XML for later importing...
+		if desttree.xml_out != None:
+			use_flags = getUseFlags([ "%s/metadata.xml" % job[3] for job in jobs ])
+			for cat, pkg, pkgdir, tpkgdir, action, link_mode in jobs:
+				desttree.xml_out.record(cat, pkg, self.srctree.name, use_flags["%s/metadata.xml" % tpkgdir])
 
 		if os.path.isdir(os.path.dirname(dest_cat_path)):
 			# only write out if profiles/ dir exists -- it doesn't with shards.
-			with open(dest_cat_path, "w") as f:
+			with openForWrite(dest_cat_path, "w") as f:
 				f.write("\n".join(sorted(dest_cat_set)))
 
+	def insertPackage(self, job):
+		cat, pkg, pkgdir, tpkgdir, action, link_mode = job
+		if action == "merge":
+			# Manifests must be processed and combined. Grab the destination entries before they are overwritten:
+			stats = ManifestMergeStats()
+			entries = readManifest("%s/Manifest" % tpkgdir)
+			mergeManifest(entries, "%s/Manifest" % pkgdir, stats)
+			copyTree(pkgdir, tpkgdir, link_mode)
+			writeManifest("%s/Manifest" % tpkgdir, entries)
+			return stats
+		else:
+			if action == "replace":
+				if os.path.isdir(tpkgdir) and not os.path.islink(tpkgdir):
+					shutil.rmtree(tpkgdir)
+				elif os.path.lexists(tpkgdir):
+					os.unlink(tpkgdir)
+			copyTree(pkgdir, tpkgdir, link_mode)
+
 class ProfileDepFix(MergeStep):
 
 	"ProfileDepFix undeprecates profiles marked as deprecated."
@@ -1167,6 +3009,7 @@ class GenUseLocalDesc(MergeStep):
 	"GenUseLocalDesc runs egencache to update use.local.desc"
 
 	def run(self,tree):
+		breakLink(os.path.join(tree.root, "profiles/use.local.desc"))
 		run_command(["egencache", "--update-use-local-desc", "--repo", tree.reponame if tree.reponame else tree.name, "--repositories-configuration", "[%s]\nlocation = %s" % (tree.reponame if tree.reponame else tree.name, tree.root)], abort_on_failure=False)
 
 class GitCheckout(MergeStep):
@@ -1175,6 +3018,8 @@ class GitCheckout(MergeStep):
 		self.branch = branch
 
 	def run(self,tree):
+		if gitIsCheckedOut(tree.root, self.branch):
+			return
 		runShell("( cd %s; git checkout %s )" % ( tree.root, self.branch ))
 
 class CreateBranch(MergeStep):
@@ -1188,10 +3033,62 @@ class CreateBranch(MergeStep):
 
 class Minify(MergeStep):
 
-	"Minify removes ChangeLogs and shrinks Manifests."
+	"""
+	Minify removes ChangeLogs and shrinks Manifests down to their DIST lines. The tree is walked once, with each
+	top-level directory handled by a thread from our pool, and Manifests are only rewritten if they actually
+	lose lines. Like the sed -n '/DIST/p' this replaces, any line containing "DIST" anywhere is kept.
+	"""
+
+	def __init__(self, workers=None):
+		self.workers = workers
+
+	def minifyManifest(self, path, st):
+		# returns the number of bytes saved by shrinking this Manifest. Manifests are handled as bytes, so line
+		# endings and non-ASCII file names come through untouched whatever the locale is:
+		with open(path, "rb") as f:
+			lines = f.readlines()
+		keep = [ line for line in lines if b"DIST" in line ]
+		if len(keep) == len(lines):
+			return 0
+		# write a new file and rename it into place, like sed -i does:
+		tmp = path + ".minify-tmp"
+		with open(tmp, "wb") as f:
+			f.writelines(keep)
+		os.chmod(tmp, stat.S_IMODE(st.st_mode))
+		os.rename(tmp, path)
+		return st.st_size - os.stat(path).st_size
+
+	def minifyDir(self, path, recurse=True):
+		# returns a (changelogs removed, manifests shrunk, bytes saved) tuple for path (and everything below it if recurse):
+		changelogs = manifests = saved = 0
+		for entry in os.scandir(path):
+			if entry.is_dir(follow_symlinks=False):
+				if recurse and entry.name != ".git":
+					c, m, b = self.minifyDir(entry.path)
+					changelogs += c
+					manifests += m
+					saved += b
+				continue
+			name = entry.name.lower()
+			if name == "changelog":
+				saved += entry.stat(follow_symlinks=False).st_size
+				os.unlink(entry.path)
+				changelogs += 1
+			elif name == "manifest" and entry.is_file(follow_symlinks=False):
+				b = self.minifyManifest(entry.path, entry.stat(follow_symlinks=False))
+				if b:
+					manifests += 1
+					saved += b
+		return changelogs, manifests, saved
 
 	def run(self,tree):
-		runShell("( cd %s; find -iname ChangeLog -exec rm -f {} \; )" % tree.root )
-		runShell("( cd %s; find -iname Manifest -exec sed -n -i -e \"/DIST/p\" {} \; )" % tree.root )
+		# top-level files are handled here, and each top-level directory by a thread in the pool:
+		changelogs, manifests, saved = self.minifyDir(tree.root, recurse=False)
+		top_dirs = [ entry.path for entry in os.scandir(tree.root) if entry.is_dir(follow_symlinks=False) and entry.name != ".git" ]
+		for c, m, b in runParallel(self.minifyDir, top_dirs, self.workers):
+			changelogs += c
+			manifests += m
+			saved += b
+		print("Minify: removed %s ChangeLogs, shrank %s Manifests, saved %s bytes." % (changelogs, manifests, saved))
 
 # vim: ts=4 sw=4 noet
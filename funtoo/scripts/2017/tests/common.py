@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+# Shared setup for the merge_utils tests. Run them from funtoo/scripts/2017 with:
+#
+#   python3 -m unittest discover tests
+#
+# merge_utils needs portage (and lxml) to import, so these run on a Funtoo/Gentoo host.
+
+import os
+import sys
+import shutil
+import tempfile
+import importlib.util
+import unittest
+import subprocess
+
+scripts_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, scripts_dir)
+
+import merge_utils
+
+git_env = dict(os.environ, GIT_AUTHOR_NAME="test", GIT_AUTHOR_EMAIL="test@localhost", GIT_COMMITTER_NAME="test",
+	GIT_COMMITTER_EMAIL="test@localhost")
+
+def writeFile(path, content):
+	if not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with open(path, "wb" if isinstance(content, bytes) else "w") as f:
+		f.write(content)
+
+def readFile(path):
+	with open(path, "rb") as f:
+		return f.read()
+
+def git(root, *args):
+	out = subprocess.run(["git"] + list(args), cwd=root, env=git_env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+		universal_newlines=True)
+	if out.returncode != 0:
+		raise RuntimeError("git %s failed in %s: %s" % (" ".join(args), root, out.stderr))
+	return out.stdout.strip()
+
+def gitCommit(root, message="commit"):
+	# commit everything in root, creating the repository first if needed, and return the new HEAD.
+	if not os.path.isdir(os.path.join(root, ".git")):
+		git(root, "init", "-q")
+	git(root, "add", "-A")
+	git(root, "commit", "-q", "--allow-empty", "-m", message)
+	return git(root, "rev-parse", "HEAD")
+
+def loadScript(path, name):
+	# import one of the merge scripts as a module. Their main code is guarded by __name__ == "__main__", so nothing runs.
+	# The module is registered under name so that process pools can pickle its functions.
+	spec = importlib.util.spec_from_file_location(name, path)
+	module = importlib.util.module_from_spec(spec)
+	sys.modules[name] = module
+	spec.loader.exec_module(module)
+	return module
+
+class TreeTestCase(unittest.TestCase):
+
+	"""
+	Gives each test a scratch directory (self.tmp) and points merge_utils' caches, worktrees and log into it, so
+	tests never touch /var and don't see each other's cached state.
+	"""
+
+	settings = [ "cache_dir", "worktree_dir", "merge_log_path" ]
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp(prefix="merge-utils-test-")
+		self.saved = dict((name, getattr(merge_utils, name)) for name in self.settings)
+		merge_utils.cache_dir = os.path.join(self.tmp, "cache")
+		merge_utils.worktree_dir = os.path.join(self.tmp, "worktrees")
+		merge_utils.merge_log_path = os.path.join(self.tmp, "merge.log")
+		merge_utils.metadata_indexes.clear()
+		merge_utils.tree_listings.clear()
+
+	def tearDown(self):
+		for name, value in self.saved.items():
+			setattr(merge_utils, name, value)
+		merge_utils.metadata_indexes.clear()
+		merge_utils.tree_listings.clear()
+		shutil.rmtree(self.tmp, ignore_errors=True)
+
+	def path(self, *parts):
+		return os.path.join(self.tmp, *parts)
+
+# vim: ts=4 sw=4 noet tw=140
@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+
+import os
+import shutil
+import unittest
+
+from common import merge_utils, TreeTestCase, writeFile, gitCommit, git
+
+class GitCommitTreeTest(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		writeFile(self.path("src/cat-a/foo/foo-1.ebuild"), "EAPI=6\n")
+		writeFile(self.path("src/cat-a/foo/files/fix.patch"), "--- a\n+++ b\n")
+		self.src_sha = gitCommit(self.path("src"))
+		writeFile(self.path("dst/README"), "kit\n")
+		gitCommit(self.path("dst"))
+		git(self.path("dst"), "config", "user.name", "test")
+		git(self.path("dst"), "config", "user.email", "test@localhost")
+		self.dst = merge_utils.GitTree("dst", root=self.path("dst"))
+
+	def testVerbatimBlobsAreCopiedIn(self):
+		merge_utils.copyTree(self.path("src/cat-a/foo"), self.path("dst/cat-a/foo"))
+		self.dst.recordVerbatim("cat-a/foo", self.path("src"), self.src_sha, "cat-a/foo")
+		self.assertTrue(self.dst.gitCommitTree("merge"))
+		self.assertEqual(git(self.path("dst"), "rev-parse", "HEAD:cat-a/foo/foo-1.ebuild"), git(self.path("src"), "rev-parse", "HEAD:cat-a/foo/foo-1.ebuild"))
+		self.assertFalse(os.path.exists(self.path("dst/.git/objects/info/alternates")))
+		# the destination repo must not need the source repo any more:
+		shutil.rmtree(self.path("src"))
+		git(self.path("dst"), "fsck", "--strict")
+		self.assertEqual(git(self.path("dst"), "cat-file", "-p", "HEAD:cat-a/foo/files/fix.patch"), "--- a\n+++ b")
+		self.assertEqual(git(self.path("dst"), "status", "--porcelain"), "")
+
+	def testNothingChanged(self):
+		merge_utils.copyTree(self.path("src/cat-a/foo"), self.path("dst/cat-a/foo"))
+		self.dst.recordVerbatim("cat-a/foo", self.path("src"), self.src_sha, "cat-a/foo")
+		self.dst.gitCommitTree("merge")
+		head = git(self.path("dst"), "rev-parse", "HEAD")
+		self.assertFalse(self.dst.gitCommitTree("merge"))
+		self.assertEqual(git(self.path("dst"), "rev-parse", "HEAD"), head)
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+import os
+import unittest
+
+from common import merge_utils, TreeTestCase, writeFile, readFile, gitCommit
+
+class CopyTreeTest(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		self.src = self.path("src")
+		writeFile(self.path("src/cat-a/foo/foo-1.ebuild"), "EAPI=6\n")
+		writeFile(self.path("src/cat-a/foo/files/fix.patch"), b"\x00binary\xff\n")
+		writeFile(self.path("src/cat-a/foo/Manifest"), "DIST foo-1.tar.gz 1 SHA256 aa\n")
+		os.chmod(self.path("src/cat-a/foo/files/fix.patch"), 0o600)
+		os.symlink("foo-1.ebuild", self.path("src/cat-a/foo/foo-9999.ebuild"))
+		os.utime(self.path("src/cat-a/foo/foo-1.ebuild"), (1000000000, 1000000000))
+
+	def assertSameTree(self, src, dst):
+		for dirpath, dirnames, filenames in os.walk(src):
+			rel = os.path.relpath(dirpath, src)
+			for fn in filenames:
+				s = os.path.join(dirpath, fn)
+				d = os.path.join(dst, rel, fn)
+				if os.path.islink(s):
+					self.assertEqual(os.readlink(s), os.readlink(d))
+					continue
+				self.assertEqual(readFile(s), readFile(d), d)
+				self.assertEqual(os.stat(s).st_mode, os.stat(d).st_mode, d)
+				self.assertEqual(os.stat(s).st_mtime_ns, os.stat(d).st_mtime_ns, d)
+
+	def testCopy(self):
+		merge_utils.copyTree(self.src, self.path("dst"))
+		self.assertSameTree(self.src, self.path("dst"))
+		self.assertTrue(os.path.islink(self.path("dst/cat-a/foo/foo-9999.ebuild")))
+		self.assertNotEqual(os.stat(self.path("src/cat-a/foo/foo-1.ebuild")).st_ino,
+			os.stat(self.path("dst/cat-a/foo/foo-1.ebuild")).st_ino)
+
+	def testCopyMergesOntoExistingTree(self):
+		writeFile(self.path("dst/cat-a/foo/foo-0.ebuild"), "old\n")
+		writeFile(self.path("dst/cat-a/foo/foo-1.ebuild"), "stale\n")
+		merge_utils.copyTree(self.src, self.path("dst"))
+		self.assertSameTree(self.src, self.path("dst"))
+		self.assertEqual(readFile(self.path("dst/cat-a/foo/foo-0.ebuild")), b"old\n")
+
+	def testCopyReplacesSymlinkWithoutFollowingIt(self):
+		writeFile(self.path("elsewhere"), "precious\n")
+		os.makedirs(self.path("dst/cat-a/foo"))
+		os.symlink(self.path("elsewhere"), self.path("dst/cat-a/foo/foo-1.ebuild"))
+		merge_utils.copyTree(self.src, self.path("dst"))
+		self.assertEqual(readFile(self.path("elsewhere")), b"precious\n")
+		self.assertFalse(os.path.islink(self.path("dst/cat-a/foo/foo-1.ebuild")))
+
+	def testHardlink(self):
+		merge_utils.copyTree(self.src, self.path("dst"), link_mode="hardlink")
+		self.assertSameTree(self.src, self.path("dst"))
+		self.assertEqual(os.stat(self.path("src/cat-a/foo/foo-1.ebuild")).st_ino,
+			os.stat(self.path("dst/cat-a/foo/foo-1.ebuild")).st_ino)
+
+	def testReflinkFallsBackToCopy(self):
+		# most test filesystems can't clone -- either way the result must be an independent copy:
+		merge_utils.copyTree(self.src, self.path("dst"), link_mode="reflink")
+		self.assertSameTree(self.src, self.path("dst"))
+		self.assertNotEqual(os.stat(self.path("src/cat-a/foo/foo-1.ebuild")).st_ino,
+			os.stat(self.path("dst/cat-a/foo/foo-1.ebuild")).st_ino)
+
+class BreakLinkTest(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		writeFile(self.path("src/Manifest"), "DIST a 1 SHA256 aa\n")
+		merge_utils.copyTree(self.path("src"), self.path("dst"), link_mode="hardlink")
+		self.assertEqual(os.stat(self.path("dst/Manifest")).st_nlink, 2)
+
+	def testBreakLinkKeepsContents(self):
+		merge_utils.breakLink(self.path("dst/Manifest"))
+		self.assertEqual(os.stat(self.path("dst/Manifest")).st_nlink, 1)
+		self.assertEqual(os.stat(self.path("src/Manifest")).st_nlink, 1)
+		self.assertEqual(readFile(self.path("dst/Manifest")), b"DIST a 1 SHA256 aa\n")
+		self.assertFalse(os.path.exists(self.path("dst/Manifest.merge-tmp")))
+
+	def testBreakLinkWithoutKeep(self):
+		merge_utils.breakLink(self.path("dst/Manifest"), keep=False)
+		self.assertFalse(os.path.exists(self.path("dst/Manifest")))
+		self.assertEqual(readFile(self.path("src/Manifest")), b"DIST a 1 SHA256 aa\n")
+
+	def testBreakLinkLeavesPrivateFilesAlone(self):
+		writeFile(self.path("dst/private"), "x\n")
+		ino = os.stat(self.path("dst/private")).st_ino
+		merge_utils.breakLink(self.path("dst/private"))
+		merge_utils.breakLink(self.path("dst/missing"))
+		self.assertEqual(os.stat(self.path("dst/private")).st_ino, ino)
+
+	def testWritesDontReachTheSourceTree(self):
+		with merge_utils.openForWrite(self.path("dst/Manifest"), "a") as f:
+			f.write("DIST b 2 SHA256 bb\n")
+		self.assertEqual(readFile(self.path("src/Manifest")), b"DIST a 1 SHA256 aa\n")
+		self.assertEqual(readFile(self.path("dst/Manifest")), b"DIST a 1 SHA256 aa\nDIST b 2 SHA256 bb\n")
+
+class InsertEbuildsTest(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		for count in range(20):
+			writeFile(self.path("src/cat-a/pkg%s/pkg%s-1.ebuild" % (count, count)), "EAPI=6\n")
+			writeFile(self.path("src/cat-a/pkg%s/files/fix-%s.patch" % (count, count)), "patch %s\n" % count)
+		writeFile(self.path("src/profiles/categories"), "cat-a\n")
+		gitCommit(self.path("src"))
+		self.srctree = merge_utils.Tree("src", self.path("src"))
+
+	def insert(self, name, workers):
+		writeFile(self.path(name, "profiles/categories"), "")
+		gitCommit(self.path(name))
+		step = merge_utils.InsertEbuilds(self.srctree, select="all", workers=workers)
+		merge_utils.GitTree(name, root=self.path(name)).run([ step ])
+		return step
+
+	def testParallelCopyMatchesSerialCopy(self):
+		self.insert("serial", 1)
+		step = self.insert("parallel", 8)
+		self.assertEqual(len(step.selected), 20)
+		CopyTreeTest.assertSameTree(self, self.path("serial/cat-a"), self.path("parallel/cat-a"))
+		CopyTreeTest.assertSameTree(self, self.path("src/cat-a"), self.path("parallel/cat-a"))
+		self.assertEqual(readFile(self.path("parallel/profiles/categories")), b"cat-a")
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+
+import unittest
+from unittest import mock
+
+from common import merge_utils, TreeTestCase, writeFile, gitCommit
+from test_metadata_index import FakePortdb
+
+# a -> b -> c -> d, with a cycle c -> a and a second path a -> e -> d:
+edges = {
+	"cat/a" : [ "cat/b", "cat/e" ],
+	"cat/b" : [ "cat/c" ],
+	"cat/c" : [ "cat/d", "cat/a" ],
+	"cat/d" : [],
+	"cat/e" : [ "cat/d" ],
+}
+
+class DependencyClosureTest(unittest.TestCase):
+
+	def setUp(self):
+		self.graph = merge_utils.DependencyGraph(None)
+		self.graph.adjacency = dict((cp, frozenset(deps)) for cp, deps in edges.items())
+
+	def testDirectDependencies(self):
+		self.assertEqual(self.graph.closure("cat/a"), { "cat/b", "cat/e" })
+		self.assertEqual(self.graph.closure("cat/d"), set())
+
+	def testLevels(self):
+		self.assertEqual(self.graph.closure("cat/a", levels=1), { "cat/b", "cat/e", "cat/c", "cat/d" })
+		self.assertEqual(self.graph.closure("cat/b", levels=1), { "cat/c", "cat/d", "cat/a" })
+
+	def testFullClosureTerminatesOnCycles(self):
+		# the root shows up as its own dependency through the cycle, as it would with repeated expansion:
+		self.assertEqual(self.graph.closure("cat/a", levels=None), set(edges.keys()))
+		self.assertEqual(self.graph.closure("cat/c", levels=None), set(edges.keys()))
+
+	def testClosuresAreMemoized(self):
+		self.graph.closure("cat/a", levels=None)
+		with mock.patch.object(self.graph, "deps") as deps:
+			self.assertEqual(self.graph.closure("cat/a", levels=None), set(edges.keys()))
+			self.assertEqual(deps.call_count, 0)
+
+class GetDependenciesTest(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		self.root = self.path("repo")
+		writeFile(self.path("repo/cat-a/foo/foo-1.ebuild"), 'DEPEND="cat-b/bar"\nRDEPEND="!cat-b/old cat-b/baz"\n')
+		writeFile(self.path("repo/cat-b/bar/bar-1.ebuild"), 'DEPEND="cat-b/baz"\n')
+		writeFile(self.path("repo/cat-b/baz/baz-1.ebuild"), "\n")
+		gitCommit(self.root)
+		self.tree = merge_utils.Tree("repo", self.root)
+		portdb = FakePortdb(self.root)
+		patcher = mock.patch.object(merge_utils, "getPortdb", lambda ebuild_repo, super_repo=None: portdb)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.addCleanup(merge_utils.dependency_graphs.clear)
+
+	def testBlockersAreIgnored(self):
+		self.assertEqual(merge_utils.getDependencies(self.tree, [ "cat-a/foo" ]), { "cat-b/bar", "cat-b/baz" })
+
+	def testClosuresAreDroppedWhenTheTreeMoves(self):
+		self.assertEqual(merge_utils.getDependencies(self.tree, [ "cat-b/bar" ]), { "cat-b/baz" })
+		writeFile(self.path("repo/cat-b/bar/bar-1.ebuild"), 'DEPEND="cat-a/foo"\n')
+		gitCommit(self.root)
+		self.assertEqual(merge_utils.getDependencies(self.tree, [ "cat-b/bar" ]), { "cat-a/foo" })
+		self.assertEqual(merge_utils.getDependencies(self.tree, [ "cat-b/bar" ], levels=None), { "cat-a/foo", "cat-b/bar", "cat-b/baz" })
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
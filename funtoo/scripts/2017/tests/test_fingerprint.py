@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+
+import unittest
+
+from common import merge_utils, TreeTestCase, writeFile, gitCommit
+
+class RunFingerprintTest(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		self.trees = []
+		for name in [ "staging", "overlay" ]:
+			writeFile(self.path(name, "profiles/repo_name"), name + "\n")
+			gitCommit(self.path(name))
+			self.trees.append(merge_utils.Tree(name, self.path(name)))
+		self.script = self.path("merge-script.py")
+		writeFile(self.script, "# steps\n")
+
+	def fingerprint(self):
+		return merge_utils.runFingerprint(self.trees, [ self.script ])
+
+	def testFingerprintFollowsInputs(self):
+		first = self.fingerprint()
+		self.assertEqual(self.fingerprint(), first)
+		writeFile(self.path("overlay/cat-a/foo/foo-1.ebuild"), "EAPI=6\n")
+		# uncommitted changes can't be fingerprinted:
+		self.assertEqual(self.fingerprint(), None)
+		gitCommit(self.path("overlay"))
+		second = self.fingerprint()
+		self.assertNotIn(second, [ None, first ])
+		writeFile(self.script, "# other steps\n")
+		self.assertNotIn(self.fingerprint(), [ None, first, second ])
+
+	def testUnchangedRunExitsWithCode2(self):
+		# no saved fingerprint yet:
+		merge_utils.exitIfUnchanged("staging", self.trees, [ self.script ])
+		merge_utils.saveFingerprint("staging", self.fingerprint())
+		with self.assertRaises(SystemExit) as cm:
+			merge_utils.exitIfUnchanged("staging", self.trees, [ self.script ])
+		self.assertEqual(cm.exception.code, 2)
+		# other runs have fingerprints of their own:
+		merge_utils.exitIfUnchanged("other", self.trees, [ self.script ])
+		writeFile(self.path("staging/profiles/categories"), "cat-a\n")
+		gitCommit(self.path("staging"))
+		merge_utils.exitIfUnchanged("staging", self.trees, [ self.script ])
+
+	def testDirtyTreeNeverMatches(self):
+		merge_utils.saveFingerprint("staging", None)
+		self.assertFalse(merge_utils.checkFingerprint("staging", None))
+		merge_utils.saveFingerprint("staging", self.fingerprint())
+		writeFile(self.path("staging/profiles/repo_name"), "changed\n")
+		merge_utils.exitIfUnchanged("staging", self.trees, [ self.script ])
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+import os
+import unittest
+from unittest import mock
+
+from common import merge_utils, TreeTestCase, writeFile, gitCommit, loadScript, scripts_dir
+
+gentoo_compare = loadScript(os.path.join(os.path.dirname(scripts_dir), "gentoo-compare-json.py"), "gentoo_compare_json")
+
+keywords = [ "~amd64", "amd64", "~*", "*" ]
+
+class CompareTestCase(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		self.funtoo = self.path("funtoo")
+		self.gentoo = self.path("gentoo")
+		self.addEbuild(self.funtoo, "cat-a/foo-1", "~amd64")
+		self.addEbuild(self.funtoo, "cat-a/bar-2", "amd64")
+		self.addEbuild(self.funtoo, "cat-a/baz-1", "~amd64")
+		self.addEbuild(self.funtoo, "cat-b/old-1", "~amd64")
+		# newer, newer but not keyworded for us, a revision bump, a live ebuild and something funtoo doesn't have:
+		self.addEbuild(self.gentoo, "cat-a/foo-2", "~amd64")
+		self.addEbuild(self.gentoo, "cat-a/foo-3", "~arm")
+		self.addEbuild(self.gentoo, "cat-a/bar-2-r1", "amd64")
+		self.addEbuild(self.gentoo, "cat-a/baz-9999", "")
+		self.addEbuild(self.gentoo, "cat-a/baz-1", "~amd64")
+		self.addEbuild(self.gentoo, "cat-a/qux-1", "~amd64")
+		self.addEbuild(self.gentoo, "cat-b/old-1.1", "*")
+		gentoo_compare.listings.clear()
+		self.addCleanup(gentoo_compare.listings.clear)
+
+	def addEbuild(self, root, cpv, kw):
+		cpv_split = gentoo_compare.portage.versions.catpkgsplit(cpv)
+		writeFile(os.path.join(root, cpv_split[0], cpv_split[1], cpv.split("/")[1] + ".ebuild"), 'EAPI=6\nKEYWORDS="%s"\n' % kw)
+
+class CompareCategoryTest(CompareTestCase):
+
+	def testCompareCategory(self):
+		results = gentoo_compare.compare_category((self.funtoo, self.gentoo, keywords, "cat-a", None))
+		self.assertEqual(results, [ ("cat-a/foo", [ "cat-a/foo 2 1", "cat-a/foo-2 (vs. cat-a/foo-1 in funtoo)" ]) ])
+		self.assertEqual(gentoo_compare.compare_category((self.funtoo, self.gentoo, keywords, "cat-a", [ "bar", "baz" ])), [])
+
+	def testParallelCompareMatchesCategories(self):
+		out = gentoo_compare.version_compare(self.funtoo, self.gentoo, keywords, workers=2)
+		expected = {}
+		for cat in [ "cat-a", "cat-b" ]:
+			expected.update(gentoo_compare.compare_category((self.funtoo, self.gentoo, keywords, cat, None)))
+		self.assertEqual(out, expected)
+		self.assertEqual(sorted(out.keys()), [ "cat-a/foo", "cat-b/old" ])
+
+class IncrementalCompareTest(CompareTestCase):
+
+	def setUp(self):
+		CompareTestCase.setUp(self)
+		gitCommit(self.funtoo)
+		gitCommit(self.gentoo)
+		self.trees = [ ("funtoo", self.funtoo), ("gentoo", self.gentoo) ]
+
+	def compare(self, full=False):
+		# returns (results, catpkgs passed to version_compare), the way a new run of the script would see them:
+		gentoo_compare.listings.clear()
+		with mock.patch.object(gentoo_compare, "version_compare", wraps=gentoo_compare.version_compare) as version_compare:
+			results = gentoo_compare.incremental_compare("test", self.trees, keywords, full)
+		self.assertEqual(version_compare.call_count, 1)
+		return results, version_compare.call_args[1].get("catpkgs")
+
+	def testOnlyChangedCatpkgsAreRecomputed(self):
+		results, catpkgs = self.compare()
+		self.assertEqual(catpkgs, None)
+		self.assertEqual(sorted(results.keys()), [ "cat-a/foo", "cat-b/old" ])
+		self.addEbuild(self.gentoo, "cat-a/baz-2", "~amd64")
+		os.unlink(os.path.join(self.gentoo, "cat-b/old/old-1.1.ebuild"))
+		gitCommit(self.gentoo)
+		results, catpkgs = self.compare()
+		self.assertEqual(catpkgs, { "cat-a/baz", "cat-b/old" })
+		self.assertEqual(sorted(results.keys()), [ "cat-a/baz", "cat-a/foo" ])
+		# the saved state moved on, too:
+		results, catpkgs = self.compare()
+		self.assertEqual(catpkgs, set())
+		self.assertEqual(sorted(results.keys()), [ "cat-a/baz", "cat-a/foo" ])
+
+	def testFullIgnoresTheSavedState(self):
+		self.compare()
+		self.assertEqual(self.compare()[1], set())
+		self.addEbuild(self.funtoo, "cat-a/foo-2", "~amd64")
+		gitCommit(self.funtoo)
+		results, catpkgs = self.compare(full=True)
+		self.assertEqual(catpkgs, None)
+		self.assertEqual(sorted(results.keys()), [ "cat-b/old" ])
+		# and a full run saves state for the next incremental one:
+		self.assertEqual(self.compare()[1], set())
+
+	def testUncommittedChangesAreNotSaved(self):
+		self.compare()
+		self.addEbuild(self.gentoo, "cat-a/baz-2", "~amd64")
+		results, catpkgs = self.compare()
+		self.assertEqual(catpkgs, { "cat-a/baz" })
+		# the uncommitted ebuild is picked up again by the next run, as the state still refers to the old commit:
+		results, catpkgs = self.compare()
+		self.assertEqual(catpkgs, { "cat-a/baz" })
+		self.assertIn("cat-a/baz", results)
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+
+import os
+import hashlib
+import unittest
+
+from common import merge_utils, TreeTestCase, writeFile
+
+keywords_sh = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "keywords.sh")
+
+# ebuilds the static parser handles itself, by name:
+static_ebuilds = {
+	"double" : 'EAPI=6\ninherit eutils\n\nKEYWORDS="~amd64 ~x86 arm"\nIUSE="doc"\n',
+	"single" : "EAPI=6\nKEYWORDS='amd64 x86' # stable\n",
+	"unquoted" : "EAPI=6\nKEYWORDS=~amd64;\n",
+	"exported" : 'export KEYWORDS="*"\n',
+	"empty" : 'KEYWORDS=""\n',
+	"absent" : 'EAPI=6\nSLOT="0"\n',
+}
+
+# ebuilds that need bash:
+bash_ebuilds = {
+	"variable" : 'MY_KW="~amd64"\nKEYWORDS="${MY_KW} ~x86"\n',
+	"twice" : 'KEYWORDS="~amd64"\nKEYWORDS="~x86"\n',
+	"command" : 'KEYWORDS="$(echo ~amd64)"\n',
+	"continued" : 'KEYWORDS="~amd64 \\\n\t~x86"\n',
+	"trailing" : 'KEYWORDS="~amd64" ; KEYWORDS="~x86"\n',
+	"indented" : 'src_compile() {\n\t:\n}\n\tKEYWORDS="~ppc"\n',
+}
+
+class KeywordProviderTest(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		self.portdir = self.path("portdir")
+		self.provider = merge_utils.KeywordProvider(keywords_sh)
+
+	def addEbuild(self, name, content):
+		ebuild = "cat-a/%s/%s-1.ebuild" % (name, name)
+		writeFile(os.path.join(self.portdir, ebuild), content)
+		return ebuild
+
+	def addCacheEntry(self, ebuild, keywords, md5=None):
+		cat, pkg, fn = ebuild.split("/")
+		if md5 == None:
+			with open(os.path.join(self.portdir, ebuild), "rb") as f:
+				md5 = hashlib.md5(f.read()).hexdigest()
+		writeFile(os.path.join(self.portdir, "metadata/md5-cache", cat, fn[:-7]), "EAPI=6\nKEYWORDS=%s\n_md5_=%s\n" % (keywords, md5))
+
+	def bashKeywords(self, ebuild):
+		status, output = self.provider.fromBash(self.portdir, ebuild)
+		self.assertEqual(status, 0)
+		return set(output.split())
+
+	def testStaticParserAgreesWithBash(self):
+		for name, content in static_ebuilds.items():
+			ebuild = self.addEbuild(name, content)
+			static = self.provider.fromEbuild(self.portdir, ebuild)
+			self.assertNotEqual(static, None, name)
+			self.assertEqual(static, self.bashKeywords(ebuild), name)
+
+	def testStaticParserDefersToBash(self):
+		for name, content in bash_ebuilds.items():
+			ebuild = self.addEbuild(name, content)
+			self.assertEqual(self.provider.fromEbuild(self.portdir, ebuild), None, name)
+			self.assertEqual(self.provider.getKeywords(self.portdir, ebuild), (0, self.bashKeywords(ebuild)), name)
+
+	def testCacheIsUsedWhenCurrent(self):
+		ebuild = self.addEbuild("cached", 'KEYWORDS="${KW}"\n')
+		self.addCacheEntry(ebuild, "~amd64 ~arm")
+		self.assertEqual(self.provider.getKeywords(self.portdir, ebuild), (0, { "~amd64", "~arm" }))
+		self.assertEqual(self.provider.stats, { "md5-cache" : 1, "static" : 0, "bash" : 0 })
+
+	def testStaleCacheIsIgnored(self):
+		ebuild = self.addEbuild("stale", 'KEYWORDS="~x86"\n')
+		self.addCacheEntry(ebuild, "~amd64", md5="0" * 32)
+		self.assertEqual(self.provider.getKeywords(self.portdir, ebuild), (0, { "~x86" }))
+		self.assertEqual(self.provider.stats, { "md5-cache" : 0, "static" : 1, "bash" : 0 })
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
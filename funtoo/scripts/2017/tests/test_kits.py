@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+
+import os
+import json
+import shutil
+import unittest
+from unittest import mock
+
+from common import merge_utils, TreeTestCase, writeFile, gitCommit, loadScript, scripts_dir
+
+merge_all_kits = loadScript(os.path.join(scripts_dir, "merge-all-kits.py"), "merge_all_kits")
+
+class KitTestCase(TreeTestCase):
+
+	"Sets up gentoo-staging, kit-fixups and funtoo-overlay repos, and points merge-all-kits.py at them."
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		writeFile(self.path("gentoo/profiles/categories"), "cat-a\ncat-b\n")
+		writeFile(self.path("gentoo/eclass/foo.eclass"), "# foo\n")
+		writeFile(self.path("gentoo/licenses/GPL-2"), "GPL\n")
+		writeFile(self.path("gentoo/cat-a/foo/foo-1.ebuild"), "EAPI=6\n")
+		self.src_sha = gitCommit(self.path("gentoo"))
+		writeFile(self.path("fixups/eclass/fixed.eclass"), "# fixed\n")
+		self.fixup_sha = gitCommit(self.path("fixups"))
+		writeFile(self.path("overlay/funtoo/scripts/package-sets/README"), "\n")
+		gitCommit(self.path("overlay"))
+		# these are set up by the script's main code:
+		merge_all_kits.gentoo_staging = merge_utils.GitTree("gentoo-staging", root=self.path("gentoo"))
+		merge_all_kits.fixup_repo = merge_utils.Tree("kit-fixups", self.path("fixups"))
+		merge_all_kits.funtoo_overlay = merge_utils.Tree("funtoo-overlay", self.path("overlay"))
+
+class KitChangesTest(KitTestCase):
+
+	def setUp(self):
+		KitTestCase.setUp(self)
+		self.kit_dict = { "name" : "text-kit", "branch" : "master", "src_branch" : "master" }
+		writeFile(self.path("kit/cat-a/foo/foo-1.ebuild"), "EAPI=6\n")
+		gitCommit(self.path("kit"))
+		self.kit = merge_utils.Tree("text-kit", self.path("kit"))
+		merge_all_kits.saveKitState(self.kit_dict, self.kit, "fingerprint", self.src_sha, self.fixup_sha)
+
+	def changes(self, fingerprint="fingerprint", kit_dict=None):
+		src_sha = merge_utils.gitRevParse(self.path("gentoo"))
+		fixup_sha = merge_utils.gitRevParse(self.path("fixups"))
+		return merge_all_kits.getKitChanges(kit_dict or self.kit_dict, self.kit, fingerprint, src_sha, fixup_sha)
+
+	def testNothingChanged(self):
+		self.assertEqual(self.changes(), { "catpkgs" : set(), "eclasses" : set(), "licenses" : set() })
+
+	def testChangedPaths(self):
+		writeFile(self.path("gentoo/eclass/foo.eclass"), "# changed\n")
+		writeFile(self.path("gentoo/licenses/MIT"), "MIT\n")
+		writeFile(self.path("gentoo/cat-b/bar/bar-1.ebuild"), "EAPI=6\n")
+		writeFile(self.path("gentoo/profiles/package.mask"), "cat-b/bar\n")
+		gitCommit(self.path("gentoo"))
+		writeFile(self.path("fixups/eclass/fixed.eclass"), "# changed\n")
+		writeFile(self.path("fixups/text-kit/global/eclass/kit.eclass"), "# kit\n")
+		writeFile(self.path("fixups/text-kit/master/cat-c/baz/baz-1.ebuild"), "EAPI=6\n")
+		# other branches and kits don't matter:
+		writeFile(self.path("fixups/text-kit/1.0-prime/cat-d/old/old-1.ebuild"), "EAPI=6\n")
+		writeFile(self.path("fixups/net-kit/global/cat-e/net/net-1.ebuild"), "EAPI=6\n")
+		gitCommit(self.path("fixups"))
+		self.assertEqual(self.changes(), {
+			"catpkgs" : { "cat-b/bar", "cat-c/baz" },
+			"eclasses" : { "foo.eclass", "fixed.eclass", "kit.eclass" },
+			"licenses" : { "MIT" }
+		})
+
+	def testFullRegeneration(self):
+		# no state, a different fingerprint, or a kit that was changed behind our back:
+		self.assertEqual(self.changes(kit_dict={ "name" : "net-kit", "branch" : "master", "src_branch" : "master" }), None)
+		self.assertEqual(self.changes(fingerprint="other"), None)
+		writeFile(self.path("kit/cat-a/foo/foo-2.ebuild"), "EAPI=6\n")
+		self.assertEqual(self.changes(), None)
+		gitCommit(self.path("kit"))
+		self.assertEqual(self.changes(), None)
+
+	def testProfileChangesRegenerateCoreKit(self):
+		kit_dict = { "name" : "core-kit", "branch" : "master", "src_branch" : "master" }
+		merge_all_kits.saveKitState(kit_dict, self.kit, "fingerprint", self.src_sha, self.fixup_sha)
+		writeFile(self.path("gentoo/cat-b/bar/bar-1.ebuild"), "EAPI=6\n")
+		gitCommit(self.path("gentoo"))
+		self.assertEqual(self.changes(kit_dict=kit_dict)["catpkgs"], { "cat-b/bar" })
+		writeFile(self.path("gentoo/profiles/package.mask"), "cat-b/bar\n")
+		gitCommit(self.path("gentoo"))
+		self.assertEqual(self.changes(kit_dict=kit_dict), None)
+
+class RemoveStaleFilesTest(KitTestCase):
+
+	def testRemoveStaleFiles(self):
+		for path in [ "cat-a/foo/foo-1.ebuild", "cat-a/old/old-1.ebuild", "cat-b/gone/gone-1.ebuild", "eclass/foo.eclass",
+			"eclass/old.eclass", "licenses/GPL-2", "licenses/OLD", "profiles/categories" ]:
+			writeFile(self.path("kit", path), "\n")
+		ebuilds = merge_utils.InsertEbuilds(merge_all_kits.gentoo_staging, select="all")
+		ebuilds.selected = { "cat-a/foo" }
+		eclasses = merge_utils.InsertEclasses(merge_all_kits.gentoo_staging)
+		eclasses.selected = { "eclass/foo.eclass" }
+		licenses = merge_utils.InsertLicenses(merge_all_kits.gentoo_staging)
+		licenses.selected = { "licenses/GPL-2" }
+		merge_all_kits.removeStaleFiles(merge_utils.Tree("kit", self.path("kit")), [ ebuilds, eclasses, licenses ])
+		remaining = []
+		for dirpath, dirnames, filenames in os.walk(self.path("kit")):
+			remaining += [ os.path.relpath(os.path.join(dirpath, fn), self.path("kit")) for fn in filenames ]
+		self.assertEqual(sorted(remaining), [ "cat-a/foo/foo-1.ebuild", "eclass/foo.eclass", "licenses/GPL-2", "profiles/categories" ])
+		self.assertFalse(os.path.exists(self.path("kit/cat-b")))
+
+class KitOwnershipTest(KitTestCase):
+
+	"""
+	Checks that planKits() and runKits() give every kit the same catpkgs as the old serial loop, which threaded one
+	kitted_catpkgs dict through updateKit() for each kit in turn. updateKit() is replaced by the copy phases that decide
+	what a kit holds: the package-set InsertEbuilds steps and the kit-fixups ebuilds.
+	"""
+
+	kit_groups = {
+		"prime" : [
+			{ "name" : "core-kit", "branch" : "master", "src_branch" : "master" },
+			{ "name" : "text-kit", "branch" : "master", "src_branch" : "master" },
+			{ "name" : "nokit", "branch" : "master", "src_branch" : "master" }
+		],
+		"current" : [
+			{ "name" : "text-kit", "branch" : "next", "src_branch" : "master" },
+			{ "name" : "core-kit", "branch" : "next", "src_branch" : "master" }
+		]
+	}
+
+	groups = [ "prime", None, "current" ]
+
+	def setUp(self):
+		KitTestCase.setUp(self)
+		for catpkg in [ "cat-a/bar", "cat-b/baz", "cat-b/extra", "cat-c/other" ]:
+			writeFile(self.path("gentoo", catpkg, catpkg.split("/")[1] + "-1.ebuild"), "EAPI=6\n")
+		writeFile(self.path("gentoo/profiles/categories"), "cat-a\ncat-b\ncat-c\n")
+		gitCommit(self.path("gentoo"))
+		writeFile(self.path("overlay/funtoo/scripts/package-sets/core-kit-packages"), "cat-a/*\n")
+		writeFile(self.path("overlay/funtoo/scripts/package-sets/text-kit-packages"), "cat-a/foo\ncat-b/*\n")
+		writeFile(self.path("fixups/text-kit/global/cat-d/fix/fix-1.ebuild"), "EAPI=6\n")
+		gitCommit(self.path("fixups"))
+		merge_all_kits.kit_groups = self.kit_groups
+		for patcher in [ mock.patch.object(merge_all_kits, "updateKit", self.updateKit), mock.patch.object(merge_all_kits, "kitTree", lambda kit_dict: None) ]:
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	def updateKit(self, kit_dict, kitted_catpkgs, create=False, incremental=False):
+		# stands in for merge_all_kits.updateKit(), and records what the kit got in a file, so results from worker processes
+		# get back to us, and a kit that is generated again replaces its earlier result:
+		result = None
+		if kit_dict['name'] != 'nokit':
+			root = self.path("kits", kit_dict['name'])
+			if os.path.exists(root):
+				shutil.rmtree(root)
+			writeFile(os.path.join(root, "profiles/categories"), "")
+			gitCommit(root)
+			kit = merge_utils.GitTree(kit_dict['name'], root=root)
+			source = merge_all_kits.gentoo_staging.snapshot(kit_dict['src_branch'])
+			steps = merge_utils.generateShardSteps(kit_dict['name'], source, kit, pkgdir=self.path("overlay/funtoo/scripts"),
+				branch=None, catpkg_dict=kitted_catpkgs)
+			steps += [ merge_utils.InsertEbuilds(merge_all_kits.fixup_repo, ebuildloc=kit_dict['name'] + "/global", select="all", replace=True) ]
+			kit.run(steps)
+			if kit_dict['name'] == 'core-kit' and kit_dict['branch'] == 'master':
+				# something the plan can't know about, like a dependency that was added while generating the kit:
+				merge_utils.copyTree(os.path.join(source.root, "cat-b/extra"), os.path.join(root, "cat-b/extra"))
+				with open(os.path.join(root, "profiles/categories"), "a") as f:
+					f.write("\ncat-b\n")
+			source.release()
+			kit_catpkgs = kit.getAllCatPkgs()
+			kitted_catpkgs.update(kit_catpkgs)
+			result = sorted(kit_catpkgs.keys())
+		writeFile(self.path("results", "%s-%s" % ( kit_dict['name'], kit_dict['branch'] )), json.dumps(result))
+		return set(result) if result != None else None
+
+	def results(self):
+		out = {}
+		for fn in os.listdir(self.path("results")):
+			with open(self.path("results", fn), "r") as f:
+				out[fn] = json.load(f)
+		shutil.rmtree(self.path("results"))
+		return out
+
+	def oldSerial(self, groups):
+		# the kit loop of merge-all-kits.py before kits were planned:
+		kitted_catpkgs = {}
+		for kit_group in groups:
+			if kit_group == None:
+				kitted_catpkgs = {}
+			else:
+				for kit_dict in merge_all_kits.kit_groups[kit_group]:
+					merge_all_kits.updateKit(kit_dict, kitted_catpkgs, create=True)
+		return self.results()
+
+	def testSerialOwnership(self):
+		expected = self.oldSerial(self.groups)
+		self.assertEqual(expected, {
+			"core-kit-master" : [ "cat-a/bar", "cat-a/foo", "cat-b/extra" ],
+			"text-kit-master" : [ "cat-b/baz", "cat-d/fix" ],
+			"nokit-master" : None,
+			"text-kit-next" : [ "cat-a/foo", "cat-b/baz", "cat-b/extra", "cat-d/fix" ],
+			"core-kit-next" : [ "cat-a/bar" ]
+		})
+		plan = merge_all_kits.planKits(self.groups)
+		self.assertEqual([ ( kit_dict['name'], kit_dict['branch'], segment ) for kit_dict, kitted_catpkgs, catpkgs, segment in plan ],
+			[ ( "core-kit", "master", 0 ), ( "text-kit", "master", 0 ), ( "nokit", "master", 0 ), ( "text-kit", "next", 1 ), ( "core-kit", "next", 1 ) ])
+		# the plan can't know about cat-b/extra, so it gives it to text-kit:
+		self.assertEqual(plan[1][2], { "cat-b/baz", "cat-b/extra", "cat-d/fix" })
+		self.assertEqual(plan[2][2], { "cat-c/other" })
+		merge_all_kits.runKits(plan, jobs=1)
+		self.assertEqual(self.results(), expected)
+
+	def testParallelOwnership(self):
+		expected = self.oldSerial(self.groups)
+		plan = merge_all_kits.planKits(self.groups)
+		merge_all_kits.runKits(plan, jobs=2)
+		self.assertEqual(self.results(), expected)
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+
+import os
+import unittest
+
+from common import merge_utils, TreeTestCase, writeFile, readFile
+
+class ManifestMergeTest(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		writeFile(self.path("dst/Manifest"), "EBUILD foo-1.ebuild 10 SHA256 e1\nDIST foo-1.tar.gz 1 SHA256 aa\nDIST foo-0.tar.gz 1 SHA256 00\n")
+		writeFile(self.path("src/Manifest"), "DIST foo-2.tar.gz 2 SHA256 bb\nDIST foo-1.tar.gz 1 SHA256 cc\n\nAUX fix.patch 3 SHA256 dd\nEBUILD foo-1.ebuild 10 SHA256 e1")
+
+	def testReadManifest(self):
+		entries = merge_utils.readManifest(self.path("dst/Manifest"))
+		self.assertEqual(sorted(entries.keys()), [ ("DIST", "foo-0.tar.gz"), ("DIST", "foo-1.tar.gz"), ("EBUILD", "foo-1.ebuild") ])
+		self.assertEqual(entries[("DIST", "foo-1.tar.gz")].line, "DIST foo-1.tar.gz 1 SHA256 aa\n")
+		self.assertEqual(merge_utils.readManifest(self.path("missing/Manifest")), {})
+
+	def testMergeManifest(self):
+		entries = merge_utils.readManifest(self.path("dst/Manifest"))
+		stats = merge_utils.ManifestMergeStats()
+		merge_utils.mergeManifest(entries, self.path("src/Manifest"), stats)
+		self.assertEqual((stats.manifests, stats.added, stats.conflicts, stats.identical), (1, 2, 1, 1))
+		merge_utils.writeManifest(self.path("dst/Manifest"), entries)
+		# source entries win, and the result is sorted by type and then name:
+		self.assertEqual(readFile(self.path("dst/Manifest")), b"AUX fix.patch 3 SHA256 dd\n"
+			b"DIST foo-0.tar.gz 1 SHA256 00\nDIST foo-1.tar.gz 1 SHA256 cc\nDIST foo-2.tar.gz 2 SHA256 bb\n"
+			b"EBUILD foo-1.ebuild 10 SHA256 e1\n")
+
+	def testMergeLeavesHardlinkedSourcesAlone(self):
+		merge_utils.copyTree(self.path("src"), self.path("linked"), link_mode="hardlink")
+		entries = merge_utils.readManifest(self.path("linked/Manifest"))
+		merge_utils.mergeManifest(entries, self.path("dst/Manifest"))
+		merge_utils.writeManifest(self.path("linked/Manifest"), entries)
+		self.assertEqual(os.stat(self.path("src/Manifest")).st_nlink, 1)
+		self.assertNotIn(b"foo-0.tar.gz", readFile(self.path("src/Manifest")))
+		self.assertIn(b"foo-0.tar.gz", readFile(self.path("linked/Manifest")))
+
+class InsertEbuildsMergeTest(TreeTestCase):
+
+	def testMergeOnTopOfDestination(self):
+		writeFile(self.path("src/cat-a/foo/foo-2.ebuild"), "EAPI=6\n")
+		writeFile(self.path("src/cat-a/foo/Manifest"), "DIST foo-2.tar.gz 2 SHA256 bb\n")
+		writeFile(self.path("dst/cat-a/foo/foo-1.ebuild"), "EAPI=6\n")
+		writeFile(self.path("dst/cat-a/foo/Manifest"), "DIST foo-1.tar.gz 1 SHA256 aa\n")
+		step = merge_utils.InsertEbuilds(merge_utils.Tree("src", self.path("src")), select="all", replace=True, merge=True,
+			categories=[ "cat-a" ], workers=1)
+		desttree = merge_utils.Tree("dst", self.path("dst"))
+		desttree.xml_out = None
+		desttree.logTree = lambda srctree: None
+		step.run(desttree)
+		self.assertTrue(os.path.exists(self.path("dst/cat-a/foo/foo-1.ebuild")))
+		self.assertEqual(readFile(self.path("dst/cat-a/foo/Manifest")), b"DIST foo-1.tar.gz 1 SHA256 aa\nDIST foo-2.tar.gz 2 SHA256 bb\n")
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+
+import os
+import re
+import unittest
+from unittest import mock
+
+from common import merge_utils, TreeTestCase, writeFile, gitCommit
+
+class FakePortdb(object):
+
+	"""
+	Stands in for portdbapi: ebuilds set their metadata with KEY="value" lines, and every aux_get() is recorded so
+	tests can see which catpkgs the index re-read.
+	"""
+
+	def __init__(self, root):
+		self.root = root
+		self.paths = {}
+		self.aux_gets = []
+
+	def cp_all(self, trees=None):
+		out = []
+		for cat in sorted(os.listdir(self.root)):
+			if "-" in cat and os.path.isdir(os.path.join(self.root, cat)):
+				out += [ cat + "/" + pkg for pkg in sorted(os.listdir(os.path.join(self.root, cat))) ]
+		return out
+
+	def cp_list(self, cp, mytree=None):
+		pkgdir = os.path.join(self.root, cp)
+		if not os.path.isdir(pkgdir):
+			return []
+		out = []
+		for fn in sorted(os.listdir(pkgdir)):
+			if fn.endswith(".ebuild"):
+				cpv = cp.split("/")[0] + "/" + fn[:-7]
+				self.paths[cpv] = os.path.join(pkgdir, fn)
+				out.append(cpv)
+		return out
+
+	def aux_get(self, cpv, keys, mytree=None):
+		self.aux_gets.append(cpv)
+		with open(self.paths[cpv]) as f:
+			values = dict(re.findall(r'^(\w+)="(.*)"$', f.read(), re.M))
+		return [ values.get(key, "") for key in keys ]
+
+class MetadataIndexTest(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		self.root = self.path("repo")
+		writeFile(self.path("repo/cat-a/foo/foo-1.ebuild"), 'INHERITED="eutils"\nDEPEND="cat-b/bar"\nLICENSE="GPL-2"\n')
+		writeFile(self.path("repo/cat-b/bar/bar-1.ebuild"), 'INHERITED="autotools"\nLICENSE="MIT"\n')
+		writeFile(self.path("repo/cat-b/baz/baz-1.ebuild"), 'LICENSE="BSD"\n')
+		writeFile(self.path("repo/eclass/eutils.eclass"), "# eutils\n")
+		gitCommit(self.root)
+		self.tree = merge_utils.Tree("repo", self.root)
+		self.portdb = FakePortdb(self.root)
+		patcher = mock.patch.object(merge_utils, "getPortdb", lambda ebuild_repo, super_repo=None: self.portdb)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def sync(self):
+		# sync the index and return the catpkgs that were re-read from "portage":
+		del self.portdb.aux_gets[:]
+		index = merge_utils.getMetadataIndex(self.tree)
+		return index, set(cpv.rsplit("-", 1)[0] for cpv in self.portdb.aux_gets)
+
+	def testInitialSync(self):
+		index, read = self.sync()
+		self.assertEqual(read, { "cat-a/foo", "cat-b/bar", "cat-b/baz" })
+		self.assertEqual(merge_utils.getAllLicenses(self.tree), { "GPL-2", "MIT", "BSD" })
+		self.assertEqual(index.sha, merge_utils.gitRevParse(self.root))
+
+	def testUnchangedTreeIsNotReRead(self):
+		self.sync()
+		index, read = self.sync()
+		self.assertEqual(read, set())
+		# a new MetadataIndex object (a new run) picks up the state stored in the database:
+		merge_utils.metadata_indexes.clear()
+		index, read = self.sync()
+		self.assertEqual(read, set())
+
+	def testCommittedChangeReReadsOnlyThatCatPkg(self):
+		self.sync()
+		writeFile(self.path("repo/cat-b/bar/bar-2.ebuild"), 'LICENSE="Apache-2.0"\n')
+		gitCommit(self.root)
+		index, read = self.sync()
+		self.assertEqual(read, { "cat-b/bar" })
+		self.assertIn("Apache-2.0", merge_utils.getAllLicenses(self.tree))
+
+	def testRemovedCatPkgIsDropped(self):
+		self.sync()
+		os.unlink(self.path("repo/cat-b/baz/baz-1.ebuild"))
+		os.rmdir(self.path("repo/cat-b/baz"))
+		gitCommit(self.root)
+		self.sync()
+		self.assertNotIn("BSD", merge_utils.getAllLicenses(self.tree))
+
+	def testUncommittedChangesArePickedUpAndRechecked(self):
+		self.sync()
+		writeFile(self.path("repo/cat-b/baz/baz-1.ebuild"), 'LICENSE="ISC"\n')
+		index, read = self.sync()
+		self.assertEqual(read, { "cat-b/baz" })
+		# results derived from a dirty tree must not be memoized against its SHA:
+		self.assertEqual(index.sha, None)
+		self.assertIn("ISC", merge_utils.getAllLicenses(self.tree))
+		# reverting the change must re-read the catpkg again, even though HEAD didn't move:
+		writeFile(self.path("repo/cat-b/baz/baz-1.ebuild"), 'LICENSE="BSD"\n')
+		index, read = self.sync()
+		self.assertEqual(read, { "cat-b/baz" })
+		self.assertIn("BSD", merge_utils.getAllLicenses(self.tree))
+		self.assertNotIn("ISC", merge_utils.getAllLicenses(self.tree))
+
+	def testEclassChangeReReadsInheritingCatPkgs(self):
+		self.sync()
+		writeFile(self.path("repo/eclass/eutils.eclass"), "# eutils, changed\n")
+		gitCommit(self.root)
+		index, read = self.sync()
+		self.assertEqual(read, { "cat-a/foo" })
+
+	def testVersionChangeRegeneratesIndex(self):
+		self.sync()
+		merge_utils.metadata_indexes.clear()
+		with mock.patch.object(merge_utils.MetadataIndex, "version", "test"):
+			index, read = self.sync()
+		self.assertEqual(read, { "cat-a/foo", "cat-b/bar", "cat-b/baz" })
+
+	def testUnknownRecordedCommitRegeneratesIndex(self):
+		index, read = self.sync()
+		index.db.execute("UPDATE state SET value = ? WHERE key = 'sha'", ("0" * 40,))
+		index.db.commit()
+		index, read = self.sync()
+		self.assertEqual(read, { "cat-a/foo", "cat-b/bar", "cat-b/baz" })
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+
+import os
+import unittest
+
+from common import merge_utils, TreeTestCase, writeFile, readFile
+
+class MinifyTest(TreeTestCase):
+
+	def minify(self):
+		tree = merge_utils.Tree("tree", self.path("tree"))
+		merge_utils.Minify(workers=2).run(tree)
+
+	def testChangeLogsAndNonDistLines(self):
+		writeFile(self.path("tree/ChangeLog"), "top\n")
+		writeFile(self.path("tree/cat-a/foo/ChangeLog"), "log\n")
+		writeFile(self.path("tree/cat-a/foo/Manifest"), "AUX fix.patch 10 SHA256 aa\nDIST foo-1.tar.gz 100 SHA256 bb\n"
+			"EBUILD foo-1.ebuild 20 SHA256 cc\nDIST foo-1-extra.tar.gz 5 SHA256 dd\nMISC metadata.xml 30 SHA256 ee\n")
+		os.chmod(self.path("tree/cat-a/foo/Manifest"), 0o640)
+		self.minify()
+		self.assertFalse(os.path.exists(self.path("tree/ChangeLog")))
+		self.assertFalse(os.path.exists(self.path("tree/cat-a/foo/ChangeLog")))
+		self.assertEqual(readFile(self.path("tree/cat-a/foo/Manifest")),
+			b"DIST foo-1.tar.gz 100 SHA256 bb\nDIST foo-1-extra.tar.gz 5 SHA256 dd\n")
+		self.assertEqual(os.stat(self.path("tree/cat-a/foo/Manifest")).st_mode & 0o777, 0o640)
+		self.assertEqual(os.listdir(self.path("tree/cat-a/foo")), [ "Manifest" ])
+
+	def testBytesAreKeptAsIs(self):
+		# CRLF line endings, UTF-8 and Latin-1 file names, and a last line without a newline:
+		manifest = b"DIST caf\xc3\xa9-1.tar.gz 1 SHA256 aa\r\nEBUILD caf\xc3\xa9-1.ebuild 2 SHA256 bb\r\n" \
+			b"DIST na\xefve-2.tar.gz 3 SHA256 cc"
+		writeFile(self.path("tree/cat-a/cafe/Manifest"), manifest)
+		self.minify()
+		self.assertEqual(readFile(self.path("tree/cat-a/cafe/Manifest")),
+			b"DIST caf\xc3\xa9-1.tar.gz 1 SHA256 aa\r\nDIST na\xefve-2.tar.gz 3 SHA256 cc")
+
+	def testLinesMentioningDistAreKept(self):
+		# same as sed -n '/DIST/p': a match anywhere in the line is enough.
+		writeFile(self.path("tree/dev-python/foo/Manifest"), "EBUILD foo-DISTutils-1.ebuild 20 SHA256 cc\n"
+			"AUX fix.patch 10 SHA256 aa\nDIST foo-1.tar.gz 100 SHA256 bb\n")
+		self.minify()
+		self.assertEqual(readFile(self.path("tree/dev-python/foo/Manifest")),
+			b"EBUILD foo-DISTutils-1.ebuild 20 SHA256 cc\nDIST foo-1.tar.gz 100 SHA256 bb\n")
+
+	def testThinManifestIsNotRewritten(self):
+		writeFile(self.path("tree/cat-a/foo/Manifest"), "DIST foo-1.tar.gz 100 SHA256 bb\n")
+		ino = os.stat(self.path("tree/cat-a/foo/Manifest")).st_ino
+		self.minify()
+		self.assertEqual(os.stat(self.path("tree/cat-a/foo/Manifest")).st_ino, ino)
+
+	def testGitDirectoryIsLeftAlone(self):
+		writeFile(self.path("tree/.git/ChangeLog"), "not ours\n")
+		writeFile(self.path("tree/.git/sub/Manifest"), "EBUILD x 1 SHA256 aa\n")
+		self.minify()
+		self.assertTrue(os.path.exists(self.path("tree/.git/ChangeLog")))
+		self.assertEqual(readFile(self.path("tree/.git/sub/Manifest")), b"EBUILD x 1 SHA256 aa\n")
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
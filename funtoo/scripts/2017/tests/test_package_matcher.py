@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+import re
+import unittest
+
+from common import merge_utils
+
+def oldSelect(select, catpkg):
+	# how InsertEbuilds matched select before PackageMatcher: lists of catpkgs and "cat/*", or a regex.
+	if isinstance(select, list):
+		return catpkg in select or catpkg.split("/")[0] + "/*" in select
+	elif isinstance(select, merge_utils.regextype):
+		return select.match(catpkg) != None
+	return True
+
+def oldSkip(skip, catpkg):
+	if isinstance(skip, list):
+		return catpkg in skip or catpkg.split("/")[0] + "/*" in skip
+	elif isinstance(skip, merge_utils.regextype):
+		return skip.match(catpkg) != None
+	return False
+
+catpkgs = [ "app-misc/foo", "app-misc/foobar", "app-misc/bar", "dev-libs/foo", "dev-libs/libfoo", "dev-python/six",
+	"dev-python/sixer", "sys-apps/portage", "virtual/foo", "x11-libs/gtk+", "dev-util/c++-thing" ]
+
+class PackageMatcherTest(unittest.TestCase):
+
+	specs = [
+		[ "app-misc/foo", "dev-libs/*" ],
+		[ "dev-python/six" ],
+		[ "x11-libs/gtk+", "dev-util/c++-thing" ],
+		[],
+		re.compile("dev-.*/six"),
+		re.compile("app-misc/foo$"),
+		re.compile("(dev|sys)-"),
+	]
+
+	def testSelectMatchesOldSemantics(self):
+		for spec in self.specs + [ "all", None ]:
+			matcher = merge_utils.PackageMatcher(spec, default=True)
+			for catpkg in catpkgs:
+				self.assertEqual(matcher.match(catpkg), oldSelect(spec, catpkg), "%r %s" % (spec, catpkg))
+
+	def testSkipMatchesOldSemantics(self):
+		for spec in self.specs + [ None ]:
+			matcher = merge_utils.PackageMatcher(spec)
+			for catpkg in catpkgs:
+				self.assertEqual(matcher.match(catpkg), oldSkip(spec, catpkg), "%r %s" % (spec, catpkg))
+
+	def testMixedListOfNamesAndRegexes(self):
+		# generateAuditSet builds one matcher from all lines of a package set:
+		spec = [ "app-misc/bar", "sys-apps/*", re.compile("dev-python/six$"), re.compile("virtual/.*") ]
+		matcher = merge_utils.PackageMatcher(spec)
+		matched = [ catpkg for catpkg in catpkgs if matcher.match(catpkg) ]
+		self.assertEqual(matched, [ "app-misc/bar", "dev-python/six", "sys-apps/portage", "virtual/foo" ])
+
+	def testRegexesThatCantBeCombined(self):
+		spec = [ re.compile(r"(app)-misc/\1"), re.compile("DEV-LIBS/FOO", re.I), re.compile("x11-libs/gtk\\+") ]
+		matcher = merge_utils.PackageMatcher(spec)
+		self.assertEqual(matcher.regex, None)
+		self.assertTrue(matcher.match("dev-libs/foo"))
+		self.assertTrue(matcher.match("x11-libs/gtk+"))
+		self.assertFalse(matcher.match("app-misc/foo"))
+
+	def testRegexesAreAnchoredAtTheStart(self):
+		matcher = merge_utils.PackageMatcher([ re.compile("foo"), re.compile("libs/") ])
+		self.assertFalse(any(matcher.match(catpkg) for catpkg in catpkgs))
+
+	def testHits(self):
+		regex = re.compile("dev-python/")
+		matcher = merge_utils.PackageMatcher([ "app-misc/foo", "dev-libs/*", "sys-apps/missing", regex ])
+		self.assertEqual(matcher.hits(catpkgs), { "app-misc/foo" : 1, "dev-libs/*" : 2, "sys-apps/missing" : 0, regex : 2 })
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
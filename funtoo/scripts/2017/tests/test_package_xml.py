@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+import io
+import os
+import unittest
+
+from lxml import etree
+
+from common import merge_utils, TreeTestCase, writeFile, readFile
+
+golden = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "packages.xml")
+
+# copies recorded by a merge, in order: a catpkg with USE flags, one without metadata.xml, one whose metadata.xml has
+# no flags, one with an empty flag description, and the first catpkg again, replaced from another tree.
+records = [
+	( "app-misc", "foo", "gentoo-staging", [ ("doc", "Build the documentation"), ("ssl", "Use dev-libs/openssl for crypto") ] ),
+	( "app-misc", "bar", "gentoo-staging", None ),
+	( "dev-libs", "baz", "funtoo-overlay", [] ),
+	( "sys-apps", "qux", "faustoo", [ ("empty", "") ] ),
+	( "app-misc", "foo", "funtoo-overlay", [ ("gtk", "Enable GTK+ & friends <3") ] ),
+]
+
+def oldPackagesXML(records):
+	# how the merge scripts wrote packages.xml before PackageXMLRecorder: InsertEbuilds' XPath lookups never
+	# matched (they looked for a "packages" child of the root), so every copy appended a new <category>.
+	xml_out = etree.Element("packages")
+	for cat, pkg, repository, use_flags in records:
+		catxml = xml_out.find("packages/category[@name='%s']" % cat)
+		if catxml == None:
+			catxml = etree.Element("category", name=cat)
+			xml_out.append(catxml)
+		pkgxml = xml_out.find("packages/category[@name='%s']/package/[@name='%s']" % ( cat ,pkg ))
+		if pkgxml != None:
+			pkgxml.getparent().remove(pkgxml)
+		pkgxml = etree.Element("package", name=pkg, repository=repository)
+		if use_flags != None:
+			usexml = etree.Element("use")
+			for name, desc in use_flags:
+				flag = etree.Element("flag")
+				flag.attrib["name"] = name
+				flag.text = desc
+				usexml.append(flag)
+			pkgxml.attrib["use"] = ""
+			pkgxml.append(usexml)
+		catxml.append(pkgxml)
+	a = io.BytesIO()
+	etree.ElementTree(xml_out).write(a, encoding='utf-8', xml_declaration=True, pretty_print=True)
+	return a.getvalue()
+
+class PackageXMLRecorderTest(TreeTestCase):
+
+	def written(self, recorder):
+		recorder.write(self.path("packages.xml"))
+		return readFile(self.path("packages.xml"))
+
+	def testGolden(self):
+		recorder = merge_utils.PackageXMLRecorder()
+		for record in records:
+			recorder.record(*record)
+		self.assertEqual(self.written(recorder), readFile(golden))
+
+	def testMatchesOldOutput(self):
+		for count in range(len(records) + 1):
+			recorder = merge_utils.PackageXMLRecorder()
+			for record in records[:count]:
+				recorder.record(*record)
+			self.assertEqual(self.written(recorder), oldPackagesXML(records[:count]), count)
+
+	def testInsertEbuildsRecordsCopies(self):
+		writeFile(self.path("src/app-misc/foo/foo-1.ebuild"), "EAPI=6\n")
+		writeFile(self.path("src/app-misc/foo/metadata.xml"), '<?xml version="1.0" encoding="UTF-8"?>\n<pkgmetadata>\n'
+			'\t<use>\n\t\t<flag name="doc">Build the documentation</flag>\n\t\t<flag name="ssl">Use <pkg>dev-libs/openssl</pkg> for crypto</flag>\n'
+			'\t</use>\n</pkgmetadata>\n')
+		writeFile(self.path("src/app-misc/bar/bar-1.ebuild"), "EAPI=6\n")
+		os.makedirs(self.path("dst/profiles"))
+		src = merge_utils.Tree("gentoo-staging", self.path("src"))
+		dst = merge_utils.Tree("dst", self.path("dst"))
+		dst.xml_out = merge_utils.PackageXMLRecorder()
+		dst.logTree = lambda srctree: None
+		merge_utils.InsertEbuilds(src, select="all", replace=True).run(dst)
+		self.assertEqual(sorted(dst.xml_out.records), sorted(records[:2]))
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
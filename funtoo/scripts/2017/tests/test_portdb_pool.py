@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+
+import unittest
+from unittest import mock
+
+from common import merge_utils, TreeTestCase, writeFile, gitCommit
+
+class FakeConfig(object):
+
+	def __init__(self, env=None, config_profile_path=None):
+		self.env = env
+
+class FakePortdbapi(object):
+
+	def __init__(self, mysettings=None):
+		self.settings = mysettings
+
+class PortdbPoolTest(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		for name in [ "gentoo", "overlay" ]:
+			writeFile(self.path(name, "profiles/repo_name"), name + "\n")
+			gitCommit(self.path(name))
+		self.gentoo = merge_utils.Tree("gentoo", self.path("gentoo"))
+		self.overlay = merge_utils.Tree("overlay", self.path("overlay"))
+		self.pool = merge_utils.PortdbPool()
+		for patcher in [ mock.patch.object(merge_utils, "portdbapi", FakePortdbapi), mock.patch.object(merge_utils.portage, "config", FakeConfig) ]:
+			patcher.start()
+			self.addCleanup(patcher.stop)
+
+	def testSameTreesShareAnInstance(self):
+		p = self.pool.get(self.overlay, self.gentoo)
+		self.assertIs(self.pool.get(self.overlay, self.gentoo), p)
+		# a different Tree object for the same root is the same configuration:
+		self.assertIs(self.pool.get(merge_utils.Tree("other-name", self.path("overlay")), self.gentoo), p)
+		self.assertFalse(p.frozen)
+
+	def testConfigurationsAreKeptApart(self):
+		with_master = self.pool.get(self.overlay, self.gentoo)
+		alone = self.pool.get(self.overlay)
+		self.assertIsNot(with_master, alone)
+		self.assertIn("location = %s" % self.path("gentoo"), with_master.settings.env["PORTAGE_REPOSITORIES"])
+		self.assertNotIn(self.path("gentoo"), alone.settings.env["PORTAGE_REPOSITORIES"])
+		self.assertIn("main-repo = overlay", alone.settings.env["PORTAGE_REPOSITORIES"])
+
+	def testMovingHeadRebuildsTheInstance(self):
+		p = self.pool.get(self.overlay, self.gentoo)
+		writeFile(self.path("gentoo/eclass/foo.eclass"), "# foo\n")
+		gitCommit(self.path("gentoo"))
+		q = self.pool.get(self.overlay, self.gentoo)
+		self.assertIsNot(q, p)
+		self.assertIs(self.pool.get(self.overlay, self.gentoo), q)
+
+	def testGetPortdbUsesTheSharedPool(self):
+		with mock.patch.object(merge_utils, "portdb_pool", self.pool):
+			self.assertIs(merge_utils.getPortdb(self.overlay), self.pool.get(self.overlay))
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
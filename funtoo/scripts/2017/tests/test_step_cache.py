@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+import os
+import unittest
+from unittest import mock
+
+from common import merge_utils, TreeTestCase, writeFile, readFile, gitCommit
+
+class StepCacheTest(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		writeFile(self.path("dst/profiles/categories"), "cat-a\n")
+		gitCommit(self.path("dst"))
+		self.dst = merge_utils.GitTree("dst", root=self.path("dst"), step_cache=True)
+		cwd = os.getcwd()
+		self.addCleanup(os.chdir, cwd)
+
+	def runStep(self, step):
+		# run step on the destination tree, and return True if it was replayed rather than run:
+		with mock.patch.object(step, "run", wraps=step.run) as run:
+			self.dst.run([ step ])
+		return run.call_count == 0
+
+	def testRecordReplayAndMiss(self):
+		self.assertFalse(self.runStep(merge_utils.GenerateRepoMetadata("core-kit", aliases=["gentoo"])))
+		layout = readFile(self.path("dst/metadata/layout.conf"))
+		os.unlink(self.path("dst/metadata/layout.conf"))
+		writeFile(self.path("dst/profiles/repo_name"), "wrong\n")
+		self.assertTrue(self.runStep(merge_utils.GenerateRepoMetadata("core-kit", aliases=["gentoo"])))
+		self.assertEqual(readFile(self.path("dst/metadata/layout.conf")), layout)
+		self.assertEqual(readFile(self.path("dst/profiles/repo_name")), b"core-kit\n")
+		# different parameters:
+		self.assertFalse(self.runStep(merge_utils.GenerateRepoMetadata("core-kit", aliases=["funtoo"])))
+
+	def testChangedInputIsAMiss(self):
+		writeFile(self.path("dst/profiles/thirdpartymirrors"), "gentoo\thttp://a/\n")
+		self.assertFalse(self.runStep(merge_utils.ThirdPartyMirrors()))
+		writeFile(self.path("dst/profiles/thirdpartymirrors"), "gentoo\thttp://b/\n")
+		self.assertFalse(self.runStep(merge_utils.ThirdPartyMirrors()))
+		self.assertIn(b"http://b/", readFile(self.path("dst/profiles/thirdpartymirrors")))
+
+	def testKeyDoesntDependOnWhereInputsAre(self):
+		# snapshots of the same commit live at different paths:
+		for src in [ "snapshot-1", "snapshot-2" ]:
+			writeFile(self.path(src, "eclass/foo.eclass"), "# foo\n")
+		self.assertFalse(self.runStep(merge_utils.SyncFiles(self.path("snapshot-1"), { "eclass/foo.eclass" : None })))
+		self.assertTrue(self.runStep(merge_utils.SyncFiles(self.path("snapshot-2"), { "eclass/foo.eclass" : None })))
+		writeFile(self.path("snapshot-2/eclass/foo.eclass"), "# changed\n")
+		self.assertFalse(self.runStep(merge_utils.SyncFiles(self.path("snapshot-2"), { "eclass/foo.eclass" : None })))
+
+	def testReplayDeclinesWhenAFileIsInTheWay(self):
+		writeFile(self.path("src/licenses/GPL-2"), "GPL\n")
+		self.assertFalse(self.runStep(merge_utils.SyncFiles(self.path("src"), { "licenses/GPL-2" : "licenses/x/GPL-2" })))
+		os.unlink(self.path("dst/licenses/x/GPL-2"))
+		os.rmdir(self.path("dst/licenses/x"))
+		writeFile(self.path("dst/licenses/x"), "in the way\n")
+		self.assertFalse(self.runStep(merge_utils.SyncFiles(self.path("src"), { "licenses/GPL-2" : "licenses/x/GPL-2" })))
+		self.assertEqual(readFile(self.path("dst/licenses/x/GPL-2")), b"GPL\n")
+
+	def testAutoGlobMaskLeavesTheWorkingDirectoryAlone(self):
+		writeFile(self.path("dst/cat-a/foo/foo-9999.ebuild"), "EAPI=6\n")
+		writeFile(self.path("dst/cat-a/foo/foo-1.ebuild"), "EAPI=6\n")
+		os.chdir(self.tmp)
+		self.assertFalse(self.runStep(merge_utils.AutoGlobMask("cat-a/foo", "foo-9999*", "foo")))
+		self.assertEqual(readFile(self.path("dst/profiles/package.mask/foo")), b"=cat-a/foo-9999\n")
+		os.unlink(self.path("dst/profiles/package.mask/foo"))
+		self.assertTrue(self.runStep(merge_utils.AutoGlobMask("cat-a/foo", "foo-9999*", "foo")))
+		self.assertEqual(readFile(self.path("dst/profiles/package.mask/foo")), b"=cat-a/foo-9999\n")
+		self.assertEqual(os.getcwd(), self.tmp)
+
+	def testPruneKeepsWhatRecordsReferTo(self):
+		writeFile(self.path("src/licenses/GPL-2"), "GPL\n")
+		self.runStep(merge_utils.SyncFiles(self.path("src"), { "licenses/GPL-2" : None }))
+		writeFile(self.path("src/licenses/GPL-2"), "GPL v2\n")
+		self.runStep(merge_utils.SyncFiles(self.path("src"), { "licenses/GPL-2" : None }))
+		objects = os.path.join(self.dst.step_cache.path, "objects")
+		count = lambda: sum(len(filenames) for dirpath, dirnames, filenames in os.walk(objects))
+		# running steps doesn't prune:
+		self.assertEqual(count(), 2)
+		self.dst.step_cache.prune()
+		self.assertEqual(count(), 1)
+		os.unlink(self.path("dst/licenses/GPL-2"))
+		self.assertTrue(self.runStep(merge_utils.SyncFiles(self.path("src"), { "licenses/GPL-2" : None })))
+		self.assertEqual(readFile(self.path("dst/licenses/GPL-2")), b"GPL v2\n")
+
+	def testCopyAndRenameIsKeyedOnWhatTheFunctionDoes(self):
+		writeFile(self.path("dst/files/a"), "a\n")
+		os.makedirs(self.path("dst/out"))
+		def suffixer(suffix):
+			return lambda f: f + suffix
+		self.assertFalse(self.runStep(merge_utils.CopyAndRename("files", "out", suffixer(".1"))))
+		self.assertTrue(self.runStep(merge_utils.CopyAndRename("files", "out", suffixer(".1"))))
+		# same code, different closure:
+		self.assertFalse(self.runStep(merge_utils.CopyAndRename("files", "out", suffixer(".2"))))
+		self.assertTrue(os.path.exists(self.path("dst/out/a.2")))
+		# same code and constants, different names:
+		self.assertNotEqual(merge_utils.callableKey(lambda f: f.upper()), merge_utils.callableKey(lambda f: f.lower()))
+		# closing over something without a stable description can't be cached:
+		table = { "a" : "b" }
+		self.assertEqual(merge_utils.CopyAndRename("files", "out", lambda f: table[f]).cacheParams(), None)
+		self.assertEqual(merge_utils.CopyAndRename("files", "out", str.lower).cacheKey(self.dst), None)
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
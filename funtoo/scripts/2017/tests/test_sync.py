@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+import os
+import threading
+import unittest
+from unittest import mock
+
+from common import merge_utils, TreeTestCase, writeFile, gitCommit, git
+
+class SyncTestCase(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		patcher = mock.patch.object(merge_utils, "source_tree_dir", self.path("sources"))
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.shas = {}
+		for name in [ "origin-a", "origin-b" ]:
+			self.shas[name] = []
+			for count in range(3):
+				writeFile(self.path(name, "cat-a/foo/foo-%s.ebuild" % count), "EAPI=6\n")
+				self.shas[name].append(gitCommit(self.path(name)))
+
+	def url(self, name):
+		# file:// so that git treats it like a remote, shallow clones and all:
+		return "file://" + self.path(name)
+
+	def head(self, name):
+		return git(self.path("sources", name), "rev-parse", "HEAD")
+
+class InitializeTreesTest(SyncTestCase):
+
+	def trees(self):
+		return [ merge_utils.GitTree(name, "master", url=self.url("origin-" + name), pull=True, defer=True) for name in [ "a", "b" ] ]
+
+	def testDeferredTreesAreSyncedTogether(self):
+		trees = self.trees()
+		self.assertFalse(os.path.exists(self.path("sources")))
+		# each sync waits for the other one, so this only finishes if they run at the same time:
+		barrier = threading.Barrier(2, timeout=30)
+		sync = merge_utils.GitTree.sync
+		def waitingSync(tree, timeout=None):
+			barrier.wait()
+			sync(tree, timeout)
+		with mock.patch.object(merge_utils.GitTree, "sync", waitingSync):
+			merge_utils.initializeTrees(trees, workers=2)
+		self.assertEqual(self.head("a"), self.shas["origin-a"][-1])
+		self.assertEqual(self.head("b"), self.shas["origin-b"][-1])
+		self.assertTrue(all(tree.synced for tree in trees))
+		# trees that are synced already are left alone:
+		with mock.patch.object(merge_utils.GitTree, "sync") as sync:
+			merge_utils.initializeTrees(trees)
+			self.assertEqual(sync.call_count, 0)
+
+	def testChangesAreReported(self):
+		merge_utils.initializeTrees(self.trees())
+		writeFile(self.path("origin-a/cat-a/foo/foo-3.ebuild"), "EAPI=6\n")
+		sha = gitCommit(self.path("origin-a"))
+		trees = self.trees()
+		merge_utils.initializeTrees(trees)
+		self.assertEqual(self.head("a"), sha)
+		self.assertEqual([ tree.changes for tree in trees ], [ True, False ])
+
+class FetchCommitTest(SyncTestCase):
+
+	def pinnedTree(self, sha, depth=1):
+		return merge_utils.GitTree("a", sha, url=self.url("origin-a"), depth=depth)
+
+	def testShallowCloneOfAPinnedCommit(self):
+		git(self.path("origin-a"), "config", "uploadpack.allowAnySHA1InWant", "true")
+		pinned = self.shas["origin-a"][1]
+		tree = self.pinnedTree(pinned)
+		self.assertEqual(self.head("a"), pinned)
+		# just the one commit was fetched:
+		self.assertEqual(git(self.path("sources/a"), "rev-list", "--count", pinned), "1")
+		self.assertTrue(os.path.exists(self.path("sources/a/.git/shallow")))
+		# and having it, the next sync doesn't go to the network at all:
+		with mock.patch.object(merge_utils, "run_command", wraps=merge_utils.run_command) as run_command:
+			tree.sync()
+			self.assertEqual(run_command.call_count, 0)
+		self.assertFalse(tree.changes)
+
+	def testFallBackToFullHistory(self):
+		# a remote that won't hand out single commits by SHA1:
+		run_command = merge_utils.run_command
+		def refusingRunCommand(args, **kwargs):
+			if args[:2] == [ "git", "fetch" ] and args[-1] == pinned:
+				return False
+			return run_command(args, **kwargs)
+		pinned = self.shas["origin-a"][0]
+		with mock.patch.object(merge_utils, "run_command", refusingRunCommand):
+			self.pinnedTree(pinned)
+		self.assertEqual(self.head("a"), pinned)
+		self.assertFalse(os.path.exists(self.path("sources/a/.git/shallow")))
+		self.assertTrue(merge_utils.GitTree("a", pinned, url=self.url("origin-a")).hasCommit(self.shas["origin-a"][-1]))
+
+	def testMissingCommit(self):
+		tree = self.pinnedTree(self.shas["origin-a"][-1], depth=None)
+		self.assertFalse(tree.fetchCommit("0" * 40))
+		self.assertTrue(tree.fetchCommit(self.shas["origin-a"][0]))
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
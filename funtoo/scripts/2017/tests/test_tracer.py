@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+import os
+import json
+import unittest
+from unittest import mock
+
+from common import merge_utils, TreeTestCase, writeFile, gitCommit
+
+class TracerTest(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		writeFile(self.path("repo/profiles/repo_name"), "repo\n")
+		self.sha = gitCommit(self.path("repo"))
+		self.tracer = merge_utils.Tracer()
+		# not enable(), which would also write the trace at exit:
+		self.tracer.path = self.path("trace.json")
+		patcher = mock.patch.object(merge_utils, "tracer", self.tracer)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def readTrace(self):
+		self.tracer.write()
+		with open(self.path("trace.json"), "r") as f:
+			trace = json.load(f)
+		self.assertEqual(trace["displayTimeUnit"], "ms")
+		self.assertEqual(trace["traceEvents"][0]["ph"], "M")
+		return trace["traceEvents"][1:]
+
+	def testStepsAndSubprocesses(self):
+		tree = merge_utils.GitTree("repo", root=self.path("repo"))
+		with merge_utils.tracer.span("Step", "step", tree="repo"):
+			# two rev-parses, show-ref and symbolic-ref:
+			self.assertTrue(merge_utils.gitIsCheckedOut(self.path("repo"), "master"))
+			self.assertTrue(tree.hasCommit(self.sha))
+		events = self.readTrace()
+		self.assertEqual([ e["name"] for e in events if e["cat"] == "step" ], [ "Step" ])
+		step = [ e for e in events if e["cat"] == "step" ][0]
+		subprocesses = [ e for e in events if e["cat"] == "subprocess" ]
+		self.assertEqual(len(subprocesses), 5)
+		self.assertEqual(step["args"]["subprocesses"], 5)
+		self.assertEqual(step["args"]["tree"], "repo")
+		self.assertIn("git cat-file -e " + self.sha, [ e["args"]["cmd"] for e in subprocesses ])
+		for e in events:
+			self.assertEqual(e["ph"], "X")
+			self.assertEqual(e["pid"], os.getpid())
+			self.assertGreaterEqual(e["args"]["cpu_ms"], 0)
+		for e in subprocesses:
+			# subprocess spans nest inside the step's:
+			self.assertGreaterEqual(e["ts"], step["ts"])
+			self.assertLessEqual(e["ts"] + e["dur"], step["ts"] + step["dur"] + 1)
+		self.assertEqual(events, sorted(events, key=lambda e: e["ts"]))
+
+	def testForkedChildrenAreMerged(self):
+		with merge_utils.tracer.span("Parent", "kit"):
+			pid = os.fork()
+			if pid == 0:
+				status = 1
+				try:
+					with merge_utils.tracer.span("Child", "kit"):
+						merge_utils.gitRevParse(self.path("repo"))
+					merge_utils.tracer.flush()
+					status = 0
+				finally:
+					os._exit(status)
+			self.assertEqual(os.waitpid(pid, 0)[1], 0)
+		events = self.readTrace()
+		self.assertEqual(sorted((e["name"], e["pid"]) for e in events if e["cat"] == "kit"), [ ("Child", pid), ("Parent", os.getpid()) ])
+		self.assertEqual([ e["pid"] for e in events if e["cat"] == "subprocess" ], [ pid ])
+		self.assertEqual(os.listdir(self.tmp).count("trace.json.%s" % pid), 0)
+
+	def testTracingOff(self):
+		self.tracer.path = None
+		with merge_utils.tracer.span("Step", "step"):
+			merge_utils.gitRevParse(self.path("repo"))
+		self.assertEqual(self.tracer.events, [])
+		self.tracer.write()
+		self.assertFalse(os.path.exists(self.path("trace.json")))
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
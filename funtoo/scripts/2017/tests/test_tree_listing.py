@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+
+import os
+import unittest
+from unittest import mock
+
+from common import merge_utils, TreeTestCase, writeFile, readFile, gitCommit, git
+from test_metadata_index import FakePortdb
+
+class TreeListingTest(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		self.root = self.path("repo")
+		writeFile(self.path("repo/profiles/categories"), "cat-a\ncat-b\n")
+		writeFile(self.path("repo/cat-a/foo/foo-1.ebuild"), 'DEPEND="cat-b/bar"\n')
+		writeFile(self.path("repo/cat-b/bar/bar-1.ebuild"), "\n")
+		writeFile(self.path("repo/other/README"), "not a category\n")
+		self.first = gitCommit(self.root)
+
+	def testListingFromGitMatchesScan(self):
+		listing = merge_utils.getTreeListing(self.root)
+		self.assertEqual(listing.sha, self.first)
+		scan = merge_utils.TreeListing(self.root)
+		for path in [ "cat-a", "cat-a/foo", "other", "missing" ]:
+			self.assertEqual(listing.listdir(path), scan.listdir(path), path)
+		self.assertEqual(listing.read("profiles/categories"), "cat-a\ncat-b\n")
+		self.assertEqual(merge_utils.getCatPkgs(self.root), [ "cat-a/foo", "cat-b/bar" ])
+
+	def testDirtyTreesAreScanned(self):
+		# an untracked file, inside an untracked directory:
+		writeFile(self.path("repo/cat-a/new/new-1.ebuild"), "\n")
+		listing = merge_utils.getTreeListing(self.root)
+		self.assertEqual(listing.sha, None)
+		self.assertIn("new", listing.listdir("cat-a"))
+		os.unlink(self.path("repo/cat-a/new/new-1.ebuild"))
+		os.rmdir(self.path("repo/cat-a/new"))
+		self.assertEqual(merge_utils.getTreeListing(self.root).sha, self.first)
+		# a modified file:
+		writeFile(self.path("repo/cat-b/bar/bar-1.ebuild"), "changed\n")
+		self.assertEqual(merge_utils.getTreeListing(self.root).sha, None)
+
+	def testDestinationStepsScanWithoutAskingGit(self):
+		writeFile(self.path("src/profiles/categories"), "cat-a\ncat-b\n")
+		writeFile(self.path("src/cat-a/foo/foo-2.ebuild"), "\n")
+		source = merge_utils.Tree("src", self.path("src"))
+		dest = merge_utils.Tree("repo", self.root)
+		with mock.patch.object(merge_utils, "gitRevParse", wraps=merge_utils.gitRevParse) as rev_parse:
+			merge_utils.ZapMatchingEbuilds(source).run(dest)
+			merge_utils.CreateCategories(source).run(dest)
+		self.assertFalse(os.path.exists(self.path("repo/cat-a/foo")))
+		self.assertEqual(readFile(self.path("repo/profiles/categories")), b"cat-a\ncat-b\n")
+		# the source isn't a git repo, and the destination wasn't looked up in git at all:
+		self.assertEqual([ call[0][0] for call in rev_parse.call_args_list ], [ self.path("src") ])
+
+	def testOnlyRecentListingsAreKept(self):
+		shas = [ self.first ]
+		for count in range(merge_utils.tree_listings_max + 1):
+			writeFile(self.path("repo/cat-b/bar/bar-%s.ebuild" % (count + 2)), "\n")
+			shas.append(gitCommit(self.root))
+		first = merge_utils.getTreeListing(self.root, self.first)
+		for sha in shas[1:]:
+			merge_utils.getTreeListing(self.root, sha)
+			# using the first listing keeps it around:
+			self.assertIs(merge_utils.getTreeListing(self.root, self.first), first)
+		self.assertEqual(len(merge_utils.tree_listings), merge_utils.tree_listings_max)
+		self.assertNotIn((self.root, shas[1]), merge_utils.tree_listings)
+		self.assertIn((self.root, shas[-1]), merge_utils.tree_listings)
+
+	def testRevisionReadsAnOlderCommitWithoutCheckingItOut(self):
+		writeFile(self.path("repo/profiles/categories"), "cat-a\ncat-b\ncat-c\n")
+		writeFile(self.path("repo/cat-c/baz/baz-1.ebuild"), "\n")
+		git(self.root, "rm", "-q", "-r", "cat-a")
+		gitCommit(self.root)
+		tree = merge_utils.GitTree("repo", root=self.root)
+		revision = tree.revision(self.first)
+		self.assertEqual(set(revision.getAllCatPkgs().keys()), { "cat-a/foo", "cat-b/bar" })
+		self.assertEqual(set(tree.revision().getAllCatPkgs().keys()), { "cat-b/bar", "cat-c/baz" })
+		self.assertFalse(os.path.exists(merge_utils.worktree_dir))
+		self.assertFalse(os.path.exists(self.path("repo/cat-a")))
+
+	def testRevisionUsesTheExistingIndexAsItIs(self):
+		portdb = FakePortdb(self.root)
+		patcher = mock.patch.object(merge_utils, "getPortdb", lambda ebuild_repo, super_repo=None: portdb)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		tree = merge_utils.GitTree("repo", root=self.root)
+		merge_utils.getMetadataIndex(tree)
+		writeFile(self.path("repo/cat-a/foo/foo-1.ebuild"), 'DEPEND="cat-b/baz"\n')
+		gitCommit(self.root)
+		del portdb.aux_gets[:]
+		revision = tree.revision()
+		self.assertEqual(merge_utils.getDependencies(revision, [ "cat-a/foo" ]), { "cat-b/bar" })
+		self.assertEqual(portdb.aux_gets, [])
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
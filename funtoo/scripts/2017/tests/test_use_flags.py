@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+
+import unittest
+from unittest import mock
+
+from common import merge_utils, TreeTestCase, writeFile
+
+metadata_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<pkgmetadata>
+	<use>
+		<flag name="ssl">Enable <pkg>dev-libs/openssl</pkg> support</flag>
+		<flag name="doc">Build documentation</flag>
+	</use>
+</pkgmetadata>
+"""
+
+class UseFlagCacheTest(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		self.addCleanup(setattr, merge_utils, "use_flag_cache", None)
+		merge_utils.use_flag_cache = None
+
+	def testGetAndPut(self):
+		cache = merge_utils.UseFlagCache()
+		self.assertEqual(cache.get("aa"), (False, None))
+		cache.put([ ("aa", [ ("ssl", "SSL") ]), ("bb", None) ])
+		self.assertEqual(cache.get("aa"), (True, [ ("ssl", "SSL") ]))
+		# a cached parse failure is still a hit:
+		self.assertEqual(cache.get("bb"), (True, None))
+		# and it is kept across runs:
+		self.assertEqual(merge_utils.UseFlagCache().get("aa"), (True, [ ("ssl", "SSL") ]))
+
+	def testGetUseFlags(self):
+		writeFile(self.path("a/metadata.xml"), metadata_xml)
+		writeFile(self.path("b/metadata.xml"), metadata_xml)
+		writeFile(self.path("broken/metadata.xml"), "<pkgmetadata>\n")
+		paths = [ self.path(d, "metadata.xml") for d in [ "a", "b", "broken", "missing" ] ]
+		flags = [ ("ssl", "Enable dev-libs/openssl support"), ("doc", "Build documentation") ]
+		with mock.patch.object(merge_utils, "parseUseFlags", wraps=merge_utils.parseUseFlags) as parse:
+			out = merge_utils.getUseFlags(paths, workers=1)
+			# identical files are only parsed once:
+			self.assertEqual(parse.call_count, 2)
+		self.assertEqual(out, { paths[0] : flags, paths[1] : flags, paths[2] : None, paths[3] : None })
+		# the next run only has hits, even with a fresh cache connection:
+		merge_utils.use_flag_cache = None
+		with mock.patch.object(merge_utils, "parseUseFlags") as parse:
+			self.assertEqual(merge_utils.getUseFlags(paths, workers=1), out)
+			self.assertEqual(parse.call_count, 0)
+
+	def testChangedFileIsAMiss(self):
+		writeFile(self.path("a/metadata.xml"), metadata_xml)
+		merge_utils.getUseFlags([ self.path("a/metadata.xml") ], workers=1)
+		writeFile(self.path("a/metadata.xml"), metadata_xml.replace("Build documentation", "Install docs"))
+		out = merge_utils.getUseFlags([ self.path("a/metadata.xml") ], workers=1)
+		self.assertEqual(out[self.path("a/metadata.xml")][1], ("doc", "Install docs"))
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+import os
+import unittest
+from unittest import mock
+
+from common import merge_utils, TreeTestCase, writeFile, gitCommit
+
+class WorktreePoolTest(TreeTestCase):
+
+	def setUp(self):
+		TreeTestCase.setUp(self)
+		self.root = self.path("repo")
+		self.shas = []
+		for count in range(3):
+			writeFile(self.path("repo/cat-a/foo/foo-%s.ebuild" % count), "EAPI=6\n")
+			self.shas.append(gitCommit(self.root))
+		self.tree = merge_utils.GitTree("repo", root=self.root)
+		self.pool = merge_utils.WorktreePool()
+
+	def worktree(self, sha):
+		return os.path.join(merge_utils.worktree_dir, "repo", sha)
+
+	def testSnapshotIsCheckedOnlyOncePerRun(self):
+		self.pool.acquire(self.tree, self.shas[0]).release()
+		# the next run checks the worktree it finds, once:
+		pool = merge_utils.WorktreePool()
+		with mock.patch.object(merge_utils, "gitChangedPaths", wraps=merge_utils.gitChangedPaths) as changed:
+			for count in range(3):
+				snapshot = pool.acquire(self.tree, self.shas[0])
+				self.assertTrue(os.path.exists(os.path.join(snapshot.root, "cat-a/foo/foo-0.ebuild")))
+				self.assertFalse(os.path.exists(os.path.join(snapshot.root, "cat-a/foo/foo-1.ebuild")))
+				snapshot.release()
+			self.assertEqual(changed.call_count, 1)
+
+	def testPruneKeepsWorktreesInUse(self):
+		held = self.pool.acquire(self.tree, self.shas[0])
+		for sha in self.shas[1:]:
+			self.pool.acquire(self.tree, sha).release()
+		self.pool.prune(self.tree, keep=0)
+		self.assertTrue(os.path.isdir(self.worktree(self.shas[0])))
+		self.assertFalse(os.path.exists(self.worktree(self.shas[1])))
+		held.release()
+		self.pool.prune(self.tree, keep=0)
+		self.assertEqual(os.listdir(os.path.join(merge_utils.worktree_dir, "repo")), [])
+
+	def testPruneKeepsWorktreesInUseByOtherProcesses(self):
+		ready_r, ready_w = os.pipe()
+		done_r, done_w = os.pipe()
+		pid = os.fork()
+		if pid == 0:
+			# a kit worker, with its own pool:
+			status = 1
+			try:
+				os.close(ready_r)
+				os.close(done_w)
+				snapshot = merge_utils.WorktreePool().acquire(self.tree, self.shas[0])
+				os.write(ready_w, b"x")
+				os.read(done_r, 1)
+				status = 0
+			finally:
+				os._exit(status)
+		os.close(ready_w)
+		os.close(done_r)
+		self.assertEqual(os.read(ready_r, 1), b"x")
+		self.pool.prune(self.tree, keep=0)
+		self.assertTrue(os.path.isdir(self.worktree(self.shas[0])))
+		os.close(done_w)
+		self.assertEqual(os.waitpid(pid, 0)[1], 0)
+		os.close(ready_r)
+		self.pool.prune(self.tree, keep=0)
+		self.assertFalse(os.path.exists(self.worktree(self.shas[0])))
+
+if __name__ == "__main__":
+	unittest.main()
+
+# vim: ts=4 sw=4 noet tw=140
@@ -0,0 +1,9 @@
+#!/usr/bin/python3
+
+# Offline micro-benchmarks for merge_utils, run against synthetic portage trees. Run "python3 -m benchmark --help"
+# from funtoo/scripts.
+
+from .synthetic import generateTree, scales
+from .suite import Bench, runScale
+
+# vim: ts=4 sw=4 noet tw=140
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import platform
+import tempfile
+import subprocess
+
+import merge_utils
+from .synthetic import scales
+from .suite import Bench, runScale
+
+usage = """Usage: python3 -m benchmark [options]
+
+Time merge_utils steps against synthetic portage trees and write the results as JSON.
+
+  --scale small,medium     scales to run (default: small,medium; available: %s)
+  --repeat N               repetitions of each benchmark (default: 3)
+  --only name,name         only run these benchmarks (available: %s)
+  --output file.json       where to write the results (default: benchmark-results.json)
+  --workdir dir            where to generate trees (default: a temporary directory)
+  --keep                   don't remove the generated trees afterwards
+""" % ( ",".join(sorted(scales.keys())), ",".join(b[0] for b in Bench.benchmarks) )
+
+def usageError(msg):
+	print("Error: %s" % msg)
+	print(usage)
+	sys.exit(1)
+
+def scriptVersion():
+	# identify the merge_utils.py being measured, so results from different versions can be compared:
+	path = os.path.realpath(merge_utils.__file__)
+	with open(path, "rb") as f:
+		sha1 = hashlib.sha1(f.read()).hexdigest()
+	rev = subprocess.run(["git", "rev-parse", "-q", "--verify", "HEAD"], cwd=os.path.dirname(path), stdout=subprocess.PIPE,
+		stderr=subprocess.DEVNULL, universal_newlines=True)
+	return { "path" : path, "sha1" : sha1, "git" : rev.stdout.strip() if rev.returncode == 0 else None }
+
+if __name__ == "__main__":
+	opts = { "--scale" : "small,medium", "--repeat" : "3", "--only" : None, "--output" : "benchmark-results.json", "--workdir" : None }
+	keep = False
+	args = sys.argv[1:]
+	while len(args):
+		arg = args.pop(0)
+		if arg in [ "-h", "--help" ]:
+			print(usage)
+			sys.exit(0)
+		elif arg == "--keep":
+			keep = True
+		elif arg in opts:
+			if not len(args):
+				usageError("%s requires an argument." % arg)
+			opts[arg] = args.pop(0)
+		else:
+			usageError("unrecognized argument %s." % arg)
+
+	run_scales = opts["--scale"].split(",")
+	for scale in run_scales:
+		if scale not in scales:
+			usageError("unknown scale %s." % scale)
+	try:
+		repeat = int(opts["--repeat"])
+	except ValueError:
+		repeat = 0
+	if repeat < 1:
+		usageError("--repeat must be a positive number.")
+	only = None
+	if opts["--only"] != None:
+		only = opts["--only"].split(",")
+		for name in only:
+			if name not in [ b[0] for b in Bench.benchmarks ]:
+				usageError("unknown benchmark %s." % name)
+
+	if opts["--workdir"] != None:
+		workdir = os.path.abspath(opts["--workdir"])
+		os.makedirs(workdir, exist_ok=True)
+	else:
+		workdir = tempfile.mkdtemp(prefix="merge-utils-bench-")
+	# keep merge_utils' caches and log out of /var, and away from any real ones:
+	merge_utils.cache_dir = os.path.join(workdir, "cache")
+	merge_utils.worktree_dir = os.path.join(workdir, "worktrees")
+	merge_utils.merge_log_path = os.path.join(workdir, "merge.log")
+
+	out = { "version" : scriptVersion(), "python" : platform.python_version(), "git" :
+		subprocess.run(["git", "--version"], stdout=subprocess.PIPE, universal_newlines=True).stdout.strip(),
+		"started" : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "repeat" : repeat, "scales" : {}, "results" : [] }
+	try:
+		for scale in run_scales:
+			out["scales"][scale] = scales[scale]
+			out["results"] += runScale(workdir, scale, repeat=repeat, only=only)
+	finally:
+		if not keep:
+			shutil.rmtree(workdir, ignore_errors=True)
+		elif opts["--workdir"] == None:
+			print("Trees left in %s" % workdir)
+
+	with open(opts["--output"] + ".tmp", "w") as f:
+		json.dump(out, f, indent=2, sort_keys=True)
+	os.replace(opts["--output"] + ".tmp", opts["--output"])
+	print("Wrote results to %s" % opts["--output"])
+
+# vim: ts=4 sw=4 noet tw=140
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+
+# The benchmarks themselves. Each one gets a fresh setup (not timed) before every repetition.
+
+import os
+import sys
+import time
+import shutil
+import statistics
+import subprocess
+
+import merge_utils
+from merge_utils import GitTree, InsertEbuilds, InsertEclasses, InsertLicenses, Minify, ZapMatchingEbuilds, \
+	copyTree, readManifest, mergeManifest, writeManifest, ManifestMergeStats, generateAuditSet
+
+from .synthetic import generateTree, catName, pkgName, scales
+
+class Bench(object):
+
+	"""
+	A synthetic source tree (src), a second, overlapping one generated with a different seed (overlay), and a
+	scratch destination tree (dest) under workdir, plus the benchmarks that run against them.
+	"""
+
+	def __init__(self, workdir, scale):
+		self.workdir = workdir
+		self.scale = scale
+		self.params = scales[scale]
+		base = os.path.join(workdir, scale)
+		if os.path.exists(base):
+			shutil.rmtree(base)
+		os.makedirs(base)
+		self.src_root = os.path.join(base, "src")
+		self.overlay_root = os.path.join(base, "overlay")
+		self.dest_root = os.path.join(base, "dest")
+		self.pkgdir = os.path.join(base, "sets")
+		start = time.perf_counter()
+		self.counts = generateTree(self.src_root, seed=1, name="bench-src", **self.params)
+		generateTree(self.overlay_root, seed=2, name="bench-overlay", **self.params)
+		self.generate_secs = time.perf_counter() - start
+		self.writePackageSet()
+		self.src = GitTree("bench-src", root=self.src_root)
+		self.overlay = GitTree("bench-overlay", root=self.overlay_root)
+		self.dest = None
+
+	def writePackageSet(self):
+		# a package set mixing the kinds of lines real kits use: catpkgs, whole categories and regexes.
+		categories = self.params["categories"]
+		packages = self.params["packages"]
+		lines = []
+		for c in range(0, categories, 3):
+			lines.append(catName(c) + "/*")
+		for c in range(1, categories, 3):
+			for p in range(0, packages, 2):
+				lines.append("%s/%s" % ( catName(c), pkgName(p) ))
+		lines.append("@regex@:^%s/%s.*" % ( catName(2), pkgName(1) ))
+		os.makedirs(os.path.join(self.pkgdir, "package-sets"))
+		with open(os.path.join(self.pkgdir, "package-sets", "bench-packages"), "w") as f:
+			f.write("\n".join(lines) + "\n")
+		with open(os.path.join(self.pkgdir, "package-sets", "bench-skip"), "w") as f:
+			f.write("%s/%s\n" % ( catName(0), pkgName(0) ))
+
+	def emptyDest(self):
+		# an empty destination git tree, with just profiles/ so categories get written:
+		if os.path.exists(self.dest_root):
+			shutil.rmtree(self.dest_root)
+		os.makedirs(os.path.join(self.dest_root, "profiles"))
+		subprocess.run(["git", "init", "-q"], cwd=self.dest_root, check=True)
+		merge_utils.tree_listings.clear()
+		self.dest = GitTree("bench-dest", root=self.dest_root)
+
+	def copiedDest(self):
+		# a destination tree that starts out as a copy of src (git repository included):
+		if os.path.exists(self.dest_root):
+			shutil.rmtree(self.dest_root)
+		copyTree(self.src_root, self.dest_root)
+		merge_utils.tree_listings.clear()
+		self.dest = GitTree("bench-dest", root=self.dest_root)
+
+	def coldListings(self):
+		merge_utils.tree_listings.clear()
+
+	# the benchmarks -- each is a (setup, run) pair of methods:
+
+	def runInsertEbuilds(self):
+		self.dest.run([ InsertEbuilds(self.src, select="all", skip=None, replace=False) ])
+
+	def runInsertEbuildsMerge(self):
+		# overlay on top of src, merging Manifests of the catpkgs both have:
+		self.dest.run([ InsertEbuilds(self.overlay, select="all", skip=None, replace=True, merge=True) ])
+
+	def runInsertFiles(self):
+		self.dest.run([ InsertEclasses(self.src, select="all"), InsertLicenses(self.src, select="all") ])
+
+	def runMinify(self):
+		self.dest.run([ Minify() ])
+
+	def runManifestMerge(self):
+		stats = ManifestMergeStats()
+		for c in range(self.params["categories"]):
+			for p in range(self.params["packages"]):
+				catpkg = "%s/%s" % ( catName(c), pkgName(p) )
+				path = os.path.join(self.dest_root, catpkg, "Manifest")
+				entries = readManifest(path)
+				mergeManifest(entries, os.path.join(self.overlay_root, catpkg, "Manifest"), stats)
+				writeManifest(path, entries)
+		return stats.manifests
+
+	def runGetAllCatPkgs(self):
+		return len(self.src.getAllCatPkgs())
+
+	def runGenerateAuditSet(self):
+		return len(generateAuditSet("bench", self.src, pkgdir=self.pkgdir, catpkg_dict={}))
+
+	def runZapMatchingEbuilds(self):
+		# zap every other category's worth of overlay catpkgs from a copy of src:
+		select = [ "%s/*" % catName(c) for c in range(0, self.params["categories"], 2) ]
+		self.dest.run([ ZapMatchingEbuilds(self.overlay, select=select) ])
+
+	benchmarks = [
+		( "InsertEbuilds", "emptyDest", "runInsertEbuilds" ),
+		( "InsertEbuilds-merge", "copiedDest", "runInsertEbuildsMerge" ),
+		( "InsertFilesFromSubdir", "emptyDest", "runInsertFiles" ),
+		( "Minify", "copiedDest", "runMinify" ),
+		( "ManifestMerge", "copiedDest", "runManifestMerge" ),
+		( "getAllCatPkgs", "coldListings", "runGetAllCatPkgs" ),
+		( "generateAuditSet", "coldListings", "runGenerateAuditSet" ),
+		( "ZapMatchingEbuilds", "copiedDest", "runZapMatchingEbuilds" ),
+	]
+
+def quiet():
+	# merge_utils is chatty -- send its output to /dev/null while timing, and return a function to restore it.
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, "w")
+	def restore():
+		sys.stdout.close()
+		sys.stdout = stdout
+	return restore
+
+def runScale(workdir, scale, repeat=3, only=None):
+
+	"""
+	Generate the trees for scale under workdir and run the benchmarks (all of them, or the names in only) repeat
+	times each. Returns a list of result dicts with the times of each repetition, in seconds.
+	"""
+
+	bench = Bench(workdir, scale)
+	print("%s: generated %s catpkgs, %s ebuilds (%s files per tree) in %.2fs" % ( scale, bench.counts["catpkgs"],
+		bench.counts["ebuilds"], bench.counts["files"], bench.generate_secs ))
+	results = []
+	for name, setup, run in Bench.benchmarks:
+		if only != None and name not in only:
+			continue
+		times = []
+		value = None
+		for i in range(repeat):
+			restore = quiet()
+			try:
+				getattr(bench, setup)()
+				start = time.perf_counter()
+				value = getattr(bench, run)()
+				times.append(time.perf_counter() - start)
+			finally:
+				restore()
+		result = { "scale" : scale, "benchmark" : name, "catpkgs" : bench.counts["catpkgs"], "times" : times,
+			"min" : min(times), "median" : statistics.median(times) }
+		if value != None:
+			result["result"] = value
+		print("  %-24s min %8.3fs  median %8.3fs" % ( name, result["min"], result["median"] ))
+		results.append(result)
+	return results
+
+# vim: ts=4 sw=4 noet tw=140
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+# Synthetic portage trees for benchmarking merge_utils without production trees or network access.
+
+import os
+import random
+import hashlib
+import subprocess
+
+# named scales -- a dict of generateTree() keyword arguments for each:
+scales = {
+	"small" : { "categories" : 10, "packages" : 20, "ebuilds" : 3, "eclasses" : 20, "licenses" : 20 },
+	"medium" : { "categories" : 40, "packages" : 50, "ebuilds" : 3, "eclasses" : 100, "licenses" : 100 },
+	"large" : { "categories" : 160, "packages" : 120, "ebuilds" : 3, "eclasses" : 300, "licenses" : 500 },
+}
+
+def catName(i):
+	return "cat%s-bench" % i
+
+def pkgName(i):
+	return "pkg%s" % i
+
+def fakeHashes(name, size):
+	h = hashlib.sha256(("%s %s" % (name, size)).encode("utf-8")).hexdigest()
+	return "%s SHA256 %s SHA512 %s WHIRLPOOL %s" % ( size, h, h * 2, h * 2 )
+
+def writeFile(path, content):
+	with open(path, "w") as f:
+		f.write(content)
+
+def generateTree(root, categories=10, packages=20, ebuilds=3, distfiles=2, eclasses=20, licenses=20, metadata=True,
+	manifests=True, changelogs=True, seed=0, name="bench", git=True):
+
+	"""
+	Write a synthetic portage tree to root (which must not exist yet) and return a dict of counts of what was written.
+	There are categories categories with packages packages each, and every package has ebuilds ebuilds, a
+	Manifest with distfiles DIST lines per ebuild plus EBUILD/AUX/MISC lines (so Minify has something to do), a
+	ChangeLog, a metadata.xml with a few USE flags and a files/ directory. Ebuilds inherit from the eclasses in
+	eclass/ and use the licenses in licenses/. seed controls versions and which eclasses and licenses are used, so
+	trees generated with different seeds overlap in catpkgs but differ in their contents. With git=True, the tree
+	is committed to a new git repository.
+	"""
+
+	rand = random.Random(seed)
+	os.makedirs(root)
+	counts = { "catpkgs" : 0, "ebuilds" : 0, "files" : 0 }
+
+	os.makedirs(os.path.join(root, "profiles"))
+	os.makedirs(os.path.join(root, "metadata"))
+	writeFile(os.path.join(root, "profiles/repo_name"), name + "\n")
+	writeFile(os.path.join(root, "profiles/categories"), "".join(catName(c) + "\n" for c in range(categories)))
+	writeFile(os.path.join(root, "profiles/thirdpartymirrors"), "gentoo\thttp://distfiles.gentoo.org\n")
+	writeFile(os.path.join(root, "metadata/layout.conf"), "repo-name = %s\nthin-manifests = true\n" % name)
+	counts["files"] += 4
+
+	eclass_names = [ "bench-eclass%s" % i for i in range(eclasses) ]
+	os.makedirs(os.path.join(root, "eclass"))
+	for eclass in eclass_names:
+		writeFile(os.path.join(root, "eclass", eclass + ".eclass"), "# synthetic eclass %s\n\nEXPORT_FUNCTIONS src_compile\n\n%s_src_compile() {\n\t:\n}\n" % (eclass, eclass))
+	license_names = [ "BENCH-%s" % i for i in range(licenses) ]
+	os.makedirs(os.path.join(root, "licenses"))
+	for lic in license_names:
+		writeFile(os.path.join(root, "licenses", lic), ("License text of %s.\n" % lic) * 40)
+	counts["files"] += eclasses + licenses
+
+	for c in range(categories):
+		cat = catName(c)
+		for p in range(packages):
+			pkg = pkgName(p)
+			pkgdir = os.path.join(root, cat, pkg)
+			os.makedirs(os.path.join(pkgdir, "files"))
+			manifest = []
+			major = rand.randint(1, 9)
+			for e in range(ebuilds):
+				version = "%s.%s.%s" % ( major, e, rand.randint(0, 20) )
+				inherit = " ".join(rand.sample(eclass_names, min(2, len(eclass_names))))
+				lic = rand.choice(license_names) if license_names else ""
+				writeFile(os.path.join(pkgdir, "%s-%s.ebuild" % (pkg, version)),
+					'# Copyright 1999-2017 Gentoo Foundation\n# Distributed under the terms of the GNU General Public License v2\n\n'
+					'EAPI=6\n\ninherit %s\n\nDESCRIPTION="Synthetic package %s/%s"\nHOMEPAGE="https://example.org/%s"\n'
+					'SRC_URI="https://example.org/%s-%s.tar.gz"\n\nLICENSE="%s"\nSLOT="0"\nKEYWORDS="~amd64 ~x86"\n'
+					'IUSE="doc test"\n\nDEPEND="%s/%s"\nRDEPEND="${DEPEND}"\n' % ( inherit, cat, pkg, pkg, pkg, version, lic,
+					catName(rand.randrange(categories)), pkgName(rand.randrange(packages)) ))
+				counts["ebuilds"] += 1
+				counts["files"] += 1
+				for d in range(distfiles):
+					fn = "%s-%s%s.tar.gz" % ( pkg, version, "-extra%s" % d if d else "" )
+					manifest.append("DIST %s %s\n" % ( fn, fakeHashes(fn, rand.randint(1000, 10000000)) ))
+				manifest.append("EBUILD %s-%s.ebuild %s\n" % ( pkg, version, fakeHashes(version, 600) ))
+			writeFile(os.path.join(pkgdir, "files", "%s-fix-build.patch" % pkg), "--- a/Makefile\n+++ b/Makefile\n@@ -1 +1 @@\n-CFLAGS=-O2\n+CFLAGS+=-O2\n")
+			counts["files"] += 1
+			if manifests:
+				manifest.append("AUX %s-fix-build.patch %s\n" % ( pkg, fakeHashes(pkg, 80) ))
+				manifest.append("MISC metadata.xml %s\n" % fakeHashes(pkg, 400))
+				writeFile(os.path.join(pkgdir, "Manifest"), "".join(manifest))
+				counts["files"] += 1
+			if changelogs:
+				writeFile(os.path.join(pkgdir, "ChangeLog"), ("# ChangeLog for %s/%s\n\n" % (cat, pkg)) + "  01 Jan 2017; Someone <someone@example.org> +files:\n  Bump.\n\n" * 20)
+				counts["files"] += 1
+			if metadata:
+				writeFile(os.path.join(pkgdir, "metadata.xml"),
+					'<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE pkgmetadata SYSTEM "http://www.gentoo.org/dtd/metadata.dtd">\n'
+					'<pkgmetadata>\n\t<maintainer type="person">\n\t\t<email>someone@example.org</email>\n\t</maintainer>\n'
+					'\t<use>\n\t\t<flag name="bench%s">Enable synthetic feature %s</flag>\n\t\t<flag name="extra">Extra bits</flag>\n\t</use>\n'
+					'</pkgmetadata>\n' % ( p, p ))
+				counts["files"] += 1
+			counts["catpkgs"] += 1
+
+	if git:
+		env = dict(os.environ, GIT_AUTHOR_NAME="bench", GIT_AUTHOR_EMAIL="bench@localhost", GIT_COMMITTER_NAME="bench",
+			GIT_COMMITTER_EMAIL="bench@localhost")
+		for args in [ ["init", "-q"], ["add", "-A"], ["commit", "-q", "-m", "synthetic tree (seed %s)" % seed] ]:
+			subprocess.run(["git"] + args, cwd=root, env=env, check=True, stdout=subprocess.DEVNULL)
+	return counts
+
+# vim: ts=4 sw=4 noet tw=140
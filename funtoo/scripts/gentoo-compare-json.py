@@ -12,24 +12,10 @@ import json
 from merge_utils import *
 dirpath = os.path.dirname(os.path.realpath(__file__))
 
-print("List of differences between funtoo and gentoo")
-print("=============================================")
+keyword_provider = KeywordProvider(dirpath + "/keywords.sh")
 
 def getKeywords(portdir, ebuild, warn):
-	a = subprocess.getstatusoutput(dirpath + "/keywords.sh %s %s" % ( portdir, ebuild ) )
-	if a[0] == 0:
-		my_set = set(a[1].split())
-		return (0, my_set)
-	else:
-		return a
-	
-
-if len(sys.argv) != 3:
-	print("Please specify funtoo tree as first argument, gentoo tree as second argument.")
-	sys.exit(1)
-
-gportdir=sys.argv[2]
-portdir=sys.argv[1]
+	return keyword_provider.getKeywords(portdir, ebuild)
 
 def filterOnKeywords(portdir, ebuilds, keywords, warn=False):
 	""" 
@@ -63,84 +49,225 @@ def filterOnKeywords(portdir, ebuilds, keywords, warn=False):
 			break
 	return filtered	
 
+# TreeListings of the trees being compared. These are set up before the worker processes are forked, so that they are
+# shared by all of them:
+listings = {}
+
+def get_listing(portdir):
+	if portdir not in listings:
+		listings[portdir] = getTreeListing(portdir)
+	return listings[portdir]
+
 def get_cpv_in_portdir(portdir,cat,pkg):
-	if not os.path.exists("%s/%s/%s" % (portdir, cat, pkg)):
-		return []
-	if not os.path.isdir("%s/%s/%s" % (portdir, cat, pkg)):
+	listing = get_listing(portdir)
+	if not listing.isdir("%s/%s" % (cat, pkg)):
 		return []
-	files = os.listdir("%s/%s/%s" % (portdir, cat, pkg))
+	files = listing.listdir("%s/%s" % (cat, pkg))
 	ebuilds = []
 	for file in files:
 		if file[-7:] == ".ebuild":
 			ebuilds.append("%s/%s" % (cat, file[:-7]))
 	return ebuilds
 	
-def version_compare(portdir,gportdir,keywords,label):
+def compare_package(portdir,gportdir,keywords,cat,pkg):
+	"""
+	Compare cat/pkg in both trees. Returns a (json entry, message) tuple if gentoo has a
+	newer version than funtoo, otherwise None.
+	"""
+	ebuilds = get_cpv_in_portdir(portdir,cat,pkg)
+	gebuilds =get_cpv_in_portdir(gportdir,cat,pkg)
+	ebuilds = filterOnKeywords(portdir, ebuilds, keywords, warn=True)
+
+	if len(ebuilds) == 0:
+		return None
+
+	fbest = portage.versions.best(ebuilds)
+
+	gebuilds = filterOnKeywords(gportdir, gebuilds, keywords, warn=False)
+
+	if len(gebuilds) == 0:
+		return None
+
+	gbest = portage.versions.best(gebuilds)
+
+	if fbest == gbest:
+		return None
+
+	# a little trickery to ignore rev differences:
+
+	fps = list(portage.versions.catpkgsplit(fbest))[1:]
+	gps = list(portage.versions.catpkgsplit(gbest))[1:]
+	gps[-1] = "r0"
+	fps[-1] = "r0"
+	if gps[-2] in [ "9999", "99999", "999999", "9999999", "99999999"]:
+		return None
+	mycmp = portage.versions.pkgcmp(fps, gps)
+	if mycmp == -1:
+		return ("%s/%s %s %s" % (cat, pkg, gbest[len(cat)+len(pkg)+2:], fbest[len(cat)+len(pkg)+2:]), "%s (vs. %s in funtoo)" % ( gbest, fbest ))
+	return None
+
+def compare_category(args):
+	portdir, gportdir, keywords, cat, pkgs = args
+	if pkgs == None:
+		pkgs = get_listing(portdir).listdir(cat)
+	results = []
+	for pkg in pkgs:
+		result = compare_package(portdir,gportdir,keywords,cat,pkg)
+		if result != None:
+			results.append((cat + "/" + pkg, list(result)))
+	return results
+
+def version_compare(portdir,gportdir,keywords,catpkgs=None,workers=None):
+	"""
+	Compare the trees and return a dict mapping each catpkg where gentoo is ahead to a [json entry, message]
+	list. If catpkgs is specified, only those catpkgs are looked at.
+	"""
 	print
 	print("Package comparison for %s" % keywords)
 	print("============================================")
 	print("(note that package.{un}mask(s) are ignored - looking at ebuilds only)")
 	print
 
-	for cat in os.listdir(portdir):
+	listing = get_listing(portdir)
+	glisting = get_listing(gportdir)
+	if catpkgs == None:
+		pkgs = {}
+		for cat in listing.listdir():
+			pkgs[cat] = None
+	else:
+		pkgs = {}
+		for catpkg in catpkgs:
+			cat, pkg = catpkg.split("/", 1)
+			if cat not in pkgs:
+				pkgs[cat] = []
+			pkgs[cat].append(pkg)
+	jobs = []
+	for cat in sorted(pkgs.keys()):
 		if cat == ".git":
 			continue
-		if not os.path.exists(gportdir+"/"+cat):
+		if not glisting.isdir(cat):
 			continue
-		if not os.path.isdir(gportdir+"/"+cat):
+		if not listing.isdir(cat):
 			continue
-		for pkg in os.listdir(os.path.join(portdir,cat)):
-			ebuilds = get_cpv_in_portdir(portdir,cat,pkg)
-			gebuilds =get_cpv_in_portdir(gportdir,cat,pkg)
-			ebuilds = filterOnKeywords(portdir, ebuilds, keywords, warn=True)
+		jobs.append((portdir, gportdir, keywords, cat, sorted(pkgs[cat]) if pkgs[cat] != None else None))
 
-			if len(ebuilds) == 0:
-				continue
-	
-			fbest = portage.versions.best(ebuilds)
-	
-			gebuilds = filterOnKeywords(gportdir, gebuilds, keywords, warn=False)
+	# categories are compared in worker processes; map() hands results back in submission order,
+	# so the output does not depend on scheduling.
+	out = {}
+	if len(jobs) == 0:
+		return out
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+		for results in executor.map(compare_category, jobs, chunksize=4):
+			for catpkg, result in results:
+				out[catpkg] = result
+	return out
 
-			if len(gebuilds) == 0:
-				continue
+def compare_state_file(label):
+	return os.path.join(cache_dir, "gentoo-compare", label + ".json")
 
-			gbest = portage.versions.best(gebuilds)
-	
-			if fbest == gbest:
-				continue
-		
-			# a little trickery to ignore rev differences:
-	
-			fps = list(portage.versions.catpkgsplit(fbest))[1:]
-			gps = list(portage.versions.catpkgsplit(gbest))[1:]
-			gps[-1] = "r0"
-			fps[-1] = "r0"
-			if gps[-2] in [ "9999", "99999", "999999", "9999999", "99999999"]:
-				continue
-			mycmp = portage.versions.pkgcmp(fps, gps)
-			if mycmp == -1:
-				json_out[label].append("%s/%s %s %s" % (cat, pkg, gbest[len(cat)+len(pkg)+2:], fbest[len(cat)+len(pkg)+2:]))
-				print("%s (vs. %s in funtoo)" % ( gbest, fbest ))
-json_out={}
-for keyw in [ "~amd64" ]:
-	if keyw == "~x86":
-		label = "fcx8632"
-	elif keyw == "~amd64":
-		label = "fcx8664"
-	json_out[label] = []
-	if keyw[0] == "~":
-		# for unstable, add stable arch and ~* and * keywords too
-		keyw = [ keyw, keyw[1:], "~*", "*"]
+def load_compare_state(label, trees, keywords):
+	# return the state saved by the previous run, or None if it doesn't apply to this run.
+	try:
+		with open(compare_state_file(label), "r") as f:
+			state = json.load(f)
+	except (IOError, ValueError):
+		return None
+	if state.get("keywords") != keywords:
+		return None
+	for name, path in trees:
+		if state.get("trees", {}).get(name, {}).get("path") != path:
+			return None
+	return state
+
+def changed_compare_catpkgs(state, trees):
+	# return the catpkgs touched in either tree since the saved state was recorded, or None if git can't tell us.
+	catpkgs = set()
+	for name, path in trees:
+		paths = gitChangedPaths(path, state["trees"][name]["sha"])
+		if paths == None:
+			return None
+		for path in paths:
+			catpkg = pathToCatPkg(path)
+			if catpkg != None:
+				catpkgs.add(catpkg)
+	return catpkgs
+
+def save_compare_state(label, trees, keywords, results):
+	state = { "keywords" : keywords, "trees" : {}, "results" : results }
+	for name, path in trees:
+		sha = gitRevParse(path)
+		if sha == None or gitChangedPaths(path, sha):
+			# results for uncommitted changes can't be tied to a SHA; leave the previous state alone -- the next
+			# diff against it will pick these paths up again.
+			return False
+		state["trees"][name] = { "path" : path, "sha" : sha }
+	fn = compare_state_file(label)
+	os.makedirs(os.path.dirname(fn), exist_ok=True)
+	with open(fn + ".tmp", "w") as f:
+		json.dump(state, f)
+	os.replace(fn + ".tmp", fn)
+	return True
+
+def incremental_compare(label, trees, keywords, full=False):
+	"""
+	Run version_compare on trees, a [("funtoo", path), ("gentoo", path)] list, and save the results as the state for
+	label. If the state saved by the previous run applies and full is not set, only the catpkgs that changed in
+	either tree since then are recomputed.
+	"""
+	portdir, gportdir = trees[0][1], trees[1][1]
+	state = None if full else load_compare_state(label, trees, keywords)
+	catpkgs = changed_compare_catpkgs(state, trees) if state != None else None
+	if catpkgs == None:
+		results = version_compare(portdir,gportdir,keywords)
 	else:
-		# for stable, also consider the * keyword
-		keyw = [ keyw, "*"]
-
-	version_compare(portdir,gportdir,keyw,label)
-for key in json_out:
-	json_out[key].sort()
-	json_out[key] = ",".join(json_out[key])
-jsonfile = "/home/ports/public_html/my.json"
-a = open(jsonfile, 'w')
-json.dump(json_out, a, sort_keys=True, indent=4, separators=(',',": "))
-a.close()
-print("Wrote output to %s" % jsonfile)
+		# only recompute what changed in either tree, and patch it into the previous results:
+		print("Recomputing %s changed catpkgs" % len(catpkgs))
+		results = state["results"]
+		for catpkg in catpkgs:
+			if catpkg in results:
+				del results[catpkg]
+		results.update(version_compare(portdir,gportdir,keywords,catpkgs=catpkgs))
+	save_compare_state(label, trees, keywords, results)
+	return results
+
+if __name__ == "__main__":
+	args = sys.argv[1:]
+	full = "--full" in args
+	if full:
+		args.remove("--full")
+	if len(args) != 2:
+		print("Please specify funtoo tree as first argument, gentoo tree as second argument. Use --full to ignore saved state.")
+		sys.exit(1)
+
+	gportdir=os.path.abspath(args[1])
+	portdir=os.path.abspath(args[0])
+	trees = [ ("funtoo", portdir), ("gentoo", gportdir) ]
+
+	print("List of differences between funtoo and gentoo")
+	print("=============================================")
+
+	json_out={}
+	for keyw in [ "~amd64" ]:
+		if keyw == "~x86":
+			label = "fcx8632"
+		elif keyw == "~amd64":
+			label = "fcx8664"
+		if keyw[0] == "~":
+			# for unstable, add stable arch and ~* and * keywords too
+			keyw = [ keyw, keyw[1:], "~*", "*"]
+		else:
+			# for stable, also consider the * keyword
+			keyw = [ keyw, "*"]
+
+		results = incremental_compare(label, trees, keyw, full)
+		for catpkg in sorted(results.keys()):
+			print(results[catpkg][1])
+		json_out[label] = [ results[catpkg][0] for catpkg in results ]
+	for key in json_out:
+		json_out[key].sort()
+		json_out[key] = ",".join(json_out[key])
+	jsonfile = "/home/ports/public_html/my.json"
+	a = open(jsonfile, 'w')
+	json.dump(json_out, a, sort_keys=True, indent=4, separators=(',',": "))
+	a.close()
+	print("Wrote output to %s" % jsonfile)
@@ -4,8 +4,8 @@ import os
 import sys
 from merge_utils import *
 
-xml_out = etree.Element("packages")
-funtoo_staging_w = GitTree("funtoo-staging", "master", "repos@localhost:ports/funtoo-staging.git", root="/var/git/dest-trees/funtoo-staging", pull=False, xml_out=xml_out)
+xml_out = PackageXMLRecorder()
+funtoo_staging_w = GitTree("funtoo-staging", "master", "repos@localhost:ports/funtoo-staging.git", root="/var/git/dest-trees/funtoo-staging", pull=False, xml_out=xml_out, step_cache=True)
 #funtoo_staging_w = GitTree("funtoo-staging-unfork", "master", "repos@localhost:ports/funtoo-staging-unfork.git", root="/var/git/dest-trees/funtoo-staging-unfork", pull=False, xml_out=None)
 xmlfile="/home/ports/public_html/packages.xml"
 
@@ -25,7 +25,7 @@ if os.path.exists(p):
 	print("Using commit: %s" % commit)
 else:
 	commit = None
-gentoo_staging_r = GitTree("gentoo-staging", "master", "repos@localhost:ports/gentoo-staging.git", commit=commit, pull=True)
+gentoo_staging_r = GitTree("gentoo-staging", "master", "repos@localhost:ports/gentoo-staging.git", commit=commit, pull=True, defer=True)
 
 # These overlays are monitored for changes -- if there are changes in these overlays, we regenerate the entire
 # tree. If there aren't changes in these overlays, we don't.
@@ -38,13 +38,13 @@ gentoo_staging_r = GitTree("gentoo-staging", "master", "repos@localhost:ports/ge
 # best solution.
 
 shards = {
-	"perl" : GitTree("gentoo-perl-shard", "7ffec93dd83b76c06a69484f2d9e6d6831790d7f", "repos@localhost:ports/gentoo-perl-shard.git", pull=True),
-	"kde" : GitTree("gentoo-kde-shard", "d33259410e3eb1b0330698520796cb927ac596e7", "repos@localhost:ports/gentoo-kde-shard.git", pull=True),
-	"gnome" : GitTree("gentoo-gnome-shard", "ffabb752f8f4e23a865ffe9caf72f950695e2f26", "repos@localhost:ports/gentoo-gnome-shard.git", pull=True),
-	"xorg" : GitTree("xorg-kit", "gentoo-1.19-snap", "repos@localhost:kits/xorg-kit.git", pull=True),
-	"media" : GitTree("gentoo-media-shard", "cb07fcb2f4fd84d5ca8bf57d0eacd99301cc0636", "repos@localhost:ports/gentoo-media-shard.git", pull=True),
-	"office" : GitTree("gentoo-office-shard", "e482bdff839aed9b81cd9c62ce435aa4e78c8cab", "repos@localhost:ports/gentoo-office-shard.git", pull=True),
-	"core" : GitTree("gentoo-core-shard", "4ff408b3de5465c5a63480e01e219ec62fee175e", "repos@localhost:ports/gentoo-core-shard.git", pull=True)
+	"perl" : GitTree("gentoo-perl-shard", "7ffec93dd83b76c06a69484f2d9e6d6831790d7f", "repos@localhost:ports/gentoo-perl-shard.git", pull=True, defer=True, depth=1),
+	"kde" : GitTree("gentoo-kde-shard", "d33259410e3eb1b0330698520796cb927ac596e7", "repos@localhost:ports/gentoo-kde-shard.git", pull=True, defer=True, depth=1),
+	"gnome" : GitTree("gentoo-gnome-shard", "ffabb752f8f4e23a865ffe9caf72f950695e2f26", "repos@localhost:ports/gentoo-gnome-shard.git", pull=True, defer=True, depth=1),
+	"xorg" : GitTree("xorg-kit", "gentoo-1.19-snap", "repos@localhost:kits/xorg-kit.git", pull=True, defer=True),
+	"media" : GitTree("gentoo-media-shard", "cb07fcb2f4fd84d5ca8bf57d0eacd99301cc0636", "repos@localhost:ports/gentoo-media-shard.git", pull=True, defer=True, depth=1),
+	"office" : GitTree("gentoo-office-shard", "e482bdff839aed9b81cd9c62ce435aa4e78c8cab", "repos@localhost:ports/gentoo-office-shard.git", pull=True, defer=True, depth=1),
+	"core" : GitTree("gentoo-core-shard", "4ff408b3de5465c5a63480e01e219ec62fee175e", "repos@localhost:ports/gentoo-core-shard.git", pull=True, defer=True, depth=1)
 }
 
 # perl: 7ffec93dd83b76c06a69484f2d9e6d6831790d7f (Updated 12 Jan 2017)
@@ -56,14 +56,14 @@ shards = {
 # funtoo-toolchain: 0ea91caf10eab4ca160b56a653f929f65cdf35fb (Updated 15 Apr 2017)
 
 funtoo_overlays = {
-	"funtoo_media" : GitTree("funtoo-media", "master", "repos@localhost:funtoo-media.git", pull=True),
-	"plex_overlay" : GitTree("funtoo-plex", "master", "https://github.com/Ghent/funtoo-plex.git", pull=True),
-	"gnome_fixups" : GitTree("gnome-3.20-fixups", "master", "repos@localhost:ports/gnome-3.20-fixups.git", pull=True),
-	"tmp-shard-fixups" : GitTree("tmp-shard-fixups", "master", "repos@localhost:ports/tmp-shard-fixups.git", pull=True),
-	"funtoo_toolchain" : GitTree("funtoo-toolchain", "0ea91caf10eab4ca160b56a653f929f65cdf35fb", "repos@localhost:funtoo-toolchain-overlay.git", pull=True),
-	"deadbeef_overlay" : GitTree("deadbeef-overlay", "master", "https://github.com/damex/deadbeef-overlay.git", pull=True),
-	"wmfs_overlay" : GitTree("wmfs-overlay", "master", "https://github.com/damex/wmfs-overlay.git", pull=True),
-	"flora" : GitTree("flora", "master", "repos@localhost:flora.git", pull=True),
+	"funtoo_media" : GitTree("funtoo-media", "master", "repos@localhost:funtoo-media.git", pull=True, defer=True),
+	"plex_overlay" : GitTree("funtoo-plex", "master", "https://github.com/Ghent/funtoo-plex.git", pull=True, defer=True),
+	"gnome_fixups" : GitTree("gnome-3.20-fixups", "master", "repos@localhost:ports/gnome-3.20-fixups.git", pull=True, defer=True),
+	"tmp-shard-fixups" : GitTree("tmp-shard-fixups", "master", "repos@localhost:ports/tmp-shard-fixups.git", pull=True, defer=True),
+	"funtoo_toolchain" : GitTree("funtoo-toolchain", "0ea91caf10eab4ca160b56a653f929f65cdf35fb", "repos@localhost:funtoo-toolchain-overlay.git", pull=True, defer=True, depth=1),
+	"deadbeef_overlay" : GitTree("deadbeef-overlay", "master", "https://github.com/damex/deadbeef-overlay.git", pull=True, defer=True),
+	"wmfs_overlay" : GitTree("wmfs-overlay", "master", "https://github.com/damex/wmfs-overlay.git", pull=True, defer=True),
+	"flora" : GitTree("flora", "master", "repos@localhost:flora.git", pull=True, defer=True),
 }
 
 # These are other overlays that we merge into the Funtoo tree. However, we just pull in the most recent versions
@@ -71,31 +71,32 @@ funtoo_overlays = {
 # fusion809_overlay: 8322bcd79d47ef81f7417c324a1a2b4772020985 (Updated, 1 Jun 2017)
 
 other_overlays = {
-	"foo_overlay" : GitTree("foo-overlay", "master", "https://github.com/slashbeast/foo-overlay.git", pull=True),
-	"bar_overlay" : GitTree("bar-overlay", "master", "git://github.com/adessemond/bar-overlay.git", pull=True),
-	"squeezebox_overlay" : GitTree("squeezebox", "master", "git://anongit.gentoo.org/user/squeezebox.git", pull=True),
-	"pantheon_overlay" : GitTree("pantheon", "master", "https://github.com/pimvullers/elementary.git", pull=True),
-	"sabayon_for_gentoo" : GitTree("sabayon-for-gentoo", "master", "git://github.com/Sabayon/for-gentoo.git", pull=True),
-	"tripsix_overlay" : GitTree("tripsix", "master", "https://github.com/666threesixes666/tripsix.git", pull=True),
-	"faustoo_overlay" : GitTree("faustoo", "master", "https://github.com/fmoro/faustoo.git", pull=True),
-	"wltjr_overlay" : GitTree("wltjr", "master", "https://github.com/Obsidian-StudiosInc/os-xtoo", pull=True),
-	"vmware_overlay" : GitTree("vmware", "master", "git://anongit.gentoo.org/proj/vmware.git", pull=True),
-	"lisp_overlay" : GitTree("lisp", "master", "git://anongit.gentoo.org/proj/lisp.git", pull=True),
-	"atom_overlay" : GitTree("atom", "master", "https://github.com/elprans/atom-overlay.git", pull=True),
-	"bhenc_overlay" : GitTree("bhenc", "master", "https://github.com/antematherian/archive-overlay.git", pull=True),
-	"fusion809_overlay" : GitTree("fusion809", "8322bcd79d47ef81f7417c324a1a2b4772020985", "https://github.com/fusion809/fusion809-overlay.git", pull=True),
+	"foo_overlay" : GitTree("foo-overlay", "master", "https://github.com/slashbeast/foo-overlay.git", pull=True, defer=True),
+	"bar_overlay" : GitTree("bar-overlay", "master", "git://github.com/adessemond/bar-overlay.git", pull=True, defer=True),
+	"squeezebox_overlay" : GitTree("squeezebox", "master", "git://anongit.gentoo.org/user/squeezebox.git", pull=True, defer=True),
+	"pantheon_overlay" : GitTree("pantheon", "master", "https://github.com/pimvullers/elementary.git", pull=True, defer=True),
+	"sabayon_for_gentoo" : GitTree("sabayon-for-gentoo", "master", "git://github.com/Sabayon/for-gentoo.git", pull=True, defer=True),
+	"tripsix_overlay" : GitTree("tripsix", "master", "https://github.com/666threesixes666/tripsix.git", pull=True, defer=True),
+	"faustoo_overlay" : GitTree("faustoo", "master", "https://github.com/fmoro/faustoo.git", pull=True, defer=True),
+	"wltjr_overlay" : GitTree("wltjr", "master", "https://github.com/Obsidian-StudiosInc/os-xtoo", pull=True, defer=True),
+	"vmware_overlay" : GitTree("vmware", "master", "git://anongit.gentoo.org/proj/vmware.git", pull=True, defer=True),
+	"lisp_overlay" : GitTree("lisp", "master", "git://anongit.gentoo.org/proj/lisp.git", pull=True, defer=True),
+	"atom_overlay" : GitTree("atom", "master", "https://github.com/elprans/atom-overlay.git", pull=True, defer=True),
+	"bhenc_overlay" : GitTree("bhenc", "master", "https://github.com/antematherian/archive-overlay.git", pull=True, defer=True),
+	"fusion809_overlay" : GitTree("fusion809", "8322bcd79d47ef81f7417c324a1a2b4772020985", "https://github.com/fusion809/fusion809-overlay.git", pull=True, defer=True, depth=1),
 }
 
-funtoo_changes = False
-if funtoo_overlay.changes:
-	funtoo_changes = True
-elif gentoo_staging_r.changes:
-	funtoo_changes = True
-else:
-	for fo in funtoo_overlays:
-		if funtoo_overlays[fo].changes:
-			funtoo_changes = True
-			break
+# Everything but funtoo-overlay (which we needed to read commit-staged from) was created with defer=True, so
+# fetch it all now, concurrently:
+
+initializeTrees([ gentoo_staging_r ] + list(shards.values()) + list(funtoo_overlays.values()) + list(other_overlays.values()))
+
+# If none of our inputs changed since the last successful run, there's nothing to do -- merge-funtoo.sh treats exit
+# code 2 as "no new updates". Use --force to regenerate anyway.
+
+all_trees = [ funtoo_staging_w, funtoo_overlay, gentoo_staging_r ] + list(shards.values()) + list(funtoo_overlays.values()) + list(other_overlays.values())
+if "--force" not in sys.argv[1:]:
+	exitIfUnchanged(funtoo_staging_w.name, all_trees, [ os.path.realpath(__file__) ])
 
 # This next code regenerates the contents of the funtoo-staging tree. Funtoo's tree is itself composed of
 # many different overlays which are merged in an automated fashion. This code does it all.
@@ -253,9 +254,11 @@ for step in all_steps:
 	funtoo_staging_w.run(step)
 funtoo_staging_w.gitCommit(message="glorious funtoo updates",branch=push)
 if xmlfile:
-	a=open(xmlfile,"wb")
-	etree.ElementTree(xml_out).write(a, encoding='utf-8', xml_declaration=True, pretty_print=True)
-	a.close()
+	xml_out.write(xmlfile)
+# remember what we were generated from (including the commit we just made), so an identical run can be skipped:
+saveFingerprint(funtoo_staging_w.name, runFingerprint(all_trees, [ os.path.realpath(__file__) ]))
+# drop cached step outputs that no step record refers to any more:
+funtoo_staging_w.step_cache.prune()
 print("merge-funtoo-staging.py completed successfully.")
 sys.exit(0)
 
@@ -14,18 +14,20 @@ import subprocess
 dirpath = os.path.dirname(os.path.realpath(__file__))
 portdir = os.path.normpath(os.path.join(dirpath,"../.."))
 
+# merge_utils and keywords.sh live in the parent directory:
+sys.path.insert(0, os.path.dirname(dirpath))
+from merge_utils import KeywordProvider
+keyword_provider = KeywordProvider(os.path.dirname(dirpath) + "/keywords.sh")
+
 print("List of differences between funtoo-overlay and gentoo")
 print("=====================================================")
 
 def getKeywords(portdir, ebuild, warn):
-	a = subprocess.getstatusoutput(dirpath + "/keywords.sh %s %s" % ( portdir, ebuild ) )
+	a = keyword_provider.getKeywords(portdir, ebuild)
 	if a[0] == 0:
-		my_set = set(a[1].split())
-		if warn and len(my_set) == 0:
+		if warn and len(a[1]) == 0:
 			print("WARNING: ebuild %s has no keywords" % ebuild)
-		return (0, my_set)
-	else:
-		return a
+	return a
 	
 
 if len(sys.argv) != 2: